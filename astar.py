@@ -0,0 +1,223 @@
+'''
+
+提前结束的点到点搜索
+
+AStarRouter: 以到终点的直线距离为启发函数的A*搜索， 终点被确定后立即停止。
+BidirectionalRouter: 从起点和终点同时做dijkstra搜索， 两个方向相遇并确定最短距离后立即停止。
+
+两者的接口都与RoadGraph.shortest_paths相同。
+
+'''
+import math
+import heapq
+
+import metrics
+
+
+class AStarRouter(object):
+    '''
+    A*搜索
+
+    启发函数为 系数 * 节点到终点所在节点的直线距离， 系数见RoadGraph.get_heuristic_scale。
+    一次查询有多个终点时， 启发函数取到各终点的最小值， 所有终点都被确定后停止。
+    '''
+
+    def __init__(self, road_graph):
+        self.road_graph = road_graph
+
+    def search(self, source_idx, source_dis, goal_set, cutoff):
+        '''
+        从source_idx出发的A*搜索， goal_set中的节点都被确定或者超过cutoff后停止
+
+        Returns:
+        ---------
+        dist, pred : 见RoadGraph.search， 只包含已确定的节点
+        '''
+        road_graph = self.road_graph
+        offsets = road_graph.offsets
+        targets = road_graph.targets
+        weights = road_graph.weights
+
+        scale = road_graph.get_heuristic_scale()
+        goal_coords = [(road_graph.node_x[goal_idx], road_graph.node_y[goal_idx]) for goal_idx in goal_set]
+        node_x = road_graph.node_x
+        node_y = road_graph.node_y
+
+        heuristic_cache = {}
+
+        def heuristic(node_idx):
+            if scale == 0:
+                return 0
+            if node_idx not in heuristic_cache:
+                x = node_x[node_idx]
+                y = node_y[node_idx]
+                heuristic_cache[node_idx] = scale * min(math.hypot(x - goal_x, y - goal_y) for goal_x, goal_y in goal_coords)
+            return heuristic_cache[node_idx]
+
+        remain_goal_set = set(goal_set)
+        dist = {}
+        seen = {source_idx: source_dis}
+        pred = {source_idx: None}
+        heap = []
+        if source_dis <= cutoff:
+            heap.append((source_dis + heuristic(source_idx), source_dis, source_idx))
+        while heap and remain_goal_set:
+            _, d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            remain_goal_set.discard(u)
+            begin = offsets[u]
+            end = offsets[u + 1]
+            for edge_idx, v, weight in zip(range(begin, end), targets[begin:end].tolist(), weights[begin:end].tolist()):
+                vu_dist = d + weight
+                if vu_dist > cutoff:
+                    continue
+                if v not in seen or vu_dist < seen[v]:
+                    estimate = vu_dist + heuristic(v)
+                    if estimate > cutoff:
+                        continue
+                    seen[v] = vu_dist
+                    pred[v] = edge_idx
+                    heapq.heappush(heap, (estimate, vu_dist, v))
+        if metrics.ENABLED:
+            metrics.count('nodes_settled', len(dist))
+        return dist, pred
+
+    def shortest_paths(self, pre_closest_point, now_closest_points, cutoff, max_dis, with_path=True):
+        '''
+        获得一个候选点到多个候选点的最短路径， 见RoadGraph.shortest_paths
+        '''
+        road_graph = self.road_graph
+        source_idx, source_dis, is_virtual_source = road_graph.get_search_source(pre_closest_point)
+        targets = [road_graph.get_search_target(now_closest_point) for now_closest_point in now_closest_points]
+        dist, pred = self.search(source_idx, source_dis, set(target_idx for target_idx, _, _ in targets), cutoff)
+
+        result_list = []
+        for now_closest_point, (target_idx, target_dis, is_virtual_target) in zip(now_closest_points, targets):
+            if target_idx not in dist or dist[target_idx] + target_dis > cutoff:
+                result_list.append((max_dis, None, None))
+                continue
+            if not with_path:
+                result_list.append((dist[target_idx] + target_dis, None, None))
+                continue
+            vertex_path, road_path = road_graph.get_path(pred, target_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target)
+            result_list.append((dist[target_idx] + target_dis, vertex_path, road_path))
+        return result_list
+
+    def shortest_path(self, pre_closest_point, now_closest_point, cutoff, max_dis, with_path=True):
+        return self.shortest_paths(pre_closest_point, [now_closest_point], cutoff, max_dis, with_path)[0]
+
+
+class BidirectionalRouter(object):
+    '''
+    双向dijkstra搜索
+
+    正向搜索沿出边， 反向搜索沿入边（RoadGraph.get_reverse_csr），
+    两个方向堆顶距离之和不小于已找到的最短距离时停止。
+    '''
+
+    def __init__(self, road_graph):
+        self.road_graph = road_graph
+
+    def search(self, source_idx, source_dis, target_idx, target_dis, cutoff):
+        '''
+        Returns:
+        ---------
+        (dis, edge_path)
+            最短距离和组成最短路径的边， 不可达时为(None, None)
+        '''
+        road_graph = self.road_graph
+        forward_csr = (road_graph.offsets, road_graph.targets, road_graph.weights, None)
+        backward_csr = road_graph.get_reverse_csr()
+
+        dists = ({}, {})
+        seens = ({source_idx: source_dis}, {target_idx: target_dis})
+        preds = ({source_idx: None}, {target_idx: None})
+        heaps = ([], [])
+        if source_dis <= cutoff:
+            heaps[0].append((source_dis, source_idx))
+        if target_dis <= cutoff:
+            heaps[1].append((target_dis, target_idx))
+
+        best_dis = float('inf')
+        meet_idx = None
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best_dis:
+                break
+            # 每次扩展堆顶距离较小的方向
+            direction = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            dist = dists[direction]
+            seen = seens[direction]
+            pred = preds[direction]
+            heap = heaps[direction]
+            other_seen = seens[1 - direction]
+            offsets, neighbors, weights, edges = (forward_csr, backward_csr)[direction]
+
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            begin = offsets[u]
+            end = offsets[u + 1]
+            edge_list = range(begin, end) if edges is None else edges[begin:end].tolist()
+            for edge_idx, v, weight in zip(edge_list, neighbors[begin:end].tolist(), weights[begin:end].tolist()):
+                vu_dist = d + weight
+                if vu_dist > cutoff:
+                    continue
+                if v not in seen or vu_dist < seen[v]:
+                    seen[v] = vu_dist
+                    pred[v] = edge_idx
+                    heapq.heappush(heap, (vu_dist, v))
+                    if v in other_seen and vu_dist + other_seen[v] < best_dis:
+                        best_dis = vu_dist + other_seen[v]
+                        meet_idx = v
+            if u in other_seen and d + other_seen[u] < best_dis:
+                best_dis = d + other_seen[u]
+                meet_idx = u
+
+        if metrics.ENABLED:
+            metrics.count('nodes_settled', len(dists[0]) + len(dists[1]))
+        if meet_idx is None or best_dis > cutoff:
+            return None, None
+
+        edge_path = []
+        node_idx = meet_idx
+        while preds[0][node_idx] is not None:
+            edge_idx = preds[0][node_idx]
+            edge_path.append(edge_idx)
+            node_idx = road_graph.sources[edge_idx]
+        edge_path.reverse()
+        node_idx = meet_idx
+        while preds[1][node_idx] is not None:
+            edge_idx = preds[1][node_idx]
+            edge_path.append(edge_idx)
+            node_idx = road_graph.targets[edge_idx]
+        return best_dis, edge_path
+
+    def shortest_paths(self, pre_closest_point, now_closest_points, cutoff, max_dis, with_path=True):
+        '''
+        获得一个候选点到多个候选点的最短路径， 见RoadGraph.shortest_paths， 每个终点做一次双向搜索
+        '''
+        road_graph = self.road_graph
+        source_idx, source_dis, is_virtual_source = road_graph.get_search_source(pre_closest_point)
+
+        result_list = []
+        for now_closest_point in now_closest_points:
+            target_idx, target_dis, is_virtual_target = road_graph.get_search_target(now_closest_point)
+            dis, edge_path = self.search(source_idx, source_dis, target_idx, target_dis, cutoff)
+            if dis is None:
+                result_list.append((max_dis, None, None))
+                continue
+            if not with_path:
+                result_list.append((dis, None, None))
+                continue
+            pred = {source_idx: None}
+            for edge_idx in edge_path:
+                pred[road_graph.targets[edge_idx]] = edge_idx
+            vertex_path, road_path = road_graph.get_path(pred, target_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target)
+            result_list.append((dis, vertex_path, road_path))
+        return result_list
+
+    def shortest_path(self, pre_closest_point, now_closest_point, cutoff, max_dis, with_path=True):
+        return self.shortest_paths(pre_closest_point, [now_closest_point], cutoff, max_dis, with_path)[0]
@@ -0,0 +1,594 @@
+'''
+
+可重复的性能测试
+
+生成网格或放射状的模拟路网（与connected_road.shp相同的source, target, weight字段）和不同采样间隔的带噪声轨迹，
+分阶段计时（轨迹压缩、 候选点搜索、 路径搜索、 动态规划、 路径拼接、 输出）， 结果保存为json， 用于比较不同版本的代码。
+
+--check 用不同的匹配引擎、 修复方式、 路径搜索模式和后端匹配同一份数据，
+与最初的实现（graph引擎， 逐对dijkstra， 重新计算整条轨迹）比较匹配结果。
+同时给出--max-candidates / --dedup-distance（候选点剪枝）或--stationary-distance / --min-spacing（轨迹压缩）时，
+另外比较这些近似处理之后的匹配结果， 用于权衡速度和准确度。 --stops可以让车辆在路口随机停留， 产生静止的log。
+
+usage:
+
+python benchmark.py --network grid --size 30 --intervals 5,15,30,60 --json bench.json
+python benchmark.py --network radial --size 20 --check
+python benchmark.py --max-candidates 4 --dedup-distance 5 --check
+python benchmark.py --stops 0.3 --stationary-distance 20 --min-spacing 30 --check
+
+'''
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import traceback
+import subprocess
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+import fiona
+
+import config
+config.PERSISTENT_CACHE = False # 每次测试都从空缓存开始
+
+import core
+import get_od_path
+import get_dijkstra_distance
+from get_dijkstra_distance import get_connected_path, set_routing_backend
+from cache import clear_cache, get_cache_stats, reset_cache_stats
+from road_index import get_track_candidates
+from track_reader import iter_tracks
+from track_compress import compress_track, expand_match_points
+from output_writer import MatchWriter
+from ubodt import build_ubodt, check_ubodt, get_ubodt_path, get_ubodt_meta_path
+from ch import build_ch, check_ch, get_ch_path
+
+
+ROAD_SCHEMA = {
+    'properties': OrderedDict([
+        ('source', 'int'),
+        ('target', 'int'),
+        ('weight', 'float')
+    ]),
+    'geometry': 'LineString'
+}
+
+TRACK_SCHEMA = {
+    'properties': OrderedDict([
+        ('uuid', 'int'),
+        ('track_id', 'int'),
+        ('log_time', 'str'),
+        ('car_id', 'str'),
+        ('v', 'float')
+    ]),
+    'geometry': 'Point'
+}
+
+ORIGIN_X = 795000.0
+ORIGIN_Y = 2500000.0
+BEGIN_TIME = datetime(2016, 9, 1, 0, 0, 0)
+
+STAGES = ['compress', 'candidates', 'routing', 'viterbi', 'path', 'output']
+
+# (名称, 匹配引擎, 修复方式, 路径搜索模式, 后端)， 第一个为比较的基准
+VARIANTS = [
+    ('reference', 'graph', 'rebuild', 'one_to_one', 'dijkstra'),
+    ('graph_one_to_many', 'graph', 'rebuild', 'one_to_many', 'dijkstra'),
+    ('array_rebuild', 'array', 'rebuild', 'one_to_many', 'dijkstra'),
+    ('array_incremental', 'array', 'incremental', 'one_to_many', 'dijkstra'),
+    ('astar', 'array', 'incremental', 'one_to_many', 'astar'),
+    ('bidirectional', 'array', 'incremental', 'one_to_many', 'bidirectional'),
+    ('ubodt', 'array', 'incremental', 'one_to_many', 'ubodt'),
+    ('ch', 'array', 'incremental', 'one_to_many', 'ch'),
+]
+
+
+def get_length(coords):
+    return sum(math.hypot(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]))
+
+
+def write_road_shapefile(shp_path, roads):
+    '''
+    写入道路文件
+
+    Parameters:
+    -----------
+    roads : list
+        (source, target, coords)列表， weight为几何长度
+    '''
+    c = fiona.open(shp_path, 'w', driver='ESRI Shapefile', crs=config.crs, schema=ROAD_SCHEMA)
+    c.writerecords([{
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': coords},
+        'properties': OrderedDict([('source', source), ('target', target), ('weight', get_length(coords))])
+    } for source, target, coords in roads])
+    c.close()
+
+
+def get_grid_roads(size, spacing, rng):
+    '''
+    size * size的网格路网， 每条边为两条方向相反的道路， 中点随机偏移
+    '''
+    roads = []
+    for i in range(size):
+        for j in range(size):
+            for di, dj in ((0, 1), (1, 0)):
+                i2, j2 = i + di, j + dj
+                if i2 >= size or j2 >= size:
+                    continue
+                a = (ORIGIN_X + j * spacing, ORIGIN_Y + i * spacing)
+                b = (ORIGIN_X + j2 * spacing, ORIGIN_Y + i2 * spacing)
+                mid = ((a[0] + b[0]) / 2 + rng.uniform(-0.05, 0.05) * spacing, (a[1] + b[1]) / 2 + rng.uniform(-0.05, 0.05) * spacing)
+                u = i * size + j
+                v = i2 * size + j2
+                roads.append((u, v, [a, mid, b]))
+                roads.append((v, u, [b, mid, a]))
+    return roads
+
+
+def get_radial_roads(size, spacing, rng, spokes=16):
+    '''
+    size圈环路和spokes条放射路组成的路网， 环路上的道路用折线近似圆弧
+    '''
+    def get_coord(ring, angle):
+        return (ORIGIN_X + ring * spacing * math.cos(angle), ORIGIN_Y + ring * spacing * math.sin(angle))
+
+    def nid(ring, spoke):
+        return 0 if ring == 0 else 1 + (ring - 1) * spokes + spoke
+
+    roads = []
+    for ring in range(size):
+        for spoke in range(spokes):
+            angle = 2 * math.pi * spoke / spokes
+            # 放射路
+            a = get_coord(ring, angle)
+            b = get_coord(ring + 1, angle)
+            roads.append((nid(ring, spoke), nid(ring + 1, spoke), [a, b]))
+            roads.append((nid(ring + 1, spoke), nid(ring, spoke), [b, a]))
+            # 环路
+            next_angle = 2 * math.pi * (spoke + 1) / spokes
+            coords = [get_coord(ring + 1, angle + (next_angle - angle) * k / 4) for k in range(5)]
+            coords[2] = (coords[2][0] + rng.uniform(-0.02, 0.02) * spacing, coords[2][1] + rng.uniform(-0.02, 0.02) * spacing)
+            u = nid(ring + 1, spoke)
+            v = nid(ring + 1, (spoke + 1) % spokes)
+            roads.append((u, v, coords))
+            roads.append((v, u, coords[::-1]))
+    return roads
+
+
+def interpolate(coords, distance):
+    '''
+    折线上距离起点distance处的坐标
+    '''
+    for (x0, y0), (x1, y1) in zip(coords[:-1], coords[1:]):
+        length = math.hypot(x1 - x0, y1 - y0)
+        if distance <= length and length > 0:
+            return x0 + (x1 - x0) * distance / length, y0 + (y1 - y0) * distance / length
+        distance -= length
+    return coords[-1]
+
+
+def write_track_shapefile(shp_path, roads, track_count, interval, track_length, noise, rng, stops=0):
+    '''
+    在路网上随机行驶， 每interval秒采样一次， 加上高斯噪声
+
+    噪声向量的长度截断在3倍标准差和25米之内， 保证每个点在30米的搜索半径内都有候选道路。
+    每到达一个路口， 以stops的概率停留30到120秒。
+    '''
+    out_roads = {}
+    for road_idx, (source, _, _) in enumerate(roads):
+        out_roads.setdefault(source, []).append(road_idx)
+    road_lengths = [get_length(coords) for _, _, coords in roads]
+    max_noise = min(3 * noise, 25)
+
+    features = []
+    uuid = 0
+    for track_id in range(1, track_count + 1):
+        road_idx = rng.randrange(len(roads))
+        offset = rng.uniform(0, road_lengths[road_idx])
+        speed = rng.uniform(8, 15)
+        log_time = BEGIN_TIME + timedelta(minutes=track_id)
+        driven = 0
+        stop_time = 0
+        while driven <= track_length:
+            x, y = interpolate(roads[road_idx][2], offset)
+            dx = rng.gauss(0, noise)
+            dy = rng.gauss(0, noise)
+            # 分别截断x和y时偏移可达25 * sqrt(2)米， 截断向量的长度
+            noise_length = math.hypot(dx, dy)
+            if noise_length > max_noise:
+                dx *= max_noise / noise_length
+                dy *= max_noise / noise_length
+            uuid += 1
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': (x + dx, y + dy)},
+                'properties': OrderedDict([
+                    ('uuid', uuid),
+                    ('track_id', track_id),
+                    ('log_time', log_time.strftime('%Y-%m-%d %H:%M:%S')),
+                    ('car_id', 'C{}'.format(track_id)),
+                    ('v', speed)
+                ])
+            })
+
+            log_time += timedelta(seconds=interval)
+            if stop_time > 0:
+                stop_time -= interval
+                continue
+
+            # 行驶interval秒， 到达道路终点时随机选择下一条道路， 尽量不掉头
+            step = speed * interval
+            driven += step
+            offset += step
+            while offset > road_lengths[road_idx]:
+                offset -= road_lengths[road_idx]
+                source, target, _ = roads[road_idx]
+                next_roads = [idx for idx in out_roads[target] if roads[idx][1] != source] or out_roads[target]
+                road_idx = rng.choice(next_roads)
+                if stops > 0 and rng.random() < stops:
+                    stop_time = rng.uniform(30, 120)
+
+    c = fiona.open(shp_path, 'w', driver='ESRI Shapefile', crs=config.crs, schema=TRACK_SCHEMA)
+    c.writerecords(features)
+    c.close()
+    return len(features)
+
+
+def get_track_path(data_dir, interval):
+    return os.path.join(data_dir, 'track_{}s.shp'.format(interval))
+
+
+def generate(data_dir, network, size, spacing, intervals, track_count, track_length, noise, seed, stops=0):
+    '''
+    生成路网和每个采样间隔的轨迹
+
+    参数与data_dir中上次生成时相同时直接使用已有的数据（以及已生成的UBODT和收缩层次），
+    否则重新生成， 并删除由旧路网生成的UBODT和收缩层次。
+
+    Returns:
+    ---------
+    road_shp_path : str
+    '''
+    road_shp_path = os.path.join(data_dir, 'connected_road.shp')
+    params = OrderedDict([
+        ('network', network), ('size', size), ('spacing', spacing), ('intervals', intervals), ('tracks', track_count),
+        ('track_length', track_length), ('noise', noise), ('seed', seed)
+    ])
+    if stops > 0:
+        params['stops'] = stops
+    params_path = os.path.join(data_dir, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return road_shp_path
+
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    ubodt_path = get_ubodt_path(road_shp_path)
+    for path in list(ubodt_path) + [get_ubodt_meta_path(ubodt_path[0]), get_ch_path(road_shp_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    rng = random.Random(seed)
+    if network == 'grid':
+        roads = get_grid_roads(size, spacing, rng)
+    else:
+        roads = get_radial_roads(size, spacing, rng)
+    write_road_shapefile(road_shp_path, roads)
+    print('generate {} roads'.format(len(roads)))
+    for interval in intervals:
+        log_count = write_track_shapefile(get_track_path(data_dir, interval), roads, track_count, interval, track_length, noise, random.Random(seed + interval), stops)
+        print('generate {} logs with interval {}s'.format(log_count, interval))
+    with open(params_path, 'w') as f:
+        json.dump(params, f)
+    return road_shp_path
+
+
+def use_road_network(road_shp_path):
+    '''
+    让匹配使用road_shp_path中的路网
+    '''
+    get_od_path.ROAD_SHP_PATH = road_shp_path
+    get_od_path.ROAD_NETWORK = None
+    get_od_path.ROAD_INDEX = None
+    get_dijkstra_distance.ROAD_SHP_PATH = road_shp_path
+    get_dijkstra_distance.ROAD_GRAPH = None
+    get_dijkstra_distance.ROAD_FINGERPRINT = None
+    get_od_path.init_matcher()
+
+
+def use_variant(match_engine, repair_mode, routing_mode, backend):
+    '''
+    切换匹配引擎、 修复方式、 路径搜索模式和后端， 并清空缓存
+    '''
+    core.MATCH_ENGINE = match_engine
+    core.REPAIR_MODE = repair_mode
+    core.ROUTING_MODE = routing_mode
+    ubodt_path = get_ubodt_path(get_dijkstra_distance.ROAD_SHP_PATH)
+    if backend == 'ubodt' and check_ubodt(*ubodt_path, get_dijkstra_distance.get_road_fingerprint(), get_dijkstra_distance.MAX_DIS) is not None:
+        build_ubodt(get_dijkstra_distance.ROAD_GRAPH, *ubodt_path, delta=get_dijkstra_distance.MAX_DIS, fingerprint=get_dijkstra_distance.get_road_fingerprint())
+    ch_path = get_ch_path(get_dijkstra_distance.ROAD_SHP_PATH)
+    if backend == 'ch' and check_ch(ch_path, get_dijkstra_distance.get_road_fingerprint()) is not None:
+        build_ch(get_dijkstra_distance.ROAD_GRAPH, ch_path, get_dijkstra_distance.get_road_fingerprint())
+    set_routing_backend(backend)
+    clear_cache()
+
+
+def run_stages(track_path, output_path):
+    '''
+    分阶段匹配一个轨迹文件
+
+    路径搜索阶段预先计算相邻两层候选点之间的转移概率（结果进入缓存），
+    动态规划阶段的match_until_connect因此主要是动态规划和断裂修复的时间。
+
+    Returns:
+    ---------
+    result : dict
+    '''
+    clear_cache()
+    reset_cache_stats()
+    stage_times = OrderedDict((stage, 0.0) for stage in STAGES)
+    track_count = 0
+    log_count = 0
+    matched_count = 0
+
+    writer_begin_tick = time.time()
+    writer = MatchWriter(output_path, get_od_path.ROAD_NETWORK, config.OUTPUT_DRIVER, config.crs, True)
+    stage_times['output'] += time.time() - writer_begin_tick
+
+    candidate_count = 0
+    layer_count = 0
+    begin_tick = time.time()
+    for track_id, logs in iter_tracks(track_path, True):
+        track_count += 1
+        log_count += len(logs)
+
+        tick = time.time()
+        kept_logs, removed = compress_track(logs, config.COMPRESS_STATIONARY_DISTANCE, config.COMPRESS_STATIONARY_TIME, config.COMPRESS_MIN_SPACING)
+        stage_times['compress'] += time.time() - tick
+        layer_count += len(kept_logs)
+
+        tick = time.time()
+        candidates = get_track_candidates(kept_logs, get_od_path.ROAD_INDEX)
+        stage_times['candidates'] += time.time() - tick
+        candidate_count += len(candidates)
+
+        tick = time.time()
+        log_id_list = get_od_path.get_match_log_ids(kept_logs, candidates)
+        if len(log_id_list) == 0:
+            continue
+        for pre_log_id, log_id in zip(log_id_list[:-1], log_id_list[1:]):
+            core.get_candidate_transimission(candidates, pre_log_id, log_id)
+        stage_times['routing'] += time.time() - tick
+
+        tick = time.time()
+        match_point_list = core.match_until_connect(log_id_list, candidates)
+        stage_times['viterbi'] += time.time() - tick
+        if match_point_list is None:
+            continue
+
+        tick = time.time()
+        connected_vertex_path, connected_road_path = get_connected_path(match_point_list)
+        stage_times['path'] += time.time() - tick
+        if connected_road_path is None:
+            continue
+        matched_count += 1
+
+        tick = time.time()
+        match_point_list = expand_match_points(match_point_list, removed, get_od_path.ROAD_INDEX)
+        stage_times['compress'] += time.time() - tick
+
+        tick = time.time()
+        writer.write(track_id, connected_road_path, match_point_list)
+        stage_times['output'] += time.time() - tick
+
+    tick = time.time()
+    writer.close()
+    stage_times['output'] += time.time() - tick
+
+    return OrderedDict([
+        ('tracks', track_count),
+        ('logs', log_count),
+        ('matched_tracks', matched_count),
+        ('layers', layer_count),
+        ('candidates_per_log', candidate_count / max(layer_count, 1)),
+        ('stages', stage_times),
+        ('total', time.time() - begin_tick),
+        ('logs_per_second', log_count / max(time.time() - begin_tick, 1e-9)),
+        ('cache', get_cache_stats())
+    ])
+
+
+def match_all(track_path):
+    '''
+    匹配一个轨迹文件， 返回track_id -> (匹配点, 经过的道路)
+    '''
+    result = OrderedDict()
+    for track_id, logs in iter_tracks(track_path, True):
+        kept_logs, removed = compress_track(logs, config.COMPRESS_STATIONARY_DISTANCE, config.COMPRESS_STATIONARY_TIME, config.COMPRESS_MIN_SPACING)
+        candidates = get_track_candidates(kept_logs, get_od_path.ROAD_INDEX)
+        log_id_list = get_od_path.get_match_log_ids(kept_logs, candidates)
+        match_point_list = core.match_until_connect(log_id_list, candidates) if len(log_id_list) > 0 else None
+        if match_point_list is None:
+            result[track_id] = (None, None)
+            continue
+        _, connected_road_path = get_connected_path(match_point_list)
+        match_point_list = expand_match_points(match_point_list, removed, get_od_path.ROAD_INDEX)
+        result[track_id] = ([(p.log_id, p.road_id, p.fraction) for p in match_point_list], connected_road_path)
+    return result
+
+
+def get_approximation():
+    '''
+    当前的候选点剪枝和轨迹压缩设置
+    '''
+    return (config.CANDIDATE_MAX_COUNT, config.CANDIDATE_DEDUP_DISTANCE, config.COMPRESS_STATIONARY_DISTANCE, config.COMPRESS_STATIONARY_TIME, config.COMPRESS_MIN_SPACING)
+
+
+def set_approximation(max_count=None, dedup_distance=0, stationary_distance=0, stationary_time=60, min_spacing=0):
+    config.CANDIDATE_MAX_COUNT = max_count
+    config.CANDIDATE_DEDUP_DISTANCE = dedup_distance
+    config.COMPRESS_STATIONARY_DISTANCE = stationary_distance
+    config.COMPRESS_STATIONARY_TIME = stationary_time
+    config.COMPRESS_MIN_SPACING = min_spacing
+
+
+def is_approximate():
+    max_count, dedup_distance, stationary_distance, _, min_spacing = get_approximation()
+    return max_count is not None or dedup_distance > 0 or stationary_distance > 0 or min_spacing > 0
+
+
+def check(data_dir, intervals, variant_names=None):
+    '''
+    比较各种实现与基准实现的匹配结果
+
+    各种实现都不剪枝候选点、 不压缩轨迹； config中设置了剪枝或压缩时， 最后用默认的实现再匹配一次，
+    结果记为'approximate'， 同时输出经过的道路不同的轨迹数和匹配到不同道路的log的比例。
+
+    Returns:
+    ---------
+    report : dict
+        变体名 -> 结果不同的轨迹数， 运行出错时为None
+    '''
+    reference = None
+    report = OrderedDict()
+    default_variant = (core.MATCH_ENGINE, core.REPAIR_MODE, core.ROUTING_MODE, config.ROUTING_BACKEND)
+    approximation = get_approximation()
+    set_approximation()
+    for name, match_engine, repair_mode, routing_mode, backend in VARIANTS:
+        if reference is not None and variant_names is not None and name not in variant_names:
+            continue
+        use_variant(match_engine, repair_mode, routing_mode, backend)
+        begin_tick = time.time()
+        try:
+            result = dict((interval, match_all(get_track_path(data_dir, interval))) for interval in intervals)
+        except Exception as e:
+            # 出错的实现记为失败（--check以非0状态退出）， 基准实现出错时由下一个能运行的实现作为基准
+            traceback.print_exc()
+            report[name] = None
+            print('{:<20} failed: {!r}'.format(name, e))
+            continue
+        elapse = time.time() - begin_tick
+        if reference is None:
+            reference = result
+            print('{:<20} {:>8.3f}s'.format(name, elapse))
+            continue
+        diff_count = 0
+        for interval in intervals:
+            for track_id, match in reference[interval].items():
+                if result[interval][track_id] != match:
+                    diff_count += 1
+                    print('  {} differs on track {} (interval {}s)'.format(name, track_id, interval))
+        report[name] = diff_count
+        print('{:<20} {:>8.3f}s  different tracks: {}'.format(name, elapse, diff_count))
+    use_variant(*default_variant)
+    set_approximation(*approximation)
+
+    if is_approximate() and reference is not None:
+        begin_tick = time.time()
+        result = dict((interval, match_all(get_track_path(data_dir, interval))) for interval in intervals)
+        elapse = time.time() - begin_tick
+        diff_count = 0
+        diff_path_count = 0
+        log_count = 0
+        diff_log_count = 0
+        for interval in intervals:
+            for track_id, match in reference[interval].items():
+                approximate_match = result[interval][track_id]
+                diff_count += int(approximate_match != match)
+                diff_path_count += int(approximate_match[1] != match[1])
+                # 两次都匹配成功的轨迹， 比较每个log匹配到的道路
+                if match[0] is not None and approximate_match[0] is not None:
+                    approximate_roads = dict((log_id, road_id) for log_id, road_id, _ in approximate_match[0])
+                    for log_id, road_id, _ in match[0]:
+                        log_count += 1
+                        diff_log_count += int(approximate_roads.get(log_id) != road_id)
+        report['approximate'] = diff_count
+        print('{:<20} {:>8.3f}s  different tracks: {}  different paths: {}  different logs: {}/{}'.format(
+            'approximate', elapse, diff_count, diff_path_count, diff_log_count, log_count
+        ))
+    return report
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='map match benchmark')
+    parser.add_argument('--data-dir', default='./benchmark_data', help='directory of the generated network and tracks')
+    parser.add_argument('--network', choices=['grid', 'radial'], default='grid')
+    parser.add_argument('--size', type=int, default=30, help='grid rows and columns, or rings of the radial network')
+    parser.add_argument('--spacing', type=float, default=200, help='distance between neighbouring nodes')
+    parser.add_argument('--intervals', default='5,15,30,60', help='sampling intervals in seconds')
+    parser.add_argument('--tracks', type=int, default=20, help='tracks per sampling interval')
+    parser.add_argument('--track-length', type=float, default=8000, help='driven distance of every track')
+    parser.add_argument('--noise', type=float, default=8, help='standard deviation of the gps noise')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--backend', choices=['dijkstra', 'astar', 'bidirectional', 'ubodt', 'ch'], help='routing backend, default is config.ROUTING_BACKEND')
+    parser.add_argument('--json', help='save the result to this json file')
+    parser.add_argument('--check', action='store_true', help='compare the matches of all engines with the reference implementation')
+    parser.add_argument('--max-candidates', type=int, default=config.CANDIDATE_MAX_COUNT, help='keep at most this many candidates per log')
+    parser.add_argument('--dedup-distance', type=float, default=config.CANDIDATE_DEDUP_DISTANCE, help='merge candidates on connected roads closer than this')
+    parser.add_argument('--stationary-distance', type=float, default=config.COMPRESS_STATIONARY_DISTANCE, help='drop logs this close to the previous kept log as stationary')
+    parser.add_argument('--stationary-time', type=float, default=config.COMPRESS_STATIONARY_TIME, help='longest time a stationary log may follow the previous kept log')
+    parser.add_argument('--min-spacing', type=float, default=config.COMPRESS_MIN_SPACING, help='drop logs closer than this to the previous kept log')
+    parser.add_argument('--stops', type=float, default=0, help='probability that a generated vehicle stops at an intersection')
+    args = parser.parse_args()
+    set_approximation(args.max_candidates, args.dedup_distance, args.stationary_distance, args.stationary_time, args.min_spacing)
+
+    intervals = [int(interval) for interval in args.intervals.split(',')]
+    road_shp_path = generate(
+        args.data_dir, args.network, args.size, args.spacing, intervals, args.tracks, args.track_length, args.noise, args.seed, args.stops
+    )
+    use_road_network(road_shp_path)
+
+    if args.check:
+        report = check(args.data_dir, intervals)
+        # 剪枝和压缩本来就可能改变匹配结果， 不作为失败
+        sys.exit(1 if any(value is None or value > 0 for name, value in report.items() if name != 'approximate') else 0)
+
+    if args.backend is not None:
+        set_routing_backend(args.backend)
+
+    results = []
+    for interval in intervals:
+        result = run_stages(get_track_path(args.data_dir, interval), os.path.join(args.data_dir, 'match_{}s.gpkg'.format(interval)))
+        result['interval'] = interval
+        results.append(result)
+        print('interval {:>3}s  logs {:>6}  layers {:>6}  candidates/log {:>5.2f}  total {:>8.3f}s  '.format(interval, result['logs'], result['layers'], result['candidates_per_log'], result['total']) + '  '.join(
+            '{} {:.3f}s'.format(stage, result['stages'][stage]) for stage in STAGES
+        ))
+
+    report = OrderedDict([
+        ('commit', get_commit()),
+        ('time', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ('python', platform.python_version()),
+        ('args', vars(args)),
+        ('config', OrderedDict([
+            ('MATCH_ENGINE', core.MATCH_ENGINE),
+            ('REPAIR_MODE', core.REPAIR_MODE),
+            ('ROUTING_MODE', core.ROUTING_MODE),
+            ('ROUTING_BACKEND', config.ROUTING_BACKEND),
+            ('CANDIDATE_RADIUS', config.CANDIDATE_RADIUS),
+            ('CANDIDATE_MAX_COUNT', config.CANDIDATE_MAX_COUNT),
+            ('CANDIDATE_DEDUP_DISTANCE', config.CANDIDATE_DEDUP_DISTANCE),
+            ('COMPRESS_STATIONARY_DISTANCE', config.COMPRESS_STATIONARY_DISTANCE),
+            ('COMPRESS_STATIONARY_TIME', config.COMPRESS_STATIONARY_TIME),
+            ('COMPRESS_MIN_SPACING', config.COMPRESS_MIN_SPACING)
+        ])),
+        ('network', OrderedDict([('roads', len(get_od_path.ROAD_NETWORK.road_ids)), ('nodes', len(get_dijkstra_distance.ROAD_GRAPH.node_ids))])),
+        ('results', results)
+    ])
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,33 +1,339 @@
 '''
 
-缓存计算好的dijkstra距离和路径
+缓存计算好的dijkstra距离
+
+只保存距离和是否可达， 不保存路径: 动态规划需要每对候选点的距离， 而路径只有最终匹配序列中相邻的点对才需要，
+由get_dijkstra_distance.get_connected_path在匹配结束后重新搜索得到。
+
+键为起点和终点的唯一标识（get_unique_id， 都在int64范围内）打包成的一个128位整数， 不会冲突，
+占用44字节， 比(source, target)元组（元组56字节加两个整数各36字节）小，
+缓存按最近最少使用（LRU）淘汰， 容量由config.CACHE_MAX_ENTRIES和config.CACHE_MAX_BYTES限制。
+
+每条记录同时保存计算时使用的cutoff:
+找到路径的记录对不小于其距离的cutoff都有效， 不可达的记录只对不大于计算时cutoff的查询有效，
+因此不同轨迹（cutoff不同）可以安全地共享缓存， 见config.CACHE_SCOPE。
+
+config.PERSISTENT_CACHE为True时， 内存中没有的记录再到道路shp文件旁边的SQLite文件中查找，
+新计算的记录批量写入这个文件， 供之后的运行复用。 文件记录了路网的指纹， 路网改变后自动清空。
+SQLite使用WAL模式， 多个匹配进程可以同时读， 写操作依次进行。
 
 '''
+import os
+import sys
+import math
+import atexit
+import sqlite3
+import hashlib
+from collections import OrderedDict
+
+import config
 
 print('load cache')
 
-DISTANCE_CACHE = {}
+FRACTION_SCALE = 10000000 # fraction量化的精度
+ID_STRIDE = FRACTION_SCALE + 1 # fraction的量化值在[0, FRACTION_SCALE]之间
+KEY_SHIFT = 64
+MAX_UNIQUE_ID = (1 << 63) - 1 # 唯一标识的上限， 与SQLite的INTEGER相同
+
+DISTANCE_CACHE = OrderedDict() # key -> (distance, is_reachable, cutoff)
+CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'disk_hits': 0, 'disk_writes': 0}
+
+PERSISTENT_CACHE_PATH = None # SQLite文件路径， 为None时不使用持久化缓存
+PERSISTENT_CACHE_FINGERPRINT = None
+PERSISTENT_CONNECTION = None
+PERSISTENT_CONNECTION_PID = None # 创建连接的进程， fork出的子进程需要重新连接
+FORKED_CONNECTIONS = [] # 从父进程继承的连接， 不能在子进程中关闭， 只保留引用
+PENDING_ROWS = [] # 尚未写入SQLite的记录
+PERSISTENT_CACHE_VERSION = 2 # 表结构的版本， 与文件中记录的不同时重建表
+
+DISTANCE_REL_TOL = 1e-9 # 不同后端对同一路径的距离按不同顺序累加， 只在最后几位不同
+
+
+
+def get_key(source, target):
+    return (source << KEY_SHIFT) | target
 
-def get_distance_from_cache(source, target):
+
+def get_entry_bytes():
     '''
-    将距离和路径保存到缓冲中
+    用sys.getsizeof估计缓存中一条记录的内存占用
+
+    包括最大的键、 记录元组和其中的两个float（is_reachable为共享的bool）、
+    以及OrderedDict中每条记录的哈希表槽位和链表节点（按刚扩容后最稀疏时的平均值）。
+    CPython 3.11上约为270字节， tracemalloc测得的平均值约为260字节。
     '''
-    if (source, target) in DISTANCE_CACHE:
-        return DISTANCE_CACHE[(source, target)]
-    else:
-        return None
+    key_bytes = sys.getsizeof(get_key(MAX_UNIQUE_ID, MAX_UNIQUE_ID))
+    entry_bytes = sys.getsizeof((0.5, True, 0.5)) + 2 * sys.getsizeof(0.5)
+    sample_size = (1 << 13) // 3 + 1 # 哈希表超过2/3满时扩容， 这个大小刚好扩容
+    table_bytes = sys.getsizeof(OrderedDict.fromkeys(range(sample_size))) / sample_size
+    return int(math.ceil(key_bytes + entry_bytes + table_bytes))
+
+
+ENTRY_BYTES = get_entry_bytes() # 一条记录的估计内存占用， 用于config.CACHE_MAX_BYTES
+
+
+def get_cache_bytes():
+    '''
+    缓存的估计内存占用
+    '''
+    return ENTRY_BYTES * len(DISTANCE_CACHE)
+
+
+def is_valid(entry, cutoff):
+    '''
+    记录对cutoff的查询是否有效
+    '''
+    distance, is_reachable, entry_cutoff = entry
+    if cutoff is None:
+        return True
+    if is_reachable:
+        return distance <= cutoff
+    return cutoff <= entry_cutoff
+
+
+def get_distance_from_cache(source, target, cutoff=None):
+    '''
+    从缓冲中获得距离
+
+    Parameters:
+    -----------
+    source, target : int
+        get_unique_id得到的起点和终点标识
+    cutoff : float
+        查询使用的cutoff， 为None时不检查记录是否对这个cutoff有效
+
+    Returns:
+    ---------
+    distance : float
+        没有有效的记录时为None
+    '''
+    key = get_key(source, target)
+    entry = DISTANCE_CACHE.get(key)
+    if entry is not None and is_valid(entry, cutoff):
+        DISTANCE_CACHE.move_to_end(key)
+        CACHE_STATS['hits'] += 1
+        return entry[0]
+
+    if PERSISTENT_CACHE_PATH is not None:
+        entry = read_persistent_entry(source, target)
+        if entry is not None and is_valid(entry, cutoff):
+            put_entry(key, entry)
+            CACHE_STATS['disk_hits'] += 1
+            return entry[0]
+
+    CACHE_STATS['misses'] += 1
+    return None
+
 
-def save_distance_to_cache(source, target, distance, vertex_path, road_path):
+def save_distance_to_cache(source, target, distance, is_reachable, cutoff=float('inf')):
     '''
-    从缓冲中获得距离和路径
+    将距离保存到缓冲中， 超过容量时淘汰最久没有使用的记录
+
+    Parameters:
+    -----------
+    is_reachable : bool
+        在cutoff内是否可达， 不可达时distance为MAX_DIS
+    cutoff : float
+        计算时使用的cutoff， 与cutoff无关的结果（如同一道路上的逆行）为inf
+    '''
+    key = get_key(source, target)
+    entry = DISTANCE_CACHE.get(key)
+    if entry is not None and entry[1] and is_reachable:
+        assert(math.isclose(entry[0], distance, rel_tol=DISTANCE_REL_TOL))
+    put_entry(key, (distance, is_reachable, cutoff))
+
+    if PERSISTENT_CACHE_PATH is not None:
+        PENDING_ROWS.append((source, target, distance, cutoff, int(is_reachable)))
+        if len(PENDING_ROWS) >= config.PERSISTENT_CACHE_BATCH:
+            flush_cache()
+
+
+def put_entry(key, entry):
+    '''
+    把记录放入内存缓存， 超过容量时淘汰最久没有使用的记录
     '''
-    if (source, target) in DISTANCE_CACHE:
-        assert(get_distance_from_cache(source, target)[0] == distance)
+    DISTANCE_CACHE.pop(key, None)
+    DISTANCE_CACHE[key] = entry
+
+    max_entries = len(DISTANCE_CACHE)
+    if config.CACHE_MAX_ENTRIES is not None:
+        max_entries = min(max_entries, config.CACHE_MAX_ENTRIES)
+    if config.CACHE_MAX_BYTES is not None:
+        max_entries = min(max_entries, config.CACHE_MAX_BYTES // ENTRY_BYTES)
+    while len(DISTANCE_CACHE) > max(max_entries, 1):
+        DISTANCE_CACHE.popitem(last=False)
+        CACHE_STATS['evictions'] += 1
+
 
-    DISTANCE_CACHE[(source, target)] = (distance, vertex_path, road_path)
 def clear_cache():
-    DISTANCE_CACHE = {}
+    '''
+    清空内存缓存， 统计数据和持久化缓存保留
+    '''
+    flush_cache()
+    DISTANCE_CACHE.clear()
+
+
+def get_cache_stats():
+    '''
+    缓存的命中、 未命中、 淘汰次数和当前大小
+    '''
+    stats = dict(CACHE_STATS)
+    stats['entries'] = len(DISTANCE_CACHE)
+    stats['bytes'] = get_cache_bytes()
+    return stats
+
+
+def reset_cache_stats():
+    for name in CACHE_STATS:
+        CACHE_STATS[name] = 0
 
 
 def get_unique_id(road_id, fraction):
-    return str(road_id) + '_' + str(int(fraction * 10000000))
\ No newline at end of file
+    '''
+    道路和fraction打包成的整数， fraction量化到1e-7
+
+    道路id需要小于MAX_UNIQUE_ID // ID_STRIDE（约9.2e11）， 使标识在int64范围内， 键不会冲突
+    '''
+    unique_id = road_id * ID_STRIDE + int(fraction * FRACTION_SCALE)
+    assert(0 <= unique_id <= MAX_UNIQUE_ID)
+    return unique_id
+
+
+def get_shapefile_fingerprint(shp_path):
+    '''
+    道路shp文件（及同名的shx、 dbf文件）内容的sha1
+    '''
+    sha1 = hashlib.sha1()
+    base_path = os.path.splitext(shp_path)[0]
+    for ext in ['.shp', '.shx', '.dbf']:
+        path = base_path + ext
+        if not os.path.exists(path):
+            continue
+        sha1.update(ext.encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_persistent_cache_path(shp_path):
+    '''
+    持久化缓存文件与道路shp文件放在同一目录下
+    '''
+    return os.path.splitext(shp_path)[0] + '.cache.sqlite'
+
+
+def init_persistent_cache(path, fingerprint):
+    '''
+    打开持久化缓存
+
+    Parameters:
+    -----------
+    path : str
+        SQLite文件路径
+    fingerprint : str
+        路网（以及影响距离的参数）的指纹， 与文件中记录的不同时清空文件
+    '''
+    global PERSISTENT_CACHE_PATH, PERSISTENT_CACHE_FINGERPRINT
+    close_persistent_cache()
+    PERSISTENT_CACHE_PATH = path
+    PERSISTENT_CACHE_FINGERPRINT = fingerprint
+
+    connection = get_persistent_connection()
+    row = connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+    if row is None or row[0] != str(PERSISTENT_CACHE_VERSION):
+        # 旧版本的表结构不同， 重建
+        with connection:
+            connection.execute('DROP TABLE distance')
+            create_distance_table(connection)
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(PERSISTENT_CACHE_VERSION),))
+    row = connection.execute("SELECT value FROM meta WHERE name = 'fingerprint'").fetchone()
+    if row is None or row[0] != fingerprint:
+        with connection:
+            if row is not None:
+                print('road network changed, clear persistent cache')
+            connection.execute('DELETE FROM distance')
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+    close_persistent_connection() # 之后用到时再连接， 避免fork时带着打开的连接
+
+
+def get_persistent_connection():
+    '''
+    当前进程的SQLite连接， 连接不能跨fork使用， 子进程第一次使用时重新连接
+    '''
+    global PERSISTENT_CONNECTION, PERSISTENT_CONNECTION_PID
+    if PERSISTENT_CONNECTION is not None and PERSISTENT_CONNECTION_PID == os.getpid():
+        return PERSISTENT_CONNECTION
+
+    if PERSISTENT_CONNECTION is not None:
+        FORKED_CONNECTIONS.append(PERSISTENT_CONNECTION)
+        del PENDING_ROWS[:] # 父进程尚未写入的记录由父进程负责
+    connection = sqlite3.connect(PERSISTENT_CACHE_PATH, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        create_distance_table(connection)
+    PERSISTENT_CONNECTION = connection
+    PERSISTENT_CONNECTION_PID = os.getpid()
+    return connection
+
+
+def create_distance_table(connection):
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS distance ('
+        'source INTEGER, target INTEGER, distance REAL, cutoff REAL, reachable INTEGER, '
+        'PRIMARY KEY (source, target)) WITHOUT ROWID'
+    )
+
+
+def read_persistent_entry(source, target):
+    row = get_persistent_connection().execute(
+        'SELECT distance, reachable, cutoff FROM distance WHERE source = ? AND target = ?', (source, target)
+    ).fetchone()
+    if row is None:
+        return None
+    distance, reachable, cutoff = row
+    return distance, bool(reachable), cutoff
+
+
+def flush_cache():
+    '''
+    把新计算的记录写入持久化缓存
+
+    已有找到路径的记录不会被不可达的记录覆盖， 不可达的记录保留cutoff较大的一条。
+    '''
+    if PERSISTENT_CACHE_PATH is None or len(PENDING_ROWS) == 0:
+        return
+    connection = get_persistent_connection()
+    rows = list(PENDING_ROWS)
+    del PENDING_ROWS[:]
+    with connection:
+        connection.executemany(
+            'INSERT INTO distance VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (source, target) DO UPDATE SET '
+            'distance = excluded.distance, cutoff = excluded.cutoff, reachable = excluded.reachable '
+            'WHERE excluded.reachable OR (NOT distance.reachable AND excluded.cutoff > distance.cutoff)',
+            rows
+        )
+    CACHE_STATS['disk_writes'] += len(rows)
+
+
+def close_persistent_connection():
+    global PERSISTENT_CONNECTION, PERSISTENT_CONNECTION_PID
+    if PERSISTENT_CONNECTION is not None and PERSISTENT_CONNECTION_PID == os.getpid():
+        flush_cache()
+        PERSISTENT_CONNECTION.close()
+        PERSISTENT_CONNECTION = None
+        PERSISTENT_CONNECTION_PID = None
+
+
+def close_persistent_cache():
+    global PERSISTENT_CACHE_PATH
+    if PERSISTENT_CACHE_PATH is None:
+        return
+    close_persistent_connection()
+    PERSISTENT_CACHE_PATH = None
+
+
+atexit.register(close_persistent_cache)
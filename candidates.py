@@ -0,0 +1,225 @@
+'''
+
+一条轨迹所有候选点的列式存储
+
+每个候选点原来是一个14个字段的CPointRec， 其中log的坐标、 时间、 速度、 track_id和car_id在同一个log的每个候选点中重复，
+一批轨迹要创建几十万个这样的对象， 匹配和路径搜索时又逐个字段取出。
+这里每个log的字段只保存一次， 候选点只保存道路下标、 fraction和投影坐标等平铺的数组， 第i个log（第i层）的候选点为
+[offsets[i], offsets[i+1])。 观察概率、 转移概率直接在数组上计算， 路径搜索只使用5个字段的RoadPoint。
+
+CandidateStore.points是log_id -> CPointRec列表的只读字典视图， 访问某个log时才创建它的CPointRec， 供原来使用dict(list)的代码使用。
+反过来， CandidateStore.from_closest_points把原来的log_id -> CPointRec列表字典转为CandidateStore。
+
+usage:
+
+candidates = get_track_candidates(logs, road_index)
+candidates.get_count(log_id)
+candidates.get_road_points(log_id)
+candidates.get_point(log_id, 0)
+candidates.points[log_id]
+candidates = CandidateStore.from_closest_points(log_closest_points)
+
+'''
+from collections import namedtuple
+from collections.abc import Mapping
+
+import numpy as np
+
+from get_dijkstra_distance import CPointRec
+from track_reader import TrackRec
+
+
+# 路径搜索需要的候选点字段， 路径搜索的后端只使用这些字段
+RoadPoint = namedtuple('RoadPoint', ['road_id', 'source', 'target', 'weight', 'fraction'])
+
+# 没有RoadSegmentIndex时， 由候选点自身的道路属性代替， 每个候选点一条道路
+RoadAttributes = namedtuple('RoadAttributes', ['road_ids', 'road_sources', 'road_targets', 'road_weights'])
+
+
+class CandidateStore(object):
+    '''
+    一条轨迹所有候选点的列式存储
+
+    Parameters:
+    -----------
+    logs : list
+        TrackRec列表， 每个log一层， 包括没有候选点的log
+    offsets : np.ndarray
+        长度为len(logs) + 1， 第i个log的候选点为[offsets[i], offsets[i+1])
+    road_idx : np.ndarray
+        候选点所在道路在road_index中的下标
+    fraction, p_x, p_y : np.ndarray
+        候选点的fraction和投影坐标
+    road_index : RoadSegmentIndex或RoadAttributes
+        用于获得道路id, source, target, weight
+
+    Attributes:
+    -----------
+    log_ids : list
+        每层的log id
+    log_x, log_y : np.ndarray
+        每层的log坐标
+    log_times : np.ndarray
+        每层的log时间， datetime64[us]
+    road_ids, sources, targets, weights : np.ndarray
+        候选点所在道路的属性
+    points : CandidatePointView
+        log_id -> CPointRec列表的字典视图
+    '''
+
+    def __init__(self, logs, offsets, road_idx, fraction, p_x, p_y, road_index):
+        self.logs = logs
+        self.log_ids = [log.uuid for log in logs]
+        self.log_positions = dict((log_id, i) for i, log_id in enumerate(self.log_ids))
+        self.log_x = np.array([log.x for log in logs], dtype=np.float64)
+        self.log_y = np.array([log.y for log in logs], dtype=np.float64)
+        self.log_times = np.array([log.log_time for log in logs], dtype='datetime64[us]')
+
+        self.offsets = offsets
+        self.road_idx = road_idx
+        self.road_ids = road_index.road_ids[road_idx]
+        self.sources = road_index.road_sources[road_idx]
+        self.targets = road_index.road_targets[road_idx]
+        self.weights = road_index.road_weights[road_idx]
+        self.fraction = fraction
+        self.p_x = p_x
+        self.p_y = p_y
+
+        self.road_point_cache = {} # log_id -> RoadPoint列表
+        self.points = CandidatePointView(self)
+
+    @classmethod
+    def from_closest_points(cls, log_closest_points):
+        '''
+        由log_id -> CPointRec列表的字典构造， 与get_track_candidates的结果等价
+
+        没有候选点的log不包含在结果中， 与原来一样， 参与匹配的log必须有候选点。
+
+        Parameters:
+        -----------
+        log_closest_points : Mapping
+            log_id -> CPointRec列表
+        '''
+        logs = []
+        offsets = [0]
+        points = []
+        for closest_points in log_closest_points.values():
+            if len(closest_points) == 0:
+                continue
+            p = closest_points[0]
+            logs.append(TrackRec(p.log_x, p.log_y, p.log_id, p.track_id, p.log_time, p.car_id, p.v))
+            points.extend(closest_points)
+            offsets.append(len(points))
+
+        road_attributes = RoadAttributes(
+            np.array([p.road_id for p in points], dtype=np.int64),
+            np.array([p.source for p in points], dtype=np.int64),
+            np.array([p.target for p in points], dtype=np.int64),
+            np.array([p.weight for p in points], dtype=np.float64)
+        )
+        return cls(
+            logs,
+            np.array(offsets, dtype=np.int64),
+            np.arange(len(points)),
+            np.array([p.fraction for p in points], dtype=np.float64),
+            np.array([p.p_x for p in points], dtype=np.float64),
+            np.array([p.p_y for p in points], dtype=np.float64),
+            road_attributes
+        )
+
+    def __len__(self):
+        '''
+        候选点总数
+        '''
+        return len(self.road_idx)
+
+    def get_position(self, log_id):
+        '''
+        log所在的层
+        '''
+        return self.log_positions[log_id]
+
+    def get_slice(self, log_id):
+        '''
+        log的候选点在数组中的范围
+        '''
+        i = self.log_positions[log_id]
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def get_count(self, log_id):
+        '''
+        log的候选点数
+        '''
+        i = self.log_positions[log_id]
+        return int(self.offsets[i + 1] - self.offsets[i])
+
+    def get_road_points(self, log_id):
+        '''
+        log的候选点， 只包含路径搜索需要的字段
+
+        Returns:
+        ---------
+        road_points : list
+            RoadPoint列表， 与CPointRec同名字段的值相同
+        '''
+        road_points = self.road_point_cache.get(log_id)
+        if road_points is None:
+            s = self.get_slice(log_id)
+            road_points = [RoadPoint(*row) for row in zip(
+                self.road_ids[s].tolist(), self.sources[s].tolist(), self.targets[s].tolist(),
+                self.weights[s].tolist(), self.fraction[s].tolist()
+            )]
+            self.road_point_cache[log_id] = road_points
+        return road_points
+
+    def get_point(self, log_id, idx):
+        '''
+        log的第idx个候选点
+
+        Returns:
+        ---------
+        closest_point : CPointRec
+        '''
+        log = self.logs[self.log_positions[log_id]]
+        k = self.get_slice(log_id).start + idx
+        return CPointRec(
+            log.x,
+            log.y,
+            float(self.p_x[k]),
+            float(self.p_y[k]),
+            int(self.road_ids[k]),
+            log.uuid,
+            int(self.sources[k]),
+            int(self.targets[k]),
+            float(self.weights[k]),
+            float(self.fraction[k]),
+            log.v,
+            log.log_time,
+            log.track_id,
+            log.car_id
+        )
+
+
+class CandidatePointView(Mapping):
+    '''
+    CandidateStore的字典视图， log_id -> CPointRec列表， 与原来get_track_closest_points返回的字典相同
+
+    每个log的CPointRec在第一次访问时创建。
+    '''
+
+    def __init__(self, store):
+        self.store = store
+        self.point_cache = {}
+
+    def __getitem__(self, log_id):
+        closest_points = self.point_cache.get(log_id)
+        if closest_points is None:
+            closest_points = [self.store.get_point(log_id, idx) for idx in range(self.store.get_count(log_id))]
+            self.point_cache[log_id] = closest_points
+        return closest_points
+
+    def __iter__(self):
+        return iter(self.store.log_ids)
+
+    def __len__(self):
+        return len(self.store.log_ids)
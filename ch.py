@@ -0,0 +1,339 @@
+'''
+
+收缩层次（Contraction Hierarchy）
+
+预处理时按重要性依次收缩路网中的节点， 并在必要时添加shortcut，
+查询时从起点和终点分别只沿着向更高层次节点的边做双向搜索， 搜索的节点数远少于普通dijkstra。
+
+预处理结果保存在道路shp文件旁边， 每个路网版本只需要生成一次。 文件中记录了生成时路网的指纹， 路网改变后拒绝打开。
+
+usage:
+
+python ch.py ./shp/input/connected_road.shp
+
+'''
+import os
+import heapq
+import argparse
+
+import numpy as np
+
+from road_graph import RoadGraph
+from cache import get_shapefile_fingerprint
+import metrics
+
+
+CH_VERSION = 1 # 文件格式的版本， 改变后需要重新生成
+
+
+def get_ch_path(shp_path):
+    '''
+    收缩层次文件与道路shp文件放在同一目录下
+    '''
+    return os.path.splitext(shp_path)[0] + '.ch.npz'
+
+
+def check_ch(ch_path, fingerprint):
+    '''
+    检查收缩层次是否由指纹为fingerprint的路网生成
+
+    Returns:
+    ---------
+    error : str
+        不能使用的原因， 可以使用时为None
+    '''
+    if not os.path.exists(ch_path):
+        return 'contraction hierarchy not found: {}'.format(ch_path)
+    with np.load(ch_path) as data:
+        if 'version' not in data or int(data['version'][0]) != CH_VERSION:
+            return 'contraction hierarchy has no fingerprint or an old version: {}'.format(ch_path)
+        if str(data['fingerprint']) != fingerprint:
+            return 'contraction hierarchy was built from another road network: {}'.format(ch_path)
+    return None
+
+
+def to_csr(node_count, adj_list):
+    '''
+    把每个节点的(邻接节点, 权重, 边)列表转为CSR数组
+    '''
+    offsets = np.zeros(node_count + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(adj) for adj in adj_list])
+    targets = np.array([v for adj in adj_list for v, w, e in adj], dtype=np.int32)
+    weights = np.array([w for adj in adj_list for v, w, e in adj], dtype=np.float64)
+    edges = np.array([e for adj in adj_list for v, w, e in adj], dtype=np.int32)
+    return offsets, targets, weights, edges
+
+
+def build_ch(road_graph, ch_path, fingerprint, witness_settle_limit=500):
+    '''
+    构造收缩层次并保存
+
+    边的编号: 原始边沿用RoadGraph中的边下标， shortcut的编号从原始边数开始，
+    shortcut_children记录每个shortcut由哪两条边组成， 用于恢复路径。
+
+    Parameters:
+    -----------
+    road_graph : RoadGraph
+        路网图
+    fingerprint : str
+        道路shp文件的指纹， 见cache.get_shapefile_fingerprint
+    witness_settle_limit : int
+        witness搜索最多扩展的节点数， 超过后直接添加shortcut（结果仍然正确， 只是shortcut变多）
+    '''
+    node_count = len(road_graph.node_ids)
+    edge_count = len(road_graph.weights)
+
+    edge_weight = road_graph.weights.tolist()
+    shortcut_children = []
+
+    # 尚未收缩的节点之间的边， 同一对节点只保留权重最小的边
+    out_edges = [dict() for _ in range(node_count)]
+    in_edges = [dict() for _ in range(node_count)]
+    for edge_idx, (u, v) in enumerate(zip(road_graph.sources.tolist(), road_graph.targets.tolist())):
+        if u == v:
+            continue
+        if v not in out_edges[u] or edge_weight[edge_idx] < edge_weight[out_edges[u][v]]:
+            out_edges[u][v] = edge_idx
+            in_edges[v][u] = edge_idx
+
+    def witness_search(source, skip, max_dis):
+        dist = {source: 0}
+        settled = set()
+        heap = [(0, source)]
+        while heap and len(settled) < witness_settle_limit:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            if d > max_dis:
+                break
+            settled.add(u)
+            for v, edge_idx in out_edges[u].items():
+                if v == skip:
+                    continue
+                vu_dist = d + edge_weight[edge_idx]
+                if vu_dist < dist.get(v, float('inf')):
+                    dist[v] = vu_dist
+                    heapq.heappush(heap, (vu_dist, v))
+        return dist
+
+    def get_shortcuts(v):
+        shortcuts = []
+        if len(out_edges[v]) == 0:
+            return shortcuts
+        max_out = max(edge_weight[edge_idx] for edge_idx in out_edges[v].values())
+        for u, in_edge in in_edges[v].items():
+            in_weight = edge_weight[in_edge]
+            dist = witness_search(u, v, in_weight + max_out)
+            for w, out_edge in out_edges[v].items():
+                if w == u:
+                    continue
+                shortcut_weight = in_weight + edge_weight[out_edge]
+                if dist.get(w, float('inf')) > shortcut_weight:
+                    shortcuts.append((u, w, shortcut_weight, in_edge, out_edge))
+        return shortcuts
+
+    deleted_neighbors = [0] * node_count
+
+    def get_priority(v, shortcuts):
+        return len(shortcuts) - len(in_edges[v]) - len(out_edges[v]) + deleted_neighbors[v]
+
+    heap = [(get_priority(v, get_shortcuts(v)), v) for v in range(node_count)]
+    heapq.heapify(heap)
+
+    up_adj = [None] * node_count # v -> 更高层次的节点w, 边v->w
+    down_adj = [None] * node_count # v -> 更高层次的节点u, 边u->v
+    rank = np.zeros(node_count, dtype=np.int32)
+    contracted_count = 0
+    while heap:
+        _, v = heapq.heappop(heap)
+        shortcuts = get_shortcuts(v)
+        priority = get_priority(v, shortcuts)
+        if heap and priority > heap[0][0]:
+            heapq.heappush(heap, (priority, v))
+            continue
+
+        rank[v] = contracted_count
+        contracted_count += 1
+        if contracted_count % 1000 == 0:
+            print('contract {}/{}'.format(contracted_count, node_count))
+
+        for u, w, shortcut_weight, in_edge, out_edge in shortcuts:
+            if w in out_edges[u] and edge_weight[out_edges[u][w]] <= shortcut_weight:
+                continue
+            shortcut_idx = edge_count + len(shortcut_children)
+            shortcut_children.append((in_edge, out_edge))
+            edge_weight.append(shortcut_weight)
+            out_edges[u][w] = shortcut_idx
+            in_edges[w][u] = shortcut_idx
+
+        up_adj[v] = [(w, edge_weight[edge_idx], edge_idx) for w, edge_idx in out_edges[v].items()]
+        down_adj[v] = [(u, edge_weight[edge_idx], edge_idx) for u, edge_idx in in_edges[v].items()]
+        for w in out_edges[v]:
+            del in_edges[w][v]
+            deleted_neighbors[w] += 1
+        for u in in_edges[v]:
+            del out_edges[u][v]
+            deleted_neighbors[u] += 1
+        out_edges[v] = {}
+        in_edges[v] = {}
+
+    up_offsets, up_targets, up_weights, up_edges = to_csr(node_count, up_adj)
+    down_offsets, down_targets, down_weights, down_edges = to_csr(node_count, down_adj)
+    np.savez(
+        ch_path,
+        version=np.array([CH_VERSION]),
+        fingerprint=np.array(fingerprint),
+        rank=rank,
+        edge_count=np.array([edge_count]),
+        shortcut_children=np.array(shortcut_children, dtype=np.int32).reshape(-1, 2),
+        up_offsets=up_offsets, up_targets=up_targets, up_weights=up_weights, up_edges=up_edges,
+        down_offsets=down_offsets, down_targets=down_targets, down_weights=down_weights, down_edges=down_edges
+    )
+    print('shortcuts: {}'.format(len(shortcut_children)))
+
+
+def upward_search(offsets, targets, weights, edges, source_idx, source_dis, cutoff, other_dist=None):
+    '''
+    只沿向更高层次节点的边搜索
+
+    other_dist为另一方向的搜索结果时， 一旦当前距离不小于已找到的最短距离就停止。
+
+    Returns:
+    ---------
+    dist : dict
+        节点下标 -> 距离
+    pred : dict
+        节点下标 -> (前一个节点, 边)
+    (best_dis, meet_idx) : tuple
+        两个方向搜索相遇的最短距离和相遇节点， other_dist为None时为(inf, None)
+    '''
+    best_dis = float('inf')
+    meet_idx = None
+    dist = {}
+    seen = {source_idx: source_dis}
+    pred = {source_idx: None}
+    heap = []
+    if source_dis <= cutoff:
+        heap.append((source_dis, source_idx))
+    while heap:
+        d, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        if other_dist is not None and d >= best_dis:
+            break
+        dist[u] = d
+        if other_dist is not None and u in other_dist and d + other_dist[u] < best_dis:
+            best_dis = d + other_dist[u]
+            meet_idx = u
+        begin = offsets[u]
+        end = offsets[u + 1]
+        for v, weight, edge_idx in zip(targets[begin:end].tolist(), weights[begin:end].tolist(), edges[begin:end].tolist()):
+            vu_dist = d + weight
+            if vu_dist > cutoff:
+                continue
+            if v not in seen or vu_dist < seen[v]:
+                seen[v] = vu_dist
+                pred[v] = (u, edge_idx)
+                heapq.heappush(heap, (vu_dist, v))
+    if metrics.ENABLED:
+        metrics.count('nodes_settled', len(dist))
+    return dist, pred, (best_dis, meet_idx)
+
+
+class ContractionHierarchy(object):
+    '''
+    基于收缩层次的路径查询， 接口与RoadGraph.shortest_paths相同
+    '''
+
+    def __init__(self, road_graph, data):
+        assert(len(data['rank']) == len(road_graph.node_ids))
+        self.road_graph = road_graph
+        self.edge_count = int(data['edge_count'][0])
+        assert(self.edge_count == len(road_graph.weights))
+        self.shortcut_children = data['shortcut_children']
+        self.up = (data['up_offsets'], data['up_targets'], data['up_weights'], data['up_edges'])
+        self.down = (data['down_offsets'], data['down_targets'], data['down_weights'], data['down_edges'])
+
+    @classmethod
+    def load(cls, road_graph, ch_path, fingerprint):
+        '''
+        打开收缩层次， 不是由指纹为fingerprint的路网生成时抛出ValueError
+        '''
+        error = check_ch(ch_path, fingerprint)
+        if error is not None:
+            raise ValueError('{}, run python ch.py to rebuild it'.format(error))
+        # NpzFile的下标访问把数组读入内存， 构造后即可关闭文件
+        with np.load(ch_path) as data:
+            return cls(road_graph, data)
+
+    def unpack_edge(self, edge_idx):
+        '''
+        把shortcut展开为原始边列表
+        '''
+        edge_path = []
+        stack = [edge_idx]
+        while stack:
+            edge_idx = stack.pop()
+            if edge_idx < self.edge_count:
+                edge_path.append(edge_idx)
+            else:
+                first_edge, second_edge = self.shortcut_children[edge_idx - self.edge_count]
+                stack.append(int(second_edge))
+                stack.append(int(first_edge))
+        return edge_path
+
+    def get_pred(self, source_idx, forward_pred, backward_pred, meet_idx):
+        '''
+        由两个方向的搜索结果恢复原始边组成的路径， 格式与RoadGraph.search的pred相同
+        '''
+        edge_path = []
+        node_idx = meet_idx
+        while forward_pred[node_idx] is not None:
+            node_idx, edge_idx = forward_pred[node_idx]
+            edge_path = self.unpack_edge(edge_idx) + edge_path
+        node_idx = meet_idx
+        while backward_pred[node_idx] is not None:
+            node_idx, edge_idx = backward_pred[node_idx]
+            edge_path = edge_path + self.unpack_edge(edge_idx)
+
+        pred = {source_idx: None}
+        for edge_idx in edge_path:
+            pred[self.road_graph.targets[edge_idx]] = edge_idx
+        return pred
+
+    def shortest_paths(self, pre_closest_point, now_closest_points, cutoff, max_dis, with_path=True):
+        '''
+        获得一个候选点到多个候选点的最短路径， 见RoadGraph.shortest_paths
+
+        起点的向上搜索与终点无关， 只做一次， 每个终点只做一次向上的反向搜索。
+        '''
+        road_graph = self.road_graph
+        source_idx, source_dis, is_virtual_source = road_graph.get_search_source(pre_closest_point)
+        forward_dist, forward_pred, _ = upward_search(*self.up, source_idx, source_dis, cutoff)
+
+        result_list = []
+        for now_closest_point in now_closest_points:
+            target_idx, target_dis, is_virtual_target = road_graph.get_search_target(now_closest_point)
+            _, backward_pred, (dis, meet_idx) = upward_search(*self.down, target_idx, target_dis, cutoff, forward_dist)
+            if meet_idx is None or dis > cutoff:
+                result_list.append((max_dis, None, None))
+                continue
+            if not with_path:
+                result_list.append((dis, None, None))
+                continue
+            pred = self.get_pred(source_idx, forward_pred, backward_pred, meet_idx)
+            vertex_path, road_path = road_graph.get_path(pred, target_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target)
+            result_list.append((dis, vertex_path, road_path))
+        return result_list
+
+    def shortest_path(self, pre_closest_point, now_closest_point, cutoff, max_dis, with_path=True):
+        return self.shortest_paths(pre_closest_point, [now_closest_point], cutoff, max_dis, with_path)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build contraction hierarchy')
+    parser.add_argument('shp_path', nargs='?', default='./shp/input/connected_road.shp')
+    parser.add_argument('--witness-settle-limit', type=int, default=500)
+    args = parser.parse_args()
+
+    build_ch(RoadGraph.from_shapefile(args.shp_path), get_ch_path(args.shp_path), get_shapefile_fingerprint(args.shp_path), args.witness_settle_limit)
@@ -12,4 +12,84 @@ schema = {
             ]
         ), 
     'geometry': 'LineString'
-    }
\ No newline at end of file
+    }
+
+# 路径搜索模式
+# 'one_to_one' : 每对候选点做一次dijkstra搜索
+# 'one_to_many' : 每个前一层候选点做一次搜索， 得到到当前层所有候选点的距离
+ROUTING_MODE = 'one_to_many'
+
+# 路径查询后端
+# 'dijkstra' : 在路网图上做有界dijkstra搜索
+# 'ubodt' : 查询预先计算的UBODT（python ubodt.py 生成）
+# 'ch' : 在收缩层次上做双向搜索（python ch.py 生成）
+# 'astar' : 以直线距离为启发函数的A*搜索， 终点确定后立即停止
+# 'bidirectional' : 双向dijkstra搜索， 两个方向相遇后立即停止
+ROUTING_BACKEND = 'dijkstra'
+
+# 匹配引擎
+# 'array' : 每层的概率保存为numpy数组， 向量化地做动态规划
+# 'graph' : 把候选点保存在nx.Graph中的权重图
+MATCH_ENGINE = 'array'
+
+# 轨迹不连通时的修复方式（仅用于'array'匹配引擎）
+# 'incremental' : 删除断裂处的点后， 只重新计算受影响的转移概率和动态规划
+# 'rebuild' : 删除断裂处的点后， 重新计算整条轨迹
+REPAIR_MODE = 'incremental'
+
+# 距离缓存（cache.py）的容量， 超过后按最近最少使用淘汰， None表示不限制
+CACHE_MAX_ENTRIES = 1000000
+CACHE_MAX_BYTES = None # 按记录的估计内存占用限制
+
+# 距离缓存的共享范围
+# 'shared' : 所有轨迹共享缓存， 相邻轨迹经过相同道路时直接复用
+# 'track' : 每条轨迹开始匹配前清空缓存
+CACHE_SCOPE = 'shared'
+
+# 是否把距离缓存保存到道路shp文件旁边的SQLite文件（connected_road.cache.sqlite）， 供之后的运行复用
+PERSISTENT_CACHE = False
+PERSISTENT_CACHE_BATCH = 1000 # 新记录积累到多少条时写入一次
+
+# 是否把读取道路shp文件的结果保存为快照（connected_road.snapshot/）， 之后的运行直接打开快照
+ROAD_SNAPSHOT = True
+
+# 轨迹文件中同一轨迹的log是否连续（如按track_id排序）
+# True : 直接按顺序分组， False : 先分桶写入临时文件再分组， None : 读取前先检查
+TRACK_INPUT_SORTED = None
+
+# 候选点选择
+# 观察概率随投影距离单调递减， 剪枝按距离从近到远保留
+CANDIDATE_RADIUS = 30 # 搜索半径
+CANDIDATE_MAX_RADIUS = CANDIDATE_RADIUS # 半径内没有道路的log加倍半径重新搜索， 直到这个半径， 等于CANDIDATE_RADIUS时不重新搜索（如设为120）
+CANDIDATE_MAX_COUNT = None # 每个log最多保留的候选点数， None为不限制
+CANDIDATE_DEDUP_DISTANCE = 0 # 相连道路上投影点距离不超过这个值的候选点只保留一个， 0为不合并
+
+# 匹配前压缩轨迹， 见track_compress.py
+COMPRESS_STATIONARY_DISTANCE = 0 # 与上一个保留的log距离不超过这个值的log视为静止并删除， 0为不删除
+COMPRESS_STATIONARY_TIME = 60 # 静止的log与上一个保留的log的最大时间间隔（秒）
+COMPRESS_MIN_SPACING = 0 # 与上一个保留的log距离小于这个值的log视为过密并删除， 0为不删除
+
+# 匹配结果输出
+# 'GPKG' : path图层和point图层写在同一个GeoPackage文件中
+# 'ESRI Shapefile' : path写在OUTPUT_PATH， point写在同名加_point后缀的文件中
+OUTPUT_DRIVER = 'GPKG'
+OUTPUT_PATH = './shp/output/match.gpkg'
+WRITE_MATCH_POINTS = False # 是否输出每个gps log的匹配结果
+
+# 增量运行（result_store.py）: 保存每条轨迹的匹配结果， 轨迹的log、 路网和匹配参数都没有改变时直接使用保存的结果
+RESULT_STORE = False # get_od_path.py --incremental
+RESULT_STORE_PATH = './shp/output/match.results.sqlite'
+RESULT_STORE_BATCH = 100 # 新结果积累到多少条时提交一次， 中断后最多重新匹配这么多条轨迹
+
+# 是否记录各阶段耗时和计数（metrics.py）， 指定METRICS_PATH或METRICS_PROMETHEUS_PATH时自动开启
+METRICS = False
+METRICS_PATH = None # 每条轨迹一行的json lines文件， 最后一行为整次运行的汇总
+METRICS_PROMETHEUS_PATH = None # 整次运行的汇总， Prometheus文本格式
+
+# 匹配服务（match_service.py）
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 2 # 匹配进程数
+SERVICE_BATCH_SIZE = 8 # 每批最多合并的请求数
+SERVICE_BATCH_WAIT = 0.005 # 收到第一个请求后最多等待多少秒凑成一批
+SERVICE_QUEUE_SIZE = 1000 # 等待匹配的请求数上限， 超过时返回503
@@ -1,12 +1,18 @@
-from get_dijkstra_distance import get_dijkstra_distance, MAX_DIS
+from get_dijkstra_distance import get_dijkstra_distance, get_dijkstra_distances, MAX_DIS
 import networkx as nx
+import numpy as np
 
-import scipy.spatial as sp
-import scipy.stats as stats
+from config import ROUTING_MODE, MATCH_ENGINE, REPAIR_MODE
+from candidates import CandidateStore
+import metrics
 
 SMALL_PROBABILITY = 0.00000001
 BIG_PROBABILITY = 0.99999999
 
+OBSERVATION_SCALE = 30 # 观察概率正态分布的标准差
+MAX_SPEED = 33 # 计算最大可行驶距离的速度
+NORM_PDF_C = np.sqrt(2 * np.pi)
+
 
 def get_transimission_probability(pre_closest_point, closest_point):
     '''
@@ -24,13 +30,63 @@ def get_transimission_probability(pre_closest_point, closest_point):
     prob : float
         转移概率
     '''
-    # begin_tick = time.time()
-    max_distance = (closest_point.log_time - pre_closest_point.log_time).total_seconds() * 33
-    max_distance = max_distance if max_distance < MAX_DIS else MAX_DIS
+    if metrics.ENABLED:
+        metrics.count('transitions')
+    max_distance = get_max_distance(pre_closest_point, closest_point)
     dijkstra_distance = get_dijkstra_distance(pre_closest_point, closest_point, max_distance)
-    # print('get dijkstra distance elapse {}'.format(time.time() - begin_tick))
-    euclidean_distance = sp.distance.euclidean([pre_closest_point.log_x, pre_closest_point.log_y], [closest_point.log_x, closest_point.log_y])
+    euclidean_distance = np.hypot(closest_point.log_x - pre_closest_point.log_x, closest_point.log_y - pre_closest_point.log_y)
+
+    return get_probability_from_distance(dijkstra_distance, euclidean_distance)
+
+def get_transimission_probabilities(pre_closest_point, closest_points):
+    '''
+    得到一个点到下一层所有候选点的转移概率
+
+    同一层的候选点属于同一个log， 时间间隔相同， 所以只需要一次有界搜索。
+
+    Parameters:
+    -----------
+    pre_closest_point : CPointRec
+        前一个点
+    closest_points : list
+        当前层的候选点
+
+    Returns:
+    ---------
+    prob_list : list
+        转移概率列表
+    '''
+    if metrics.ENABLED:
+        metrics.count('transitions', len(closest_points))
+    max_distance = get_max_distance(pre_closest_point, closest_points[0])
+    dijkstra_distances = get_dijkstra_distances(pre_closest_point, closest_points, max_distance)
+    euclidean_distance = np.hypot(closest_points[0].log_x - pre_closest_point.log_x, closest_points[0].log_y - pre_closest_point.log_y)
+
+    return get_probabilities_from_distances(np.array(dijkstra_distances, dtype=np.float64), euclidean_distance).tolist()
+
+def get_max_distance(pre_closest_point, closest_point):
+    '''
+    两点间的最大可行驶距离， 作为dijkstra搜索的cutoff
+    '''
+    max_distance = (closest_point.log_time - pre_closest_point.log_time).total_seconds() * MAX_SPEED
+    return max_distance if max_distance < MAX_DIS else MAX_DIS
+
+
+def get_max_distances(elapses):
+    '''
+    批量计算最大可行驶距离， 与get_max_distance相同
+
+    Parameters:
+    -----------
+    elapses : np.ndarray
+        两点间的时间间隔（秒）
+    '''
+    return np.minimum(elapses * MAX_SPEED, MAX_DIS)
 
+def get_probability_from_distance(dijkstra_distance, euclidean_distance):
+    '''
+    由路网距离和欧氏距离得到转移概率
+    '''
     if dijkstra_distance == MAX_DIS:
         return SMALL_PROBABILITY
     if dijkstra_distance > euclidean_distance + 2000:
@@ -47,6 +103,28 @@ def get_transimission_probability(pre_closest_point, closest_point):
     
     return prob
 
+
+def get_probabilities_from_distances(dijkstra_distances, euclidean_distances):
+    '''
+    批量计算转移概率， 与对每个元素调用get_probability_from_distance相同
+
+    Parameters:
+    -----------
+    dijkstra_distances : np.ndarray
+        路网距离， 不可达为MAX_DIS
+    euclidean_distances : np.ndarray or float
+        欧氏距离， 形状可以广播到dijkstra_distances
+
+    Returns:
+    ---------
+    prob : np.ndarray
+        与dijkstra_distances形状相同
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob = np.clip(euclidean_distances / dijkstra_distances, SMALL_PROBABILITY, BIG_PROBABILITY)
+    prob = np.where(dijkstra_distances == 0, BIG_PROBABILITY, prob)
+    return np.where((dijkstra_distances == MAX_DIS) | (dijkstra_distances > euclidean_distances + 2000), SMALL_PROBABILITY, prob)
+
 def get_observation_probability(closest_point):
     '''
     得到观察概率
@@ -57,8 +135,22 @@ def get_observation_probability(closest_point):
         当前点
 
     '''
-    dis = sp.distance.euclidean([closest_point.log_x, closest_point.log_y], [closest_point.p_x, closest_point.p_y])
-    return stats.norm.pdf(dis, loc=0, scale=30)
+    return float(get_layer_observation([closest_point])[0])
+
+
+def get_observation_probabilities(log_x, log_y, p_x, p_y):
+    '''
+    批量计算观察概率， 即投影距离在正态分布N(0, OBSERVATION_SCALE)下的概率密度， 与scipy.stats.norm.pdf相同
+
+    Parameters:
+    -----------
+    log_x, log_y : np.ndarray
+        gps log坐标
+    p_x, p_y : np.ndarray
+        投影点坐标
+    '''
+    x = np.hypot(log_x - p_x, log_y - p_y) / OBSERVATION_SCALE
+    return np.exp(-x**2 / 2.0) / NORM_PDF_C / OBSERVATION_SCALE
 
 def construct_graph(log_list, log_closest_points):
     '''
@@ -84,12 +176,13 @@ def construct_graph(log_list, log_closest_points):
         assert(len(closest_points) > 0)
 
         now_layer = []
+        observation = get_layer_observation(closest_points)
 
         for closest_point_idx, closest_point in enumerate(closest_points):
             point_id = str(log_id) + '_' + str(closest_point_idx)
             now_layer.append(point_id)                
-            g.add_node(point_id, observation_probability=get_observation_probability(closest_point))
-            if len(pre_layer) == 0:
+            g.add_node(point_id, observation_probability=float(observation[closest_point_idx]))
+            if len(pre_layer) == 0 or ROUTING_MODE == 'one_to_many':
                 continue
             else:
                 for pre_point_id in pre_layer:
@@ -99,6 +192,15 @@ def construct_graph(log_list, log_closest_points):
                     pre_closest_point = log_closest_points[pre_log_id][pre_closest_point_idx]
                     transimission_probability = get_transimission_probability(pre_closest_point, closest_point)
                     g.add_edge(pre_point_id, point_id, transimission_probability=transimission_probability)
+
+        if len(pre_layer) != 0 and ROUTING_MODE == 'one_to_many':
+            # 每个前一层候选点只做一次搜索， 得到到当前层所有候选点的转移概率
+            for pre_point_id in pre_layer:
+                pre_log_id, pre_closest_point_idx = pre_point_id.split('_')
+                pre_closest_point = log_closest_points[int(pre_log_id)][int(pre_closest_point_idx)]
+                transimission_probabilities = get_transimission_probabilities(pre_closest_point, closest_points)
+                for point_id, transimission_probability in zip(now_layer, transimission_probabilities):
+                    g.add_edge(pre_point_id, point_id, transimission_probability=transimission_probability)
         pre_layer = now_layer
     return g
 
@@ -128,7 +230,7 @@ def find_match_sequence(g, log_list, log_closest_points):
     first_log_id = log_list[0]
     for closest_point_idx, closest_point in enumerate(log_closest_points[first_log_id]):
         point_id = str(first_log_id) + '_' + str(closest_point_idx)
-        f[point_id] = g.node[point_id]['observation_probability']
+        f[point_id] = g.nodes[point_id]['observation_probability']
 
     # 记录第二层到最后一层的权重
     pre_log_id = first_log_id
@@ -140,7 +242,7 @@ def find_match_sequence(g, log_list, log_closest_points):
             # 找到从前一次到当前层当前候选点的最大权重
             for pre_closest_point_idx, pre_closest_point in enumerate(log_closest_points[pre_log_id]):
                 pre_point_id = str(pre_log_id) + '_' + str(pre_closest_point_idx)
-                temp = g[pre_point_id][now_point_id]['transimission_probability'] * g.node[now_point_id]['observation_probability'] + f[pre_point_id]
+                temp = g[pre_point_id][now_point_id]['transimission_probability'] * g.nodes[now_point_id]['observation_probability'] + f[pre_point_id]
                 if temp > max_probability:
                     max_probability = temp
                     pre[now_point_id] = pre_point_id
@@ -195,27 +297,310 @@ def find_match_sequence(g, log_list, log_closest_points):
         return (False, match_point_list, break_idx)
 
 
-def match_until_connect(log_list, log_closest_points):
+def get_layer_coords(closest_points):
+    '''
+    一层候选点的坐标数组， 形状为(候选点数, 4)， 每行为log_x, log_y, p_x, p_y
+    '''
+    return np.array([(closest_point.log_x, closest_point.log_y, closest_point.p_x, closest_point.p_y) for closest_point in closest_points], dtype=np.float64)
+
+
+def get_layer_times(closest_points):
+    '''
+    一层候选点的log时间数组
+    '''
+    return np.array([closest_point.log_time for closest_point in closest_points], dtype='datetime64[us]')
+
+
+def get_layer_observation(closest_points):
+    '''
+    一层候选点的观察概率向量
+    '''
+    assert(len(closest_points) > 0)
+    coords = get_layer_coords(closest_points)
+    return get_observation_probabilities(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
+
+
+def get_layer_transimission(pre_closest_points, closest_points):
+    '''
+    相邻两层候选点之间的转移概率矩阵， 形状为(前一层候选点数, 当前层候选点数)
+
+    欧氏距离、 最大可行驶距离和由距离得到概率都在数组上批量计算， 只有路径搜索逐个候选点进行。
+    '''
+    if metrics.ENABLED:
+        metrics.count('transitions', len(pre_closest_points) * len(closest_points))
+    pre_coords = get_layer_coords(pre_closest_points)
+    coords = get_layer_coords(closest_points)
+    euclidean_distances = np.hypot(coords[None, :, 0] - pre_coords[:, None, 0], coords[None, :, 1] - pre_coords[:, None, 1])
+    elapses = (get_layer_times(closest_points)[None, :] - get_layer_times(pre_closest_points)[:, None]) / np.timedelta64(1, 's')
+    max_distances = get_max_distances(elapses).tolist()
+
+    return get_probabilities_from_distances(get_layer_distances(pre_closest_points, closest_points, max_distances), euclidean_distances)
+
+
+def get_layer_distances(pre_closest_points, closest_points, max_distances):
+    '''
+    相邻两层候选点之间的路网距离矩阵， 逐个候选点进行路径搜索
+
+    Parameters:
+    -----------
+    pre_closest_points, closest_points : list
+        CPointRec或RoadPoint列表
+    max_distances : list
+        max_distances[i][j]为前一层第i个候选点到当前层第j个候选点的搜索cutoff
+
+    Returns:
+    ---------
+    dijkstra_distances : np.ndarray
+        形状为(前一层候选点数, 当前层候选点数)， 不可达为MAX_DIS
+    '''
+    if ROUTING_MODE == 'one_to_many':
+        # 同一层的候选点属于同一个log， 每个前一层候选点只需要一次有界搜索
+        dijkstra_distances = [get_dijkstra_distances(pre_closest_point, closest_points, max_distances[i][0]) for i, pre_closest_point in enumerate(pre_closest_points)]
+    else:
+        dijkstra_distances = [
+            [get_dijkstra_distance(pre_closest_point, closest_point, max_distances[i][j]) for j, closest_point in enumerate(closest_points)]
+            for i, pre_closest_point in enumerate(pre_closest_points)
+        ]
+    return np.array(dijkstra_distances, dtype=np.float64)
+
+
+def get_candidate_observation(candidates, log_id):
+    '''
+    一层候选点的观察概率向量， 直接使用CandidateStore中的数组， 与get_layer_observation相同
+    '''
+    s = candidates.get_slice(log_id)
+    assert(s.stop > s.start)
+    i = candidates.get_position(log_id)
+    return get_observation_probabilities(candidates.log_x[i], candidates.log_y[i], candidates.p_x[s], candidates.p_y[s])
+
+
+def get_candidate_transimission(candidates, pre_log_id, log_id):
+    '''
+    相邻两层候选点之间的转移概率矩阵， 直接使用CandidateStore中的数组， 与get_layer_transimission相同
+
+    同一层的候选点共用log的坐标和时间， 欧氏距离和最大可行驶距离每两层只计算一次， 路径搜索使用RoadPoint。
+    '''
+    pre_road_points = candidates.get_road_points(pre_log_id)
+    road_points = candidates.get_road_points(log_id)
+    if metrics.ENABLED:
+        metrics.count('transitions', len(pre_road_points) * len(road_points))
+    pre_i = candidates.get_position(pre_log_id)
+    i = candidates.get_position(log_id)
+    euclidean_distance = np.hypot(candidates.log_x[i] - candidates.log_x[pre_i], candidates.log_y[i] - candidates.log_y[pre_i])
+    elapse = (candidates.log_times[i] - candidates.log_times[pre_i]) / np.timedelta64(1, 's')
+    max_distance = float(get_max_distances(elapse))
+
+    max_distances = [[max_distance] * len(road_points)] * len(pre_road_points)
+    return get_probabilities_from_distances(get_layer_distances(pre_road_points, road_points, max_distances), euclidean_distance)
+
+
+def construct_layers(log_list, candidates):
+    '''
+    构造每一层的观察概率向量和相邻两层之间的转移概率矩阵， 代替construct_graph中的权重图
+
+    Parameters:
+    ----------
+    log_list : list
+        组成track的log_id列表
+    candidates : CandidateStore
+        轨迹的候选点
+
+    Returns:
+    ---------
+    observation_list : list
+        第i个元素为第i层候选点的观察概率， 形状为(k_i,)
+    transimission_list : list
+        第i个元素为第i层到第i+1层的转移概率， 形状为(k_i, k_i+1)
+    '''
+    observation_list = [get_candidate_observation(candidates, log_id) for log_id in log_list]
+    transimission_list = []
+    for pre_log_id, log_id in zip(log_list[:-1], log_list[1:]):
+        transimission_list.append(get_candidate_transimission(candidates, pre_log_id, log_id))
+
+    return observation_list, transimission_list
+
+
+def forward_layer(f, observation, transimission):
+    '''
+    动态规划的一步
+
+    Parameters:
+    -----------
+    f : np.ndarray
+        从开头到前一层每个候选点的最大权重和
+    observation : np.ndarray
+        当前层的观察概率
+    transimission : np.ndarray
+        前一层到当前层的转移概率
+
+    Returns:
+    ---------
+    (f, pre)
+        从开头到当前层每个候选点的最大权重和， 当前层每个候选点在最长路径上的前一个候选点
+    '''
+    # score[i, j]: 从前一层第i个候选点到当前层第j个候选点的权重和
+    score = transimission * observation + f[:, None]
+    pre = score.argmax(axis=0)
+    return score[pre, np.arange(len(observation))], pre
+
+
+def get_match_sequence(f, pre_list, transimission_list, log_list, candidates):
+    '''
+    从最后一层权重最大的候选点回溯得到最长路径， 并查看路径中是否存在断点
+
+    Returns:
+    ----------
+    (True, match_list, break_idx)
+        见find_match_sequence
+    '''
+    # 从最后一层权重最大的候选点， 从尾到头，找到最长路径
+    closest_point_idx = int(f.argmax())
+    match_idx_list = [closest_point_idx]
+    for pre in reversed(pre_list):
+        closest_point_idx = int(pre[closest_point_idx])
+        match_idx_list.append(closest_point_idx)
+    match_idx_list.reverse()
+
+    # 查看路径中是否存在断点
+    break_idx = -1
+    for i in range(1, len(match_idx_list)):
+        if transimission_list[i-1][match_idx_list[i-1], match_idx_list[i]] == SMALL_PROBABILITY:
+            break_idx = i
+            break
+
+    # 只为匹配到的候选点创建CPointRec
+    match_point_list = [candidates.get_point(log_id, closest_point_idx) for log_id, closest_point_idx in zip(log_list, match_idx_list)]
+
+    if break_idx == -1:
+        return (True, match_point_list, break_idx)
+    else:
+        return (False, match_point_list, break_idx)
+
+
+def find_match_sequence_layers(observation_list, transimission_list, log_list, candidates):
+    '''
+    在每层的概率数组上做动态规划， 找到得分最大的候选点序列， 结果与find_match_sequence相同
+
+    得分与find_match_sequence一样是每一步 转移概率 * 观察概率 的累加， 每层用一次向量化的max/argmax代替逐个候选点的循环。
+
+    Parameters:
+    -----------
+    observation_list, transimission_list :
+        见construct_layers
+    log_list : list
+        组成track的log id
+    candidates : CandidateStore
+        轨迹的候选点
+
+    Returns:
+    ----------
+    (True, match_list, break_idx)
+        是否连通， 组成最长路径的closest point, 如果不连通， 从那个位置开始不连通
+    '''
+    f = observation_list[0] # 从开头到当前层每个候选点的最大权重和
+    pre_list = [] # 第i个元素为第i+1层每个候选点在最长路径上的前一个候选点
+
+    for observation, transimission in zip(observation_list[1:], transimission_list):
+        f, pre = forward_layer(f, observation, transimission)
+        pre_list.append(pre)
+
+    return get_match_sequence(f, pre_list, transimission_list, log_list, candidates)
+
+
+def match_until_connect_incremental(log_list, candidates):
+    '''
+    与match_until_connect相同， 但删除断裂处的点后只重新计算受影响的部分:
+
+    观察概率按log缓存， 转移概率按(前一个log, 当前log)缓存， 删除点后只需要计算新相邻的两层之间的转移概率；
+    删除点之前各层的动态规划结果不变， 只从删除的位置开始继续动态规划。
+
+    '''
+    observation_dict = {} # log_id -> 观察概率
+    transimission_dict = {} # (pre_log_id, log_id) -> 转移概率
+    f_list = [] # 第i个元素为从开头到第i层每个候选点的最大权重和
+    pre_list = [] # 第i个元素为第i+1层每个候选点在最长路径上的前一个候选点
+
+    cnt = 0
+    while True:
+        for i in range(len(f_list), len(log_list)):
+            log_id = log_list[i]
+            if log_id not in observation_dict:
+                observation_dict[log_id] = get_candidate_observation(candidates, log_id)
+            if i == 0:
+                f_list.append(observation_dict[log_id])
+                continue
+            pre_log_id = log_list[i-1]
+            if (pre_log_id, log_id) not in transimission_dict:
+                with metrics.timer('transition'):
+                    transimission_dict[(pre_log_id, log_id)] = get_candidate_transimission(candidates, pre_log_id, log_id)
+            with metrics.timer('viterbi'):
+                f, pre = forward_layer(f_list[-1], observation_dict[log_id], transimission_dict[(pre_log_id, log_id)])
+            f_list.append(f)
+            pre_list.append(pre)
+
+        transimission_list = [transimission_dict[(pre_log_id, log_id)] for pre_log_id, log_id in zip(log_list[:-1], log_list[1:])]
+        with metrics.timer('viterbi'):
+            is_connect, match_point_list, break_idx = get_match_sequence(f_list[-1], pre_list, transimission_list, log_list, candidates)
+        if is_connect:
+            return match_point_list
+        else:
+            del log_list[break_idx-1:break_idx+1]
+            # 第break_idx-1层之前的动态规划结果仍然有效
+            del f_list[break_idx-1:]
+            del pre_list[max(break_idx-2, 0):]
+            cnt += 1
+            metrics.count('retries')
+        if len(log_list) < 4:
+            return None
+
+        if cnt > 10:
+            return None
+
+
+def match_until_connect(log_list, candidates):
     '''
     尝试构建权重图，获得匹配轨迹， 如果返回的轨迹不连通，
     则删除断裂处的点，重新匹配。
 
+    Parameters:
+    -----------
+    log_list : list
+        参与匹配的log_id列表， 删除断裂处的点时会被修改
+    candidates : CandidateStore或Mapping
+        轨迹的候选点， 权重图使用它的字典视图candidates.points；
+        也可以是原来的log_id -> CPointRec列表字典， 会先转为CandidateStore
+
+    Returns:
+    ---------
+    match_point_list : list
+        匹配好的CPointRec列表， 匹配失败时为None
     '''
+    if not isinstance(candidates, CandidateStore):
+        candidates = CandidateStore.from_closest_points(candidates)
+
+    if MATCH_ENGINE == 'array' and REPAIR_MODE == 'incremental':
+        return match_until_connect_incremental(log_list, candidates)
+
     cnt = 0
     while True:
-        # begin_tick = time.time()
-        g = construct_graph(log_list, log_closest_points)
-        # print('construct graph for {} logs elapse {}'.format(len(log_list), time.time() - begin_tick))
-        # begin_tick = time.time()
-        is_connect, match_point_list, break_idx = find_match_sequence(g, log_list, log_closest_points)
-        # print('find match for {} logs elapse {}'.format(len(log_list), time.time() - begin_tick))
+        if MATCH_ENGINE == 'array':
+            with metrics.timer('transition'):
+                observation_list, transimission_list = construct_layers(log_list, candidates)
+            with metrics.timer('viterbi'):
+                is_connect, match_point_list, break_idx = find_match_sequence_layers(observation_list, transimission_list, log_list, candidates)
+        else:
+            with metrics.timer('transition'):
+                g = construct_graph(log_list, candidates.points)
+            with metrics.timer('viterbi'):
+                is_connect, match_point_list, break_idx = find_match_sequence(g, log_list, candidates.points)
         if is_connect:
             return match_point_list
         else:
             del log_list[break_idx-1:break_idx+1]
             cnt += 1
+            metrics.count('retries')
         if len(log_list) < 4:
             return None
 
         if cnt > 10:
-            return None
\ No newline at end of file
+            return None
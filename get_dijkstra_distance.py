@@ -9,12 +9,16 @@ print('load road')
 
 from collections import namedtuple
 
-import networkx as nx
 import psycopg2
-import fiona
 
 
-from cache import get_distance_from_cache, save_distance_to_cache, get_unique_id
+from cache import get_distance_from_cache, save_distance_to_cache, get_unique_id, init_persistent_cache, get_persistent_cache_path, get_shapefile_fingerprint
+from road_graph import RoadGraph
+from ubodt import UBODT, get_ubodt_path
+from ch import ContractionHierarchy, get_ch_path
+from astar import AStarRouter, BidirectionalRouter
+import config
+import metrics
 
 
 CPointRec = namedtuple('CPointRec', ["log_x", "log_y", "p_x", "p_y", "road_id", "log_id", "source", "target", "weight", "fraction", "v", "log_time", "track_id", "car_id"])
@@ -26,24 +30,72 @@ CPointRec = namedtuple('CPointRec', ["log_x", "log_y", "p_x", "p_y", "road_id",
 
 MAX_V = 33
 MAX_DIS = 5000
+ROAD_SHP_PATH = './shp/input/connected_road.shp'
 ROAD_GRAPH = None
+ROAD_FINGERPRINT = None # 道路shp文件的指纹， 见get_road_fingerprint
+ROUTER = None # 回答候选点之间最短路径查询的后端， 由config.ROUTING_BACKEND决定
 
 
 
 
-def init_road_graph():
-    global ROAD_GRAPH
-    c = fiona.open('./shp/input/connected_road.shp')
-    road_graph = nx.DiGraph()    
-    for feature in c:
-        road_id = int(feature['id'])
-        properties = feature['properties']
-        source = int(properties['source'])
-        target = int(properties['target'])
-        weight = float(properties['weight'])
-        road_graph.add_edge(source, target, weight=weight, road_id=road_id)
-    
+def init_road_graph(road_graph=None, fingerprint=None):
+    '''
+    Parameters:
+    -----------
+    road_graph : RoadGraph
+        已加载的路网图（见road_network.load_road_network）， 为None时读取ROAD_SHP_PATH
+    fingerprint : str
+        道路shp文件的指纹， 为None时在需要时计算
+    '''
+    global ROAD_GRAPH, ROAD_FINGERPRINT
+    if road_graph is None:
+        road_graph = RoadGraph.from_shapefile(ROAD_SHP_PATH)
     ROAD_GRAPH = road_graph
+    ROAD_FINGERPRINT = fingerprint
+    init_router()
+    if config.PERSISTENT_CACHE:
+        # 不可达的记录保存的距离为MAX_DIS， MAX_DIS改变后也需要清空
+        init_persistent_cache(get_persistent_cache_path(ROAD_SHP_PATH), '{}_{}'.format(get_road_fingerprint(), MAX_DIS))
+
+
+def get_road_fingerprint():
+    '''
+    道路shp文件的指纹， init_road_graph没有给出时在第一次使用时计算
+    '''
+    global ROAD_FINGERPRINT
+    if ROAD_FINGERPRINT is None:
+        ROAD_FINGERPRINT = get_shapefile_fingerprint(ROAD_SHP_PATH)
+    return ROAD_FINGERPRINT
+
+
+def init_router():
+    global ROUTER
+    if config.ROUTING_BACKEND == 'ubodt':
+        table_path, offsets_path = get_ubodt_path(ROAD_SHP_PATH)
+        ROUTER = UBODT.load(ROAD_GRAPH, table_path, offsets_path, get_road_fingerprint(), MAX_DIS)
+    elif config.ROUTING_BACKEND == 'ch':
+        ROUTER = ContractionHierarchy.load(ROAD_GRAPH, get_ch_path(ROAD_SHP_PATH), get_road_fingerprint())
+    elif config.ROUTING_BACKEND == 'astar':
+        ROUTER = AStarRouter(ROAD_GRAPH)
+    elif config.ROUTING_BACKEND == 'bidirectional':
+        ROUTER = BidirectionalRouter(ROAD_GRAPH)
+    elif config.ROUTING_BACKEND == 'dijkstra':
+        ROUTER = ROAD_GRAPH
+    else:
+        raise ValueError('unknown routing backend: {}'.format(config.ROUTING_BACKEND))
+
+
+def set_routing_backend(backend):
+    '''
+    切换路径查询后端， 用于在同一份数据上比较不同后端
+
+    不同后端的最短距离相同， 但边权累加的顺序不同（如UBODT查表、 收缩层次的shortcut）， 结果可能在最后几位不同，
+    因此切换后已缓存的结果仍然可以使用， 只是与新后端重新计算的值不一定逐位相等（见cache.DISTANCE_REL_TOL）。
+    需要逐位比较不同后端的结果时先调用cache.clear_cache， 如benchmark.use_variant。
+    '''
+    config.ROUTING_BACKEND = backend
+    if ROAD_GRAPH is not None:
+        init_router()
 
 
 
@@ -62,9 +114,9 @@ def get_dijkstra_distance(pre_closest_point, now_closest_point, cufoff=5000):
 
     Parameters:
     -----------
-    pre_closest_point : CPointRec
+    pre_closest_point : CPointRec或RoadPoint
         起点
-    now_closest_point : CPointRec
+    now_closest_point : CPointRec或RoadPoint
         终点
 
     '''
@@ -74,7 +126,7 @@ def get_dijkstra_distance(pre_closest_point, now_closest_point, cufoff=5000):
     pre_fraction = pre_closest_point.fraction
     pre_weight = pre_closest_point.weight
     
-    assert(ROAD_GRAPH[pre_source][pre_target]['weight'] == pre_weight)
+    assert(ROAD_GRAPH.get_weight(pre_source, pre_target) == pre_weight)
 
 
     now_road_id = now_closest_point.road_id
@@ -83,7 +135,7 @@ def get_dijkstra_distance(pre_closest_point, now_closest_point, cufoff=5000):
     now_fraction = now_closest_point.fraction
     now_weight = now_closest_point.weight
 
-    assert(ROAD_GRAPH[now_source][now_target]['weight'] == now_weight)
+    assert(ROAD_GRAPH.get_weight(now_source, now_target) == now_weight)
     
     source_id = get_unique_id(pre_road_id, pre_fraction) # 唯一标识一个起点
     target_id = get_unique_id(now_road_id, now_fraction) # 唯一标识一个终点
@@ -91,77 +143,121 @@ def get_dijkstra_distance(pre_closest_point, now_closest_point, cufoff=5000):
     
 
     # if cached
-    result = get_distance_from_cache(source_id, target_id)
-    if result:
-        # print('from cache')
-        return result[0]
+    dis = get_distance_from_cache(source_id, target_id, cufoff)
+    if dis is not None:
+        return dis
 
     # if not cached
     if pre_road_id == now_road_id:
         if now_fraction <= pre_fraction:
-            save_distance_to_cache(source_id, target_id, MAX_DIS, None, None)
+            save_distance_to_cache(source_id, target_id, MAX_DIS, False)
             return MAX_DIS
         else:
             dis = (now_fraction-pre_fraction) * now_weight
-            save_distance_to_cache(source_id, target_id, dis, ['a', 'b'], [pre_road_id])
+            save_distance_to_cache(source_id, target_id, dis, True)
             return dis
 
-
+    # 起点和终点的投影点作为虚拟点'a'和'b'， 只在搜索时参与计算， 不修改ROAD_GRAPH
+    # 只计算距离， 路径在get_connected_path中需要时再搜索
+    if metrics.ENABLED:
+        metrics.count('routing_queries')
+    dis, _, _ = ROUTER.shortest_path(pre_closest_point, now_closest_point, cufoff, MAX_DIS, False)
+    save_distance_to_cache(source_id, target_id, dis, dis < MAX_DIS, cufoff)
     
+    return dis
 
 
-    pre_id = 'a'
-    now_id = 'b'
+def get_dijkstra_distances(pre_closest_point, now_closest_points, cufoff=5000):
+    '''
+    获得一个起点到多个终点的dijkstra距离
 
-    if pre_fraction == 0:
-        pre_id = pre_source
-    elif pre_fraction == 1:
-        pre_id = pre_target
-    else:
-        ROAD_GRAPH.add_edge(pre_source, pre_id, weight = pre_fraction * pre_weight,road_id=pre_road_id)
-        ROAD_GRAPH.add_edge(pre_id, pre_target, weight = (1-pre_fraction) * pre_weight,road_id=pre_road_id)
+    只从起点做一次有界的dijkstra搜索， 然后用终点所在道路的fraction计算到每个终点（包括道路中间的虚拟点）的距离，
+    并把结果批量写入缓存。 结果与逐个调用get_dijkstra_distance相同， 同样不生成路径。
 
-    if now_fraction == 0:
-        now_id = now_source
-    elif now_fraction == 1:
-        now_id = now_target
-    else:
-        ROAD_GRAPH.add_edge(now_source, now_id, weight = now_fraction * now_weight, road_id=now_road_id)
-        ROAD_GRAPH.add_edge(now_id, now_target, weight = (1-now_fraction) * now_weight, road_id=now_road_id)
-    
-    dis = MAX_DIS
-    vertex_path = None
-
-    length, path = nx.single_source_dijkstra(ROAD_GRAPH, pre_id, cutoff=cufoff)
-    try:
-        dis = length[now_id]
-        vertex_path = path[now_id]
-    except KeyError:
-        pass
-
-    if vertex_path is None:
-        save_distance_to_cache(source_id, target_id, dis, None, None)
-    else:
-        road_path = ['x']
-        for i in range(1, len(vertex_path)):
-            pre_vertex = vertex_path[i-1]
-            now_vertex = vertex_path[i]
-            road_id = ROAD_GRAPH[pre_vertex][now_vertex]['road_id']
-            if road_id != road_path[-1]:
-                road_path.append(road_id)
+    Parameters:
+    -----------
+    pre_closest_point : CPointRec或RoadPoint
+        起点
+    now_closest_points : list
+        终点列表
 
-        save_distance_to_cache(source_id, target_id, dis, vertex_path, road_path[1:])
+    Returns:
+    ---------
+    dis_list : list
+        起点到每个终点的距离， 不可达为MAX_DIS
+    '''
+    if (ROAD_GRAPH is None):
+        print('init road_graph')
+        init_road_graph()
 
+    pre_road_id = pre_closest_point.road_id
+    pre_fraction = pre_closest_point.fraction
 
-    if pre_fraction != 0 and pre_fraction != 1:
-        ROAD_GRAPH.remove_edge(pre_source, pre_id)
-        ROAD_GRAPH.remove_edge(pre_id, pre_target)
+    assert(ROAD_GRAPH.get_weight(pre_closest_point.source, pre_closest_point.target) == pre_closest_point.weight)
 
-    if now_fraction != 0 and now_fraction != 1:
-        ROAD_GRAPH.remove_edge(now_source, now_id)
-        ROAD_GRAPH.remove_edge(now_id, now_target)
-    
-    return dis
+    source_id = get_unique_id(pre_road_id, pre_fraction)
+
+    dis_list = [None] * len(now_closest_points)
+    search_list = [] # 需要通过搜索得到距离的终点
+    for idx, now_closest_point in enumerate(now_closest_points):
+        now_road_id = now_closest_point.road_id
+        now_fraction = now_closest_point.fraction
+        target_id = get_unique_id(now_road_id, now_fraction)
+
+        dis = get_distance_from_cache(source_id, target_id, cufoff)
+        if dis is not None:
+            dis_list[idx] = dis
+        elif pre_road_id == now_road_id:
+            if now_fraction <= pre_fraction:
+                save_distance_to_cache(source_id, target_id, MAX_DIS, False)
+                dis_list[idx] = MAX_DIS
+            else:
+                dis = (now_fraction-pre_fraction) * now_closest_point.weight
+                save_distance_to_cache(source_id, target_id, dis, True)
+                dis_list[idx] = dis
+        else:
+            assert(ROAD_GRAPH.get_weight(now_closest_point.source, now_closest_point.target) == now_closest_point.weight)
+            search_list.append(idx)
+
+    if len(search_list) == 0:
+        return dis_list
+
+    if metrics.ENABLED:
+        metrics.count('routing_queries')
+    result_list = ROUTER.shortest_paths(pre_closest_point, [now_closest_points[idx] for idx in search_list], cufoff, MAX_DIS, False)
+    for idx, (dis, _, _) in zip(search_list, result_list):
+        now_closest_point = now_closest_points[idx]
+        target_id = get_unique_id(now_closest_point.road_id, now_closest_point.fraction)
+        save_distance_to_cache(source_id, target_id, dis, dis < MAX_DIS, cufoff)
+        dis_list[idx] = dis
+
+    return dis_list
+
+
+def get_distance_and_path(pre_closest_point, now_closest_point, cufoff=5000):
+    '''
+    获得两点间的距离和路径
+
+    缓存中只有距离， 这里重新做一次带路径的搜索， 只对最终匹配序列中相邻的点对调用。
+    同一cutoff下搜索结果确定， 距离与匹配时使用的相同。
+
+    Returns:
+    ---------
+    (distance, vertex_path, road_path)
+        不可达时为(MAX_DIS, None, None)
+    '''
+    if (ROAD_GRAPH is None):
+        print('init road_graph')
+        init_road_graph()
+
+    if pre_closest_point.road_id == now_closest_point.road_id:
+        if now_closest_point.fraction <= pre_closest_point.fraction:
+            return MAX_DIS, None, None
+        return (now_closest_point.fraction-pre_closest_point.fraction) * now_closest_point.weight, ['a', 'b'], [pre_closest_point.road_id]
+
+    if metrics.ENABLED:
+        metrics.count('path_queries')
+    return ROUTER.shortest_path(pre_closest_point, now_closest_point, cufoff, MAX_DIS)
 
 
 def get_connected_path(match_point_list):
@@ -188,18 +284,12 @@ def get_connected_path(match_point_list):
 
     for now_point in match_point_list[1:]:
         
-        source_id = get_unique_id(pre_point.road_id, pre_point.fraction)
-        target_id = get_unique_id(now_point.road_id, now_point.fraction)
-        
-        result = get_distance_from_cache(source_id, target_id)        
-        assert(result is not None)
-
-        dis, vertex_path, road_path = result
+        elapse_time = (now_point.log_time - pre_point.log_time).total_seconds()
+        dis, vertex_path, road_path = get_distance_and_path(pre_point, now_point, min(elapse_time * MAX_V, MAX_DIS))
 
         assert(vertex_path is not None)
         assert(road_path is not None)
 
-        elapse_time = (now_point.log_time - pre_point.log_time).total_seconds()
         if elapse_time * MAX_V < dis:
             return None, None # 超速行驶
 
@@ -236,7 +326,7 @@ if __name__ == '__main__':
     b = CPointRec(-1, -1, -1, -1, 5933, -1, 2412, 2413, 155.541266283945987, 0.6, -1, -1, -1, -1)
     assert(get_dijkstra_distance(a, b) == 15.554126628394595)
     
-    result = get_distance_from_cache(get_unique_id(5933, 0.5), get_unique_id(5933, 0.6))
+    result = get_distance_and_path(a, b)
     assert(result[0] == 15.554126628394595 and result[1] == ['a', 'b'] and result[2] == [5933])
 
     assert(get_dijkstra_distance(a, b) == 15.554126628394595) # from cache
@@ -254,7 +344,7 @@ if __name__ == '__main__':
     b = CPointRec(-1, -1, -1, -1, 63796, -1, 32714, 40182, 144.726173089272010, 0.5, -1, -1, -1, -1)
     assert(get_dijkstra_distance(a,b) == 244.26067072491298)
 
-    result = get_distance_from_cache(get_unique_id(31222, 0.5), get_unique_id(63796, 0.5))
+    result = get_distance_and_path(a, b)
     
     assert(result[0] == 244.26067072491298 and result[1] == ['a', 32714, 'b'] and result[2] == [31222, 63796])
 
@@ -264,20 +354,20 @@ if __name__ == '__main__':
     b = CPointRec(-1, -1, -1, -1, 63796, -1, 32714, 40182, 144.726173089272010, 1, -1, -1, -1, -1)
     assert(get_dijkstra_distance(a,b) == 343.795168360553987+144.726173089272010)
 
-    result = get_distance_from_cache(get_unique_id(31222, 0), get_unique_id(63796, 1))    
+    result = get_distance_and_path(a, b)    
     assert(result[0] == 343.795168360553987+144.726173089272010 and result[1] == [32697, 32714, 40182] and result[2] == [31222, 63796])
     
     a = CPointRec(-1, -1, -1, -1, 31222, -1, 32697, 32714, 343.795168360553987, 0, -1, -1, -1, -1)
     b = CPointRec(-1, -1, -1, -1, 63796, -1, 32714, 40182, 144.726173089272010, 0, -1, -1, -1, -1)
     assert(get_dijkstra_distance(a,b) == 343.795168360553987)
 
-    result = get_distance_from_cache(get_unique_id(31222, 0), get_unique_id(63796, 0))    
+    result = get_distance_and_path(a, b)    
     assert(result[0] == 343.795168360553987 and result[1] == [32697, 32714])
 
     a = CPointRec(-1, -1, -1, -1, 31222, -1, 32697, 32714, 343.795168360553987, 1, -1, -1, -1, -1)
     b = CPointRec(-1, -1, -1, -1, 63796, -1, 32714, 40182, 144.726173089272010, 0, -1, -1, -1, -1)
     assert(get_dijkstra_distance(a,b) == 0)
-    result = get_distance_from_cache(get_unique_id(31222, 1), get_unique_id(63796, 0))    
+    result = get_distance_and_path(a, b)    
     assert(result[0] == 0 and result[1] == [32714])
     assert(get_dijkstra_distance(a,b) == 0) ## from cache
     
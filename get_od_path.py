@@ -7,215 +7,258 @@
 
 '''
 import time
-from datetime import datetime
-from collections import namedtuple, defaultdict, OrderedDict
+import argparse
+import threading
+import multiprocessing
+from collections import namedtuple, deque
 
 
-import psycopg2
-import fiona
-from shapely.geometry import shape, Point
-from shapely.strtree import STRtree
-
-from config import crs, driver, schema
+import config
+from config import crs
 
 from core import match_until_connect
-from get_dijkstra_distance import get_connected_path
-from cache import clear_cache
+import get_dijkstra_distance
+import metrics
+from get_dijkstra_distance import get_connected_path, set_routing_backend
+from cache import clear_cache, flush_cache, get_cache_stats
+from road_index import get_track_candidates
+from road_network import load_road_network
+from track_reader import iter_tracks
+from track_compress import compress_track, expand_match_points
+from output_writer import MatchWriter
+from result_store import ResultStore, get_matcher_fingerprint
 
-CPointRec = namedtuple('CPointRec', ["log_x", "log_y", "p_x", "p_y", "road_id", "log_id", "source", "target", "weight", "fraction", "v", "log_time", "track_id", "car_id"])
-TrackRec = namedtuple('TrackRec', ['x','y', 'uuid', 'track_id', 'log_time', 'car_id', 'v'])
 
+# match_track的结果， metrics为metrics.end_track的返回值， 未开启时为None
+MatchResult = namedtuple('MatchResult', ['track_id', 'connected_vertex_path', 'connected_road_path', 'match_point_list', 'elapse', 'metrics'])
 
+ROAD_SHP_PATH = './shp/input/connected_road.shp'
+ROAD_INDEX = None
+ROAD_NETWORK = None
 
-def get_road_rtree(shp_path):
-    '''
-    获得道路rtree，coord->feature字典
 
-    Parameters:
-    -----------
-    shp_path : str
-        道路文件名
 
+def init_matcher():
     '''
-    c = fiona.open(shp_path)
+    加载匹配需要的道路索引和路网图
 
-    coord_feature_dict = {}
-    geom_list = []
-    
-    for feature in c:
-        geometry = feature['geometry']
-        geom = shape(geometry)
-        geom_list.append(geom)
-
-        coord_key = geom.coords[0] + geom.coords[-1]
-        assert(coord_key not in coord_feature_dict)
-        coord_feature_dict[coord_key] = feature
+    并行匹配时在创建进程池之前调用， fork出的子进程以copy-on-write的方式只读共享这些数据， 不需要重新加载。
+    '''
+    global ROAD_INDEX, ROAD_NETWORK
+    if ROAD_NETWORK is None:
+        ROAD_NETWORK = load_road_network(ROAD_SHP_PATH, config.ROAD_SNAPSHOT)
+        ROAD_INDEX = ROAD_NETWORK.road_index
+    if get_dijkstra_distance.ROAD_GRAPH is None:
+        get_dijkstra_distance.init_road_graph(ROAD_NETWORK.road_graph, ROAD_NETWORK.fingerprint)
 
-    c.close()
 
-    rtree = STRtree(geom_list)
+def get_match_log_ids(kept_logs, candidates):
+    '''
+    参与匹配的log id， 扩大搜索半径后仍然没有候选点的log不参与匹配
 
-    return rtree, coord_feature_dict
-    
+    benchmark.py同样使用这个函数， 与这里的匹配过程保持一致。
+    '''
+    return [log.uuid for log in kept_logs if candidates.get_count(log.uuid) > 0]
 
 
-def get_closest_points(log, road_rtree, coord_feature_dict):
+def match_track(track_id_logs_item):
     '''
-    获得点在路网中的投影点
+    匹配一条轨迹
 
     Parameters:
-    -------------
-    point : shapely point
-        gps log点
-    road_tree : shapely rtree
-        道路rtree
-    coord_feature_dict : dict
-        道路头尾坐标 -> 道路feature字典
-
-    '''
-    # begin_tick = time.time()
-    point = Point(log.x, log.y)
-    point_buffer = point.buffer(30)
-    project_roads = []
-    for road in road_rtree.query(point_buffer):
-        if road.intersects(point_buffer):
-            project_roads.append(road)
-
-    project_points = []
-    for road in project_roads:
-        fraction = road.project(point, normalized=True)
-        project_point = road.interpolate(fraction, normalized=True)
-        road_feature = coord_feature_dict[road.coords[0]+road.coords[-1]]        
-        project_points.append(CPointRec(
-            log.x,
-            log.y,
-            project_point.x,
-            project_point.y,
-            int(road_feature['id']),
-            log.uuid,
-            road_feature['properties']['source'],
-            road_feature['properties']['target'],
-            road_feature['properties']['weight'],
-            fraction,
-            log.v,
-            log.log_time,
-            log.track_id,
-            log.car_id
-        ))
-    
-    # print('get_closest_points time: {}'.format(time.time() - begin_tick))
-    
-    return project_points
+    -----------
+    track_id_logs_item : tuple
+        (track_id, logs)
 
-def read_track(shp_path):
+    Returns:
+    ---------
+    match_result : MatchResult
+        匹配失败时path为None， match_point_list为匹配好的CPointRec列表， 包括压缩时删除的log
     '''
-    '''
-    track_id_logs = defaultdict(list)
-
-    c = fiona.open(shp_path)
-    for feature in c:
-        geometry = feature['geometry']
-        x = geometry['coordinates'][0]
-        y = geometry['coordinates'][1]
-        properties = feature['properties']
-        track_id = properties['track_id']
-        track_id_logs[track_id].append(
-            TrackRec(
-                x,
-                y,
-                properties['uuid'],
-                track_id,
-                datetime.strptime(properties['log_time'], '%Y-%m-%d %H:%M:%S'),
-                properties['car_id'],
-                properties['v']
-                )
-            )
-    
-    return track_id_logs
+    track_id, logs = track_id_logs_item
+    begin_tick = time.time()
+    init_matcher()
+    metrics.begin_track()
+
+    with metrics.timer('compress'):
+        kept_logs, removed = compress_track(logs, config.COMPRESS_STATIONARY_DISTANCE, config.COMPRESS_STATIONARY_TIME, config.COMPRESS_MIN_SPACING)
+    with metrics.timer('candidates'):
+        candidates = get_track_candidates(kept_logs, ROAD_INDEX)
+    log_id_list = get_match_log_ids(kept_logs, candidates)
+    if metrics.ENABLED:
+        metrics.count('logs', len(logs))
+        metrics.count('logs_compressed', len(logs) - len(kept_logs))
+        metrics.count('candidates', len(candidates))
+
+    if config.CACHE_SCOPE == 'track':
+        clear_cache()
+    connected_vertex_path, connected_road_path = None, None
+    match_point_list = match_until_connect(log_id_list, candidates) if len(log_id_list) > 0 else None
+    if match_point_list is not None:
+        with metrics.timer('path'):
+            connected_vertex_path, connected_road_path = get_connected_path(match_point_list)
+        with metrics.timer('compress'):
+            match_point_list = expand_match_points(match_point_list, removed, ROAD_INDEX)
+    flush_cache()
+    if metrics.ENABLED:
+        metrics.count('matched_tracks', int(connected_road_path is not None))
+    elapse = time.time() - begin_tick
+    return MatchResult(track_id, connected_vertex_path, connected_road_path, match_point_list, elapse, metrics.end_track(track_id, elapse))
 
 
-def read_road(shp_path='./shp/input/connected_road.shp'):
+def match_tracks(track_id_logs_items, processes=1, chunksize=4):
     '''
-    读road文件，
-    获得，(source, target) -> road_id 字典
-    和 road_id -> geometry字典
+    匹配多条轨迹， 按输入的顺序返回结果
 
-    
+    Parameters:
+    -----------
+    track_id_logs_items : iterable
+        (track_id, logs)序列
+    processes : int
+        进程数， 为1时在当前进程中匹配
+
+    Returns:
+    ---------
+    generator of match_track的返回值
     '''
-    c = fiona.open(shp_path)
-
-    road_id_geometry_dict = {}
-    key_road_id_dict = {}
+    init_matcher()
+    if processes == 1:
+        for item in track_id_logs_items:
+            yield match_track(item)
+        return
+
+    # fork时子进程直接共享父进程已加载的路网， 不支持fork的平台由每个子进程在第一次匹配时自己加载
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    # imap在后台线程中读取输入， 限制已读取但结果尚未返回的轨迹数， 避免把整个输入读入内存
+    pending = threading.BoundedSemaphore(processes * chunksize * 2)
+
+    def feed():
+        for item in track_id_logs_items:
+            pending.acquire()
+            yield item
+
+    pool = context.Pool(processes)
+    try:
+        for result in pool.imap(match_track, feed(), chunksize):
+            pending.release()
+            yield result
+    finally:
+        pool.terminate()
+
+
+def match_tracks_incremental(track_id_logs_items, store, processes=1):
+    '''
+    只匹配新增或改变的轨迹， 其余轨迹使用保存的结果， 新匹配的结果写入store
 
-    for feature in c:
-        properties = feature['properties']
-        source = properties['source']
-        target = properties['target']
-        road_id = int(feature['id'])
+    保存的结果在下一个新匹配的结果之前返回， 所以轨迹之间的顺序可能与输入不同。
 
-        road_id_geometry_dict[road_id] = feature['geometry']
-        key_road_id_dict[((source, target))] = road_id
+    Parameters:
+    -----------
+    track_id_logs_items : iterable
+        (track_id, logs)序列
+    store : ResultStore
+        保存的结果
+    processes : int
+        进程数
+
+    Returns:
+    ---------
+    generator of MatchResult
+        使用保存的结果时elapse和metrics为None
+    '''
+    reused_track_ids = deque() # 使用保存的结果的轨迹， 多进程时由读取输入的线程添加
+    fingerprints = {} # 需要匹配的轨迹 -> 指纹
+
+    def feed():
+        for track_id, logs in track_id_logs_items:
+            fingerprint = store.get_fingerprint(logs)
+            if store.is_unchanged(track_id, fingerprint):
+                reused_track_ids.append(track_id)
+                continue
+            fingerprints[track_id] = fingerprint
+            yield track_id, logs
+
+    def pop_reused():
+        while reused_track_ids:
+            track_id = reused_track_ids.popleft()
+            yield MatchResult(track_id, *store.get(track_id), elapse=None, metrics=None)
+
+    for result in match_tracks(feed(), processes):
+        for reused_result in pop_reused():
+            yield reused_result
+        store.put(result.track_id, fingerprints.pop(result.track_id), result.connected_vertex_path, result.connected_road_path, result.match_point_list)
+        yield result
+    for reused_result in pop_reused():
+        yield reused_result
 
-    return key_road_id_dict, road_id_geometry_dict
 
 if __name__ == '__main__':
-
-    road_rtree, coord_feature_dict = get_road_rtree('./shp/input/connected_road.shp')
-    
-    key_road_id_dict, road_id_geometry_dict = read_road('./shp/input/connected_road.shp')
-
-
-    # track_id -> logs 字典
-    track_id_logs = read_track('./shp/input/track.shp')    
-    for track_id, logs in track_id_logs.items():
-        begin_tick = time.time()        
-        log_id_list = [log.uuid for log in logs]
-        log_closest_points = defaultdict(list)
-                
-        for log in logs:
-            project_points = get_closest_points(log, road_rtree, coord_feature_dict)            
-            log_closest_points[log.uuid] = project_points
-
-        clear_cache()
-        match_point_list = match_until_connect(log_id_list, log_closest_points)
-        if match_point_list is not None:
-            connected_vertex_path, connected_road_path = get_connected_path(match_point_list)
-            if connected_vertex_path is not None:
-                assert(connected_road_path is not None)                
-                
-                
-                out_c = fiona.open('./shp/output/new_path{}.shp'.format(track_id), 'w', driver=driver, crs=crs, schema=schema)                
-                for i, road_id in enumerate(connected_road_path):
-                    rec = {
-                        'type': 'Feature',
-                        'id': '-1',
-                        'geometry': road_id_geometry_dict[int(road_id)],
-                        'properties': OrderedDict([
-                            ('idx', i)
-                        ])
-                    }
-                    out_c.write(rec)
-                out_c.close()
-
-
-                # out_c = fiona.open('./shp/output/path{}.shp'.format(track_id), 'w', driver=driver, crs=crs, schema=schema)                
-                
-                # for i in range(2, len(connected_vertex_path)):
-                #     pre_point = connected_vertex_path[i-1]
-                #     now_point = connected_vertex_path[i]
-                #     assert((pre_point, now_point) in key_road_id_dict)
-                #     rec = {
-                #         'type': 'Feature',
-                #         'id': '-1',
-                #         'geometry': road_id_geometry_dict[key_road_id_dict[(pre_point, now_point)]],
-                #         'properties': OrderedDict([
-                #             ('idx', i)
-                #         ])
-                #     }
-                #     out_c.write(rec)
-                # out_c.close()
-
-        print(time.time()-begin_tick)
+    parser = argparse.ArgumentParser(description='map match')
+    parser.add_argument('--tracks', default='./shp/input/track.shp', help='gps logs, a shapefile or a csv/parquet file with columns x, y, uuid, track_id, log_time, car_id, v')
+    parser.add_argument('--backend', choices=['dijkstra', 'astar', 'bidirectional', 'ubodt', 'ch'], help='routing backend, default is config.ROUTING_BACKEND')
+    parser.add_argument('--processes', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--output', default=config.OUTPUT_PATH, help='output dataset, default is config.OUTPUT_PATH')
+    parser.add_argument('--points', action='store_true', default=config.WRITE_MATCH_POINTS, help='also write the matched point of every gps log')
+    parser.add_argument('--metrics', default=config.METRICS_PATH, help='write per-track and per-run metrics as json lines')
+    parser.add_argument('--prometheus', default=config.METRICS_PROMETHEUS_PATH, help='write per-run metrics in the prometheus text format')
+    parser.add_argument('--incremental', action='store_true', default=config.RESULT_STORE, help='reuse the stored results of unchanged tracks and only match new or changed ones')
+    parser.add_argument('--result-store', default=config.RESULT_STORE_PATH, help='result store of --incremental, default is config.RESULT_STORE_PATH')
+    args = parser.parse_args()
+    if args.backend is not None:
+        set_routing_backend(args.backend)
+    if args.metrics is not None or args.prometheus is not None:
+        metrics.enable()
+    metrics_file = open(args.metrics, 'w') if args.metrics is not None else None
+
+    init_matcher()
+
+
+    # 逐条读取轨迹， 边读边匹配， 结果由后台线程写入同一个数据集
+    writer = MatchWriter(args.output, ROAD_NETWORK, config.OUTPUT_DRIVER, crs, args.points)
+    track_id_logs_items = iter_tracks(args.tracks, config.TRACK_INPUT_SORTED)
+    # 增量运行时所有轨迹（包括使用保存的结果的轨迹）仍然写入输出， 中断后再次运行从中断处继续
+    store = ResultStore(args.result_store, get_matcher_fingerprint(ROAD_NETWORK.fingerprint)) if args.incremental else None
+    reused_count = 0
+    try:
+        if store is not None:
+            results = match_tracks_incremental(track_id_logs_items, store, args.processes)
+        else:
+            results = match_tracks(track_id_logs_items, args.processes)
+        for result in results:
+            if result.connected_vertex_path is not None:
+                assert(result.connected_road_path is not None)
+                writer.write(result.track_id, result.connected_road_path, result.match_point_list)
+            if result.metrics is not None:
+                metrics.add_track(result.metrics)
+                if metrics_file is not None:
+                    metrics.write_jsonl(metrics_file, result.metrics)
+
+            if result.elapse is None:
+                reused_count += 1
+            else:
+                print(result.elapse)
+    finally:
+        # 匹配出错或被中断时也结束后台写入线程并关闭数据集， 已匹配的轨迹仍然写入输出
+        try:
+            writer.close()
+        finally:
+            if store is not None:
+                store.close()
+
+    if store is not None:
+        print('reused {} unchanged tracks'.format(reused_count))
+    if metrics_file is not None:
+        metrics.write_jsonl(metrics_file, {'run': metrics.get_run_summary()})
+        metrics_file.close()
+    if args.prometheus is not None:
+        metrics.write_prometheus(args.prometheus)
+
+    if args.processes == 1:
+        # 多进程时每个进程有自己的缓存， 只在单进程时输出
+        print('cache: {}'.format(get_cache_stats()))
         
         
         
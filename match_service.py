@@ -0,0 +1,417 @@
+'''
+
+地图匹配服务
+
+常驻的本地HTTP服务（TCP端口或Unix socket）， 只使用标准库:
+启动时加载一次道路索引和路网图， 然后fork出匹配进程， 子进程以copy-on-write的方式共享这些数据；
+asyncio接收请求， 把请求放入队列， 批处理任务把同时到达的请求合并成小批（最多SERVICE_BATCH_SIZE条轨迹，
+收到第一个请求后最多等待SERVICE_BATCH_WAIT秒）， 交给进程池匹配， 事件循环不会被CPU密集的匹配阻塞。
+同时执行的批数不超过进程数， 进程都在忙时请求留在队列中， 下一批因此更大； 队列满时返回503。
+
+接口:
+POST /match    请求体为一条轨迹， 返回经过的道路和每个log的匹配结果
+GET /metrics   Prometheus文本格式的请求数、 延迟分布、 队列长度、 批大小， 开启--metrics时还有匹配各阶段的计数和耗时
+GET /health
+
+usage:
+
+python match_service.py --port 8765 --workers 4
+
+curl -X POST localhost:8765/match -d '{"track_id": 1, "logs": [{"x": 795000.0, "y": 2500000.0, "uuid": 1, "log_time": "2016-09-01 08:00:00", "car_id": "a", "v": 10}, ...]}'
+curl localhost:8765/metrics
+
+'''
+import time
+import json
+import signal
+import asyncio
+import argparse
+import traceback
+import multiprocessing
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import metrics
+import get_od_path
+from get_dijkstra_distance import set_routing_backend
+from track_reader import TrackRec
+
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # 延迟分布的上界（秒）
+MAX_BODY_BYTES = 64 << 20
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+
+def match_batch(items):
+    '''
+    在匹配进程中匹配一批轨迹
+
+    Parameters:
+    -----------
+    items : list
+        (track_id, logs)列表
+
+    Returns:
+    ---------
+    result_list : list
+        get_od_path.MatchResult列表， 匹配出错的轨迹为RuntimeError， 不影响同一批中的其他轨迹
+    '''
+    result_list = []
+    for item in items:
+        try:
+            result_list.append(get_od_path.match_track(item))
+        except Exception as e:
+            traceback.print_exc()
+            # 原来的异常不一定能传回主进程， 转为RuntimeError
+            result_list.append(RuntimeError('matching track {} failed: {!r}'.format(item[0], e)))
+    return result_list
+
+
+def parse_track(body):
+    '''
+    由请求体得到一条轨迹
+
+    请求体为json: {"track_id": ..., "logs": [{"x", "y", "uuid", "log_time", "car_id", "v"}, ...]}，
+    log_time的格式与轨迹shp文件相同（%Y-%m-%d %H:%M:%S）， log按时间排序。
+
+    Returns:
+    ---------
+    (track_id, logs)
+        logs为TrackRec列表
+
+    Raises:
+    ---------
+    ValueError
+        请求体格式错误
+    '''
+    try:
+        request = json.loads(body.decode('utf-8'))
+        track_id = request['track_id']
+        logs = [
+            TrackRec(
+                float(log['x']),
+                float(log['y']),
+                log['uuid'],
+                track_id,
+                datetime.strptime(log['log_time'], '%Y-%m-%d %H:%M:%S'),
+                log.get('car_id'),
+                log.get('v')
+            )
+            for log in request['logs']
+        ]
+    except (KeyError, TypeError, AttributeError, UnicodeDecodeError) as e:
+        raise ValueError('invalid track: {!r}'.format(e))
+    if len(logs) == 0:
+        raise ValueError('track {} has no logs'.format(track_id))
+    return track_id, logs
+
+
+def format_result(result):
+    '''
+    MatchResult -> 可以序列化为json的dict， 匹配失败时matched为False
+    '''
+    matched = result.connected_road_path is not None
+    points = []
+    if matched and result.match_point_list is not None:
+        for closest_point in result.match_point_list:
+            points.append(OrderedDict([
+                ('log_id', closest_point.log_id),
+                ('road_id', int(closest_point.road_id)),
+                ('fraction', float(closest_point.fraction)),
+                ('p_x', float(closest_point.p_x)),
+                ('p_y', float(closest_point.p_y))
+            ]))
+    return OrderedDict([
+        ('track_id', result.track_id),
+        ('matched', matched),
+        ('elapse', result.elapse),
+        ('road_path', [int(road_id) for road_id in result.connected_road_path] if matched else None),
+        ('vertex_path', [int(vertex) for vertex in result.connected_vertex_path] if matched else None),
+        ('points', points)
+    ])
+
+
+class ServiceStats(object):
+    '''
+    服务的请求数、 延迟、 排队时间和批大小
+    '''
+
+    def __init__(self):
+        self.responses = OrderedDict() # 状态码 -> 匹配请求数
+        self.latency_counts = [0] * len(LATENCY_BUCKETS) # 第i个元素为延迟不超过LATENCY_BUCKETS[i]的请求数
+        self.latency_sum = 0.0
+        self.latency_count = 0
+        self.queue_wait_sum = 0.0 # 请求在队列中等待的总时间
+        self.batches = 0
+        self.batch_tracks = 0
+        self.match_seconds = 0.0 # 进程池执行各批的总时间
+
+    def observe_request(self, status, latency):
+        self.responses[status] = self.responses.get(status, 0) + 1
+        self.latency_sum += latency
+        self.latency_count += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_counts[i] += 1
+
+    def observe_batch(self, track_count, queue_wait, match_seconds):
+        self.batches += 1
+        self.batch_tracks += track_count
+        self.queue_wait_sum += queue_wait
+        self.match_seconds += match_seconds
+
+    def format_prometheus(self, queue_depth, running_batches, workers, prefix='mapmatch_service'):
+        '''
+        Prometheus文本格式
+        '''
+        lines = []
+        lines.append('# TYPE {}_requests_total counter'.format(prefix))
+        for status, value in self.responses.items():
+            lines.append('{}_requests_total{{code="{}"}} {}'.format(prefix, status, value))
+        lines.append('# TYPE {}_request_seconds histogram'.format(prefix))
+        for bound, value in zip(LATENCY_BUCKETS, self.latency_counts):
+            lines.append('{}_request_seconds_bucket{{le="{}"}} {}'.format(prefix, bound, value))
+        lines.append('{}_request_seconds_bucket{{le="+Inf"}} {}'.format(prefix, self.latency_count))
+        lines.append('{}_request_seconds_sum {}'.format(prefix, self.latency_sum))
+        lines.append('{}_request_seconds_count {}'.format(prefix, self.latency_count))
+        for name, value in [
+            ('queue_wait_seconds_total', self.queue_wait_sum),
+            ('batches_total', self.batches),
+            ('batch_tracks_total', self.batch_tracks),
+            ('match_seconds_total', self.match_seconds)
+        ]:
+            lines.append('# TYPE {}_{} counter'.format(prefix, name))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+        for name, value in [
+            ('queue_depth', queue_depth),
+            ('running_batches', running_batches),
+            ('workers', workers)
+        ]:
+            lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+            lines.append('{}_{} {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MatchService(object):
+    '''
+    合并请求并交给进程池匹配
+
+    Parameters:
+    -----------
+    workers : int
+        匹配进程数
+    batch_size : int
+        每批最多的轨迹数
+    batch_wait : float
+        收到第一个请求后最多等待多少秒凑成一批
+    queue_size : int
+        等待匹配的请求数上限
+    '''
+
+    def __init__(self, workers, batch_size, batch_wait, queue_size):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue_size = queue_size
+        self.stats = ServiceStats()
+        self.running_batches = 0
+        self.queue = None # 在事件循环中创建
+        self.slots = None
+
+        # 在创建进程池之前加载路网， fork出的匹配进程直接共享
+        get_od_path.init_matcher()
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+        self.pool = ProcessPoolExecutor(workers, mp_context=context)
+        # fork时第一次提交就创建所有进程， 在启动事件循环之前完成； 其他平台由子进程自己加载路网
+        self.pool.submit(get_od_path.init_matcher).result()
+
+    async def serve(self, host=None, port=None, unix_path=None):
+        '''
+        启动服务， 直到被取消
+        '''
+        self.queue = asyncio.Queue(self.queue_size)
+        # 同时执行的批数不超过进程数
+        self.slots = asyncio.Semaphore(self.workers)
+        batcher = asyncio.ensure_future(self.run_batches())
+        # SIGTERM时与Ctrl-C一样停止服务
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except NotImplementedError:
+            pass
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+            print('serving on {}'.format(unix_path))
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print('serving on {}:{}'.format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+    async def match(self, item):
+        '''
+        提交一条轨迹， 等待匹配结果
+
+        Raises:
+        ---------
+        asyncio.QueueFull
+            队列已满
+        '''
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def run_batches(self):
+        '''
+        从队列中取出请求组成批， 有空闲的进程时交给进程池
+        '''
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            if self.batch_wait > 0 and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_wait)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            asyncio.ensure_future(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        self.running_batches += 1
+        begin_tick = time.perf_counter()
+        try:
+            result_list = await asyncio.get_running_loop().run_in_executor(self.pool, match_batch, [item for item, _, _ in batch])
+            for (_, future, _), result in zip(batch, result_list):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.running_batches -= 1
+            self.slots.release()
+            self.stats.observe_batch(len(batch), sum(begin_tick - enqueue_tick for _, _, enqueue_tick in batch), time.perf_counter() - begin_tick)
+
+    async def handle_connection(self, reader, writer):
+        '''
+        处理一个连接上的HTTP/1.1请求， 支持keep-alive
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                parts = request_line.decode('latin-1').split()
+                length = int(headers.get('content-length', 0) or 0)
+                if len(parts) != 3:
+                    status, content_type, payload = 400, 'text/plain', 'invalid request line\n'
+                    keep_alive = False
+                elif length > MAX_BODY_BYTES:
+                    status, content_type, payload = 413, 'text/plain', 'request body too large\n'
+                    keep_alive = False
+                else:
+                    method, path, version = parts
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status, content_type, payload = await self.dispatch(method, path.split('?')[0], body)
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                data = payload.encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n'.format(
+                    status, HTTP_REASONS[status], content_type, len(data), 'keep-alive' if keep_alive else 'close'
+                ).encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        '''
+        Returns:
+        ---------
+        (status, content_type, payload)
+        '''
+        if path == '/health':
+            return 200, 'text/plain', 'ok\n'
+        if path == '/metrics':
+            payload = self.stats.format_prometheus(self.queue.qsize(), self.running_batches, self.workers)
+            if metrics.ENABLED:
+                payload += metrics.format_prometheus()
+            return 200, 'text/plain; version=0.0.4', payload
+        if path != '/match':
+            return 404, 'text/plain', 'not found\n'
+        if method != 'POST':
+            return 405, 'text/plain', 'use POST\n'
+
+        begin_tick = time.perf_counter()
+        try:
+            result = await self.match(parse_track(body))
+        except ValueError as e:
+            status, payload = 400, json.dumps({'error': str(e)})
+        except asyncio.QueueFull:
+            status, payload = 503, json.dumps({'error': 'queue is full'})
+        except Exception as e:
+            status, payload = 500, json.dumps({'error': repr(e)})
+        else:
+            if result.metrics is not None:
+                metrics.add_track(result.metrics)
+            status, payload = 200, json.dumps(format_result(result))
+        self.stats.observe_request(status, time.perf_counter() - begin_tick)
+        return status, 'application/json', payload
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='map match service')
+    parser.add_argument('--host', default=config.SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=config.SERVICE_PORT)
+    parser.add_argument('--unix', help='listen on this unix socket instead of a tcp port')
+    parser.add_argument('--workers', type=int, default=config.SERVICE_WORKERS, help='number of matching processes')
+    parser.add_argument('--batch-size', type=int, default=config.SERVICE_BATCH_SIZE, help='most tracks matched in one batch')
+    parser.add_argument('--batch-wait', type=float, default=config.SERVICE_BATCH_WAIT, help='seconds to wait for more requests after the first one of a batch')
+    parser.add_argument('--queue-size', type=int, default=config.SERVICE_QUEUE_SIZE, help='most requests waiting to be matched')
+    parser.add_argument('--backend', choices=['dijkstra', 'astar', 'bidirectional', 'ubodt', 'ch'], help='routing backend, default is config.ROUTING_BACKEND')
+    parser.add_argument('--metrics', action='store_true', default=config.METRICS, help='also export the per-stage matching counters on /metrics')
+    args = parser.parse_args()
+    if args.backend is not None:
+        set_routing_backend(args.backend)
+    if args.metrics:
+        metrics.enable()
+
+    service = MatchService(args.workers, args.batch_size, args.batch_wait, args.queue_size)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,235 @@
+'''
+
+匹配过程的计时和计数
+
+按轨迹记录各阶段耗时、 计数和最大值（候选点数、 剪枝去掉的候选点数、 计算的转移概率数、 路径查询次数、 搜索确定的节点数、 删除断裂点的次数等），
+并汇总为整次运行的结果， 可以输出为json lines或Prometheus文本格式。
+
+关闭时（config.METRICS为False）timer返回不做任何事情的对象， 调用处用ENABLED判断后再计数， 几乎没有额外开销。
+
+usage:
+
+metrics.begin_track()
+with metrics.timer('candidates'):
+    ...
+if metrics.ENABLED:
+    metrics.count('candidates', n)
+record = metrics.end_track(track_id)
+metrics.add_track(record)
+
+'''
+import time
+import json
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import config
+from cache import get_cache_stats
+
+
+ENABLED = config.METRICS
+
+CURRENT = None # 当前轨迹的计数和计时
+CACHE_STATS_BEGIN = None # 当前轨迹开始时的缓存统计
+RUN = None # 整次运行的汇总
+
+
+def new_record():
+    return {'counters': OrderedDict(), 'maxima': OrderedDict(), 'stages': OrderedDict()}
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+    reset()
+
+
+def reset():
+    global CURRENT, RUN
+    CURRENT = new_record()
+    RUN = new_record()
+    RUN['tracks'] = 0
+    RUN['peak_rss_kb'] = None
+
+
+class Timer(object):
+    '''
+    把with块的耗时累加到当前轨迹的一个阶段
+    '''
+    __slots__ = ['name', 'tick']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.tick = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stages = CURRENT['stages']
+        stages[self.name] = stages.get(self.name, 0.0) + time.perf_counter() - self.tick
+        return False
+
+
+class NullTimer(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name):
+    if ENABLED:
+        return Timer(name)
+    return NULL_TIMER
+
+
+def count(name, value=1):
+    '''
+    当前轨迹的计数器加value， 热点代码中应先判断ENABLED
+    '''
+    if ENABLED:
+        counters = CURRENT['counters']
+        counters[name] = counters.get(name, 0) + value
+
+
+def maximum(name, value):
+    '''
+    记录当前轨迹中某个量的最大值， 例如一个log的最大候选点数
+    '''
+    if ENABLED:
+        maxima = CURRENT['maxima']
+        maxima[name] = max(maxima.get(name, value), value)
+
+
+def get_peak_rss_kb():
+    '''
+    进程的内存占用峰值（KB）， 不支持的平台为None
+    '''
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def begin_track():
+    global CURRENT, CACHE_STATS_BEGIN
+    if not ENABLED:
+        return
+    CURRENT = new_record()
+    CACHE_STATS_BEGIN = get_cache_stats()
+
+
+def end_track(track_id, elapse=None):
+    '''
+    结束当前轨迹
+
+    Returns:
+    ---------
+    record : dict
+        当前轨迹的计数和计时， 未开启时为None
+    '''
+    if not ENABLED:
+        return None
+    record = OrderedDict()
+    record['track_id'] = track_id
+    record['elapse'] = elapse
+    record['counters'] = CURRENT['counters']
+    record['maxima'] = CURRENT['maxima']
+    record['stages'] = CURRENT['stages']
+
+    cache_stats = get_cache_stats()
+    hits = cache_stats['hits'] + cache_stats['disk_hits'] - CACHE_STATS_BEGIN['hits'] - CACHE_STATS_BEGIN['disk_hits']
+    misses = cache_stats['misses'] - CACHE_STATS_BEGIN['misses']
+    record['counters']['cache_hits'] = hits
+    record['counters']['cache_misses'] = misses
+    record['cache_hit_rate'] = hits / (hits + misses) if hits + misses > 0 else None
+    logs = record['counters'].get('logs', 0)
+    record['candidates_per_log'] = record['counters'].get('candidates', 0) / logs if logs > 0 else None
+    record['peak_rss_kb'] = get_peak_rss_kb()
+    return record
+
+
+def add_track(record):
+    '''
+    把一条轨迹的结果（可能来自其他进程）汇总到整次运行
+    '''
+    if record is None:
+        return
+    RUN['tracks'] += 1
+    for name, value in record['counters'].items():
+        RUN['counters'][name] = RUN['counters'].get(name, 0) + value
+    for name, value in record['maxima'].items():
+        RUN['maxima'][name] = max(RUN['maxima'].get(name, value), value)
+    for name, value in record['stages'].items():
+        RUN['stages'][name] = RUN['stages'].get(name, 0.0) + value
+    if record['peak_rss_kb'] is not None:
+        RUN['peak_rss_kb'] = max(RUN['peak_rss_kb'] or 0, record['peak_rss_kb'])
+
+
+def get_run_summary():
+    summary = OrderedDict()
+    summary['tracks'] = RUN['tracks']
+    summary['counters'] = RUN['counters']
+    summary['maxima'] = RUN['maxima']
+    summary['stages'] = RUN['stages']
+    hits = RUN['counters'].get('cache_hits', 0)
+    misses = RUN['counters'].get('cache_misses', 0)
+    summary['cache_hit_rate'] = hits / (hits + misses) if hits + misses > 0 else None
+    logs = RUN['counters'].get('logs', 0)
+    summary['candidates_per_log'] = RUN['counters'].get('candidates', 0) / logs if logs > 0 else None
+    summary['peak_rss_kb'] = RUN['peak_rss_kb']
+    return summary
+
+
+def write_jsonl(f, record):
+    '''
+    写入一行json
+    '''
+    f.write(json.dumps(record) + '\n')
+
+
+def format_prometheus(prefix='mapmatch'):
+    '''
+    整次运行的汇总的Prometheus文本格式
+    '''
+    summary = get_run_summary()
+    lines = []
+    lines.append('# TYPE {}_tracks_total counter'.format(prefix))
+    lines.append('{}_tracks_total {}'.format(prefix, summary['tracks']))
+    lines.append('# TYPE {}_stage_seconds_total counter'.format(prefix))
+    for name, value in summary['stages'].items():
+        lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, name, value))
+    for name, value in summary['counters'].items():
+        lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+        lines.append('{}_{}_total {}'.format(prefix, name, value))
+    for name, value in summary['maxima'].items():
+        lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+        lines.append('{}_{} {}'.format(prefix, name, value))
+    if summary['cache_hit_rate'] is not None:
+        lines.append('# TYPE {}_cache_hit_rate gauge'.format(prefix))
+        lines.append('{}_cache_hit_rate {}'.format(prefix, summary['cache_hit_rate']))
+    if summary['peak_rss_kb'] is not None:
+        lines.append('# TYPE {}_peak_rss_bytes gauge'.format(prefix))
+        lines.append('{}_peak_rss_bytes {}'.format(prefix, summary['peak_rss_kb'] * 1024))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, prefix='mapmatch'):
+    '''
+    把整次运行的汇总写为Prometheus文本格式（可由node_exporter的textfile collector读取）
+    '''
+    with open(path, 'w') as f:
+        f.write(format_prometheus(prefix))
+
+
+reset()
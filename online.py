@@ -0,0 +1,313 @@
+'''
+
+实时gps数据的在线匹配
+
+每辆车只保留最近的若干层候选点（滑动窗口）， 每收到一个log做一步动态规划：
+窗口内所有候选点回溯的路径汇合到同一个候选点时， 汇合点之前的匹配结果不会再改变， 立即输出；
+窗口超过lag层时， 按当前得分最大的路径强制输出最早的一层。
+与窗口不连通的log按match_until_connect的规则删除断裂处的两个log: 这个log和窗口的最后一层。
+这个log先暂存， 如果下一个log也与窗口不连通， 则从暂存的log开始新的一段。
+因此每辆车占用的内存与行程长度无关。
+
+与批量匹配的区别: 已经输出的log不能再删除， 窗口最后一层是已输出的锚点时只删除不连通的log；
+批量匹配连续删除10次后放弃整条轨迹， 在线匹配则从暂存的log开始新的一段。
+
+usage:
+
+matcher = OnlineMatcher(RoadSegmentIndex.from_shapefile('./shp/input/connected_road.shp'), lag=10)
+for log in feed:
+    for match in matcher.add_log(log):
+        ...
+matcher.flush_all()
+
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from core import get_layer_observation, get_layer_transimission, forward_layer, get_max_distance, SMALL_PROBABILITY
+from get_dijkstra_distance import get_distance_and_path
+from road_index import get_track_closest_points
+
+
+# log: TrackRec, closest_point: 匹配到的CPointRec,
+# road_path: 从上一个匹配点到当前匹配点经过的道路， 每段连续匹配的第一个点为None
+MatchRec = namedtuple('MatchRec', ['log', 'closest_point', 'road_path'])
+
+
+class Layer(object):
+    '''
+    窗口中的一层
+
+    Attributes:
+    -----------
+    log : TrackRec
+    closest_points : list
+        候选点
+    observation : np.ndarray
+        观察概率
+    transimission : np.ndarray
+        前一层到这一层的转移概率， 窗口第一层为None
+    f : np.ndarray
+        从窗口开头到这一层每个候选点的最大权重和
+    pre : np.ndarray
+        每个候选点在最长路径上的前一个候选点， 窗口第一层为None
+    '''
+
+    def __init__(self, log, closest_points, observation):
+        self.log = log
+        self.closest_points = closest_points
+        self.observation = observation
+        self.transimission = None
+        self.f = observation
+        self.pre = None
+
+
+class VehicleState(object):
+    '''
+    一辆车的匹配状态
+
+    window的第一层如果已经输出， 则只保留输出的那个候选点， 作为后续匹配的锚点。
+    '''
+
+    def __init__(self):
+        self.window = []
+        self.is_anchored = False # window第一层是否已经输出
+        self.last_point = None # 最后输出的候选点
+        self.pending = None # 与窗口不连通、 暂存的一层
+        self.last_log_time = None # 最后收到的log的时间， 包括暂存和没有候选点的log
+
+
+class OnlineMatcher(object):
+    '''
+    固定延迟的在线匹配
+
+    Parameters:
+    -----------
+    road_index : RoadSegmentIndex
+        道路线段索引
+    lag : int
+        一个log最多在收到之后的lag个log内输出匹配结果
+    radius : float
+        候选点搜索半径
+    '''
+
+    def __init__(self, road_index, lag=10, radius=30):
+        assert(lag >= 1)
+        self.road_index = road_index
+        self.lag = lag
+        self.radius = radius
+        self.vehicles = {} # (car_id, track_id) -> VehicleState
+
+    def add_log(self, log):
+        '''
+        接收一个log
+
+        Parameters:
+        -----------
+        log : TrackRec
+            同一辆车的log需要按时间顺序输入
+
+        Returns:
+        ---------
+        match_list : list
+            本次可以确定的MatchRec列表
+        '''
+        key = (log.car_id, log.track_id)
+        state = self.vehicles.get(key)
+        if state is not None:
+            state.last_log_time = log.log_time
+
+        closest_points = get_track_closest_points([log], self.road_index, self.radius)[log.uuid]
+        if len(closest_points) == 0:
+            return []
+
+        if state is None:
+            state = VehicleState()
+            state.last_log_time = log.log_time
+            self.vehicles[key] = state
+
+        layer = Layer(log, closest_points, get_layer_observation(closest_points))
+        match_list = []
+        if self.connect(state.window, layer):
+            # 不连通的log之后的log又与窗口连通， 丢弃暂存的log
+            state.pending = None
+        elif state.pending is None:
+            # 与match_until_connect相同， 删除断裂处的两个log， 已经输出的锚点不能删除
+            if not (state.is_anchored and len(state.window) == 1):
+                state.window.pop()
+            # 暂不处理这个log， 等下一个log决定是丢弃它还是从这里开始新的一段
+            state.pending = layer
+            return match_list
+        else:
+            # 连续两个log都与窗口不连通， 输出当前窗口， 从暂存的log开始新的一段
+            match_list.extend(self.finalize(state, len(state.window) - 1, self.backtrack(state.window, int(state.window[-1].f.argmax()))))
+            state.window = []
+            state.is_anchored = False
+            state.last_point = None
+            pending = state.pending
+            state.pending = None
+            self.connect(state.window, pending)
+            state.window.append(pending)
+            if not self.connect(state.window, layer):
+                state.pending = layer
+                return match_list
+        state.window.append(layer)
+
+        converged_idx = self.get_converged_idx(state.window, state.is_anchored)
+        if converged_idx is not None:
+            match_list.extend(self.finalize(state, converged_idx[0], self.backtrack(state.window[:converged_idx[0] + 1], converged_idx[1])))
+        if len(state.window) > self.lag:
+            # 超过延迟， 按当前最优路径输出最早未输出的一层
+            path = self.backtrack(state.window, int(state.window[-1].f.argmax()))
+            finalize_idx = len(state.window) - 1 - self.lag
+            match_list.extend(self.finalize(state, finalize_idx, path[:finalize_idx + 1]))
+        return match_list
+
+    def connect(self, window, layer):
+        '''
+        计算window最后一层到layer的转移概率和动态规划结果
+
+        Returns:
+        ---------
+        is_connect : bool
+            得分最大的路径在这一步是否连通， window为空时为True
+        '''
+        if len(window) == 0:
+            layer.transimission = None
+            layer.f = layer.observation
+            layer.pre = None
+            return True
+        pre_layer = window[-1]
+        layer.transimission = get_layer_transimission(pre_layer.closest_points, layer.closest_points)
+        layer.f, layer.pre = forward_layer(pre_layer.f, layer.observation, layer.transimission)
+        best_idx = int(layer.f.argmax())
+        return layer.transimission[layer.pre[best_idx], best_idx] != SMALL_PROBABILITY
+
+    def flush(self, car_id, track_id):
+        '''
+        一辆车的行程结束， 输出窗口中剩余的匹配结果并释放状态
+        '''
+        state = self.vehicles.pop((car_id, track_id), None)
+        if state is None:
+            return []
+        match_list = []
+        if len(state.window) > 0:
+            # 断裂处的两个log被删除后窗口可能为空
+            match_list = self.finalize(state, len(state.window) - 1, self.backtrack(state.window, int(state.window[-1].f.argmax())))
+        if state.pending is not None:
+            # 最后一个log与之前不连通， 单独作为一段
+            pending = state.pending
+            state.window = []
+            state.is_anchored = False
+            state.last_point = None
+            self.connect(state.window, pending)
+            state.window.append(pending)
+            match_list.extend(self.finalize(state, 0, [int(pending.f.argmax())]))
+        return match_list
+
+    def flush_all(self):
+        match_list = []
+        for car_id, track_id in list(self.vehicles.keys()):
+            match_list.extend(self.flush(car_id, track_id))
+        return match_list
+
+    def flush_idle(self, now, max_idle_seconds):
+        '''
+        输出并释放超过max_idle_seconds没有收到log的车辆
+
+        空闲时间从最后收到的log算起， 包括暂存的和没有候选点的log。
+
+        Parameters:
+        -----------
+        now : datetime
+            当前时间
+        '''
+        match_list = []
+        for (car_id, track_id), state in list(self.vehicles.items()):
+            if (now - state.last_log_time).total_seconds() > max_idle_seconds:
+                match_list.extend(self.flush(car_id, track_id))
+        return match_list
+
+    def backtrack(self, window, closest_point_idx):
+        '''
+        从window最后一层的closest_point_idx回溯， 得到每层候选点下标
+        '''
+        path = [closest_point_idx]
+        for layer in reversed(window[1:]):
+            closest_point_idx = int(layer.pre[closest_point_idx])
+            path.append(closest_point_idx)
+        path.reverse()
+        return path
+
+    def get_converged_idx(self, window, is_anchored=False):
+        '''
+        最后一层所有候选点回溯的路径在哪一层汇合
+
+        锚点只有一个候选点， 所有路径总是在锚点汇合， 只汇合到锚点时没有新的结果可以输出， 返回None。
+
+        Parameters:
+        -----------
+        is_anchored : bool
+            window第一层是否是已经输出的锚点
+
+        Returns:
+        ---------
+        (layer_idx, closest_point_idx)
+            汇合的最后一层和汇合的候选点， 没有汇合（或只汇合到锚点）为None
+        '''
+        alive = np.arange(len(window[-1].closest_points))
+        for layer_idx in range(len(window) - 1, -1, -1):
+            if len(alive) == 1:
+                if layer_idx == 0 and is_anchored:
+                    return None
+                return layer_idx, int(alive[0])
+            if layer_idx == 0:
+                return None
+            alive = np.unique(window[layer_idx].pre[alive])
+        return None
+
+    def finalize(self, state, finalize_idx, path):
+        '''
+        输出window中第0层到第finalize_idx层的匹配结果， 并把第finalize_idx层作为新的锚点
+
+        Parameters:
+        -----------
+        path : list
+            第0层到第finalize_idx层（或更多层）选择的候选点下标
+        '''
+        match_list = []
+        window = state.window
+        for layer_idx in range(finalize_idx + 1):
+            if layer_idx == 0 and state.is_anchored:
+                continue
+            closest_point = window[layer_idx].closest_points[path[layer_idx]]
+            road_path = None
+            if state.last_point is not None:
+                road_path = get_road_path(state.last_point, closest_point)
+            match_list.append(MatchRec(window[layer_idx].log, closest_point, road_path))
+            state.last_point = closest_point
+
+        # 锚点只保留选择的候选点， 重新计算后续各层的动态规划
+        anchor = window[finalize_idx]
+        anchor_idx = path[finalize_idx]
+        anchor.closest_points = [anchor.closest_points[anchor_idx]]
+        anchor.observation = anchor.observation[[anchor_idx]]
+        anchor.f = anchor.f[[anchor_idx]]
+        anchor.transimission = None
+        anchor.pre = None
+        if finalize_idx + 1 < len(window):
+            next_layer = window[finalize_idx + 1]
+            next_layer.transimission = next_layer.transimission[[anchor_idx]]
+        state.window = window[finalize_idx:]
+        state.is_anchored = True
+        for pre_layer, layer in zip(state.window[:-1], state.window[1:]):
+            layer.f, layer.pre = forward_layer(pre_layer.f, layer.observation, layer.transimission)
+        return match_list
+
+
+def get_road_path(pre_closest_point, closest_point):
+    '''
+    相邻两个匹配点之间经过的道路
+    '''
+    return get_distance_and_path(pre_closest_point, closest_point, get_max_distance(pre_closest_point, closest_point))[2]
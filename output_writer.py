@@ -0,0 +1,165 @@
+'''
+
+把所有轨迹的匹配结果写入同一个数据集
+
+path图层: 每条轨迹经过的道路， 每条道路一个要素， 属性为track_id, idx, road_id
+point图层（可选）: 每个gps log的匹配结果， 几何为投影点， 属性为track_id, log_id, road_id, fraction, p_x, p_y
+
+GeoPackage时两个图层写在同一个文件中， shapefile时point图层写在同名加_point后缀的文件中。
+写入在后台线程中进行， 要素积累到buffer_size个后批量写入， 与匹配同时进行。
+
+'''
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import fiona
+
+
+PATH_SCHEMA = {
+    'properties': OrderedDict([
+        ('track_id', 'int'),
+        ('idx', 'int'),
+        ('road_id', 'int')
+    ]),
+    'geometry': 'LineString'
+}
+
+POINT_SCHEMA = {
+    'properties': OrderedDict([
+        ('track_id', 'int'),
+        ('log_id', 'int'),
+        ('road_id', 'int'),
+        ('fraction', 'float'),
+        ('p_x', 'float'),
+        ('p_y', 'float')
+    ]),
+    'geometry': 'Point'
+}
+
+
+class MatchWriter(object):
+    '''
+    后台写入匹配结果
+
+    Parameters:
+    -----------
+    output_path : str
+        输出文件
+    road_network : RoadNetwork
+        用于获得道路几何
+    driver : str
+        'GPKG'或'ESRI Shapefile'
+    crs : dict
+        坐标系
+    write_points : bool
+        是否写入每个gps log的匹配结果
+    buffer_size : int
+        每次批量写入的要素数
+    '''
+
+    def __init__(self, output_path, road_network, driver, crs, write_points=False, buffer_size=1000):
+        self.road_network = road_network
+        self.buffer_size = buffer_size
+        self.error = None
+
+        if driver == 'GPKG':
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            self.path_c = fiona.open(output_path, 'w', driver=driver, crs=crs, schema=PATH_SCHEMA, layer='path')
+            self.point_c = None
+            if write_points:
+                self.point_c = fiona.open(output_path, 'w', driver=driver, crs=crs, schema=POINT_SCHEMA, layer='point')
+        else:
+            self.path_c = fiona.open(output_path, 'w', driver=driver, crs=crs, schema=PATH_SCHEMA)
+            self.point_c = None
+            if write_points:
+                point_path = os.path.splitext(output_path)[0] + '_point' + os.path.splitext(output_path)[1]
+                self.point_c = fiona.open(point_path, 'w', driver=driver, crs=crs, schema=POINT_SCHEMA)
+
+        # 队列有上限， 写入跟不上匹配时匹配会等待， 内存不会无限增长
+        self.queue = queue.Queue(maxsize=64)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, track_id, connected_road_path, match_point_list=None):
+        '''
+        提交一条轨迹的匹配结果
+
+        Parameters:
+        -----------
+        connected_road_path : list
+            轨迹经过的道路
+        match_point_list : list
+            匹配好的CPointRec列表， 不写point图层时忽略
+        '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((track_id, connected_road_path, match_point_list))
+
+    def close(self):
+        '''
+        写入剩余的要素并关闭数据集， 后台线程出错时抛出该错误
+        '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        path_buffer = []
+        point_buffer = []
+        is_finished = False
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    is_finished = True
+                    break
+                track_id, connected_road_path, match_point_list = item
+                for idx, road_id in enumerate(connected_road_path):
+                    path_buffer.append({
+                        'type': 'Feature',
+                        'geometry': self.road_network.get_geometry(int(road_id)),
+                        'properties': OrderedDict([
+                            ('track_id', int(track_id)),
+                            ('idx', idx),
+                            ('road_id', int(road_id))
+                        ])
+                    })
+                if self.point_c is not None and match_point_list is not None:
+                    for closest_point in match_point_list:
+                        point_buffer.append({
+                            'type': 'Feature',
+                            'geometry': {'type': 'Point', 'coordinates': (closest_point.p_x, closest_point.p_y)},
+                            'properties': OrderedDict([
+                                ('track_id', int(track_id)),
+                                ('log_id', int(closest_point.log_id)),
+                                ('road_id', int(closest_point.road_id)),
+                                ('fraction', float(closest_point.fraction)),
+                                ('p_x', float(closest_point.p_x)),
+                                ('p_y', float(closest_point.p_y))
+                            ])
+                        })
+                if len(path_buffer) >= self.buffer_size:
+                    self.path_c.writerecords(path_buffer)
+                    path_buffer = []
+                if len(point_buffer) >= self.buffer_size:
+                    self.point_c.writerecords(point_buffer)
+                    point_buffer = []
+
+            if path_buffer:
+                self.path_c.writerecords(path_buffer)
+            if point_buffer:
+                self.point_c.writerecords(point_buffer)
+        except Exception as e:
+            self.error = e
+            # 继续取出队列中的结果， 避免write阻塞
+            while not is_finished:
+                is_finished = self.queue.get() is None
+        finally:
+            self.path_c.close()
+            if self.point_c is not None:
+                self.point_c.close()
@@ -0,0 +1,147 @@
+'''
+
+保存每条轨迹的匹配结果， 增量地重新运行
+
+每条轨迹的指纹由它的所有log、 路网的指纹和影响匹配结果的参数计算得到。 结果按track_id保存在SQLite文件中，
+再次运行时指纹相同的轨迹直接使用保存的结果， 只匹配新增或改变的轨迹。
+结果每积累config.RESULT_STORE_BATCH条提交一次， 中断的运行再次启动时已提交的轨迹不再匹配， 从中断处继续。
+
+匹配引擎、 修复方式、 路径搜索模式和后端不改变匹配结果（见benchmark.py --check）， 不计入指纹。
+
+usage:
+
+store = ResultStore(path, get_matcher_fingerprint(network_fingerprint))
+fingerprint = store.get_fingerprint(logs)
+if store.is_unchanged(track_id, fingerprint):
+    connected_vertex_path, connected_road_path, match_point_list = store.get(track_id)
+else:
+    ... 匹配 ...
+    store.put(track_id, fingerprint, connected_vertex_path, connected_road_path, match_point_list)
+store.close()
+
+get_od_path.match_tracks_incremental按这个方式匹配多条轨迹。
+
+'''
+import pickle
+import sqlite3
+import hashlib
+
+import config
+import core
+import get_dijkstra_distance
+
+
+RESULT_STORE_VERSION = 1 # 保存的结果的格式， 改变后所有轨迹重新匹配
+
+
+def get_matcher_fingerprint(network_fingerprint):
+    '''
+    路网和匹配参数的指纹
+
+    Parameters:
+    -----------
+    network_fingerprint : str
+        道路shp文件的指纹， 见RoadNetwork.fingerprint
+    '''
+    parameters = (
+        RESULT_STORE_VERSION,
+        network_fingerprint,
+        get_dijkstra_distance.MAX_DIS,
+        get_dijkstra_distance.MAX_V,
+        core.OBSERVATION_SCALE,
+        core.MAX_SPEED,
+        config.CANDIDATE_RADIUS,
+        config.CANDIDATE_MAX_RADIUS,
+        config.CANDIDATE_MAX_COUNT,
+        config.CANDIDATE_DEDUP_DISTANCE,
+        config.COMPRESS_STATIONARY_DISTANCE,
+        config.COMPRESS_STATIONARY_TIME,
+        config.COMPRESS_MIN_SPACING
+    )
+    return hashlib.sha1(repr(parameters).encode()).hexdigest()
+
+
+def get_track_fingerprint(matcher_fingerprint, logs):
+    '''
+    一条轨迹的指纹， log的任何字段或顺序改变时不同
+    '''
+    sha1 = hashlib.sha1(matcher_fingerprint.encode())
+    for log in logs:
+        sha1.update(repr(tuple(log)).encode())
+    return sha1.hexdigest()
+
+
+class ResultStore(object):
+    '''
+    按track_id保存匹配结果的SQLite文件
+
+    Parameters:
+    -----------
+    path : str
+        SQLite文件路径
+    matcher_fingerprint : str
+        get_matcher_fingerprint的返回值
+    batch_size : int
+        每保存多少条结果提交一次， 为None时使用config.RESULT_STORE_BATCH
+    '''
+
+    def __init__(self, path, matcher_fingerprint, batch_size=None):
+        self.matcher_fingerprint = matcher_fingerprint
+        self.batch_size = config.RESULT_STORE_BATCH if batch_size is None else batch_size
+        self.pending = 0 # 尚未提交的结果数
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS result ('
+                'track_key TEXT PRIMARY KEY, fingerprint TEXT, result BLOB)'
+            )
+        # track_key -> 指纹， 只读入指纹， 结果在使用时再读取
+        self.fingerprints = dict(self.connection.execute('SELECT track_key, fingerprint FROM result'))
+
+    def get_fingerprint(self, logs):
+        return get_track_fingerprint(self.matcher_fingerprint, logs)
+
+    def is_unchanged(self, track_id, fingerprint):
+        '''
+        是否保存了指纹相同的结果
+        '''
+        return self.fingerprints.get(str(track_id)) == fingerprint
+
+    def get(self, track_id):
+        '''
+        读取保存的结果
+
+        Returns:
+        ---------
+        (connected_vertex_path, connected_road_path, match_point_list)
+            没有保存时为None
+        '''
+        row = self.connection.execute('SELECT result FROM result WHERE track_key = ?', (str(track_id),)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def put(self, track_id, fingerprint, connected_vertex_path, connected_road_path, match_point_list):
+        '''
+        保存一条轨迹的结果， 匹配失败（path为None）的结果同样保存
+        '''
+        blob = pickle.dumps((connected_vertex_path, connected_road_path, match_point_list), pickle.HIGHEST_PROTOCOL)
+        self.connection.execute('INSERT OR REPLACE INTO result VALUES (?, ?, ?)', (str(track_id), fingerprint, blob))
+        self.fingerprints[str(track_id)] = fingerprint
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        '''
+        提交剩余的结果并关闭文件
+        '''
+        self.commit()
+        self.connection.close()
+
@@ -0,0 +1,314 @@
+'''
+
+用数组（CSR）存储的只读路网图
+
+节点id和道路id都被重新映射为连续的整数下标，
+查询时起点和终点的投影点作为虚拟边处理， 不会修改图本身， 可以在多线程中共享。
+
+'''
+import heapq
+
+import numpy as np
+import fiona
+
+import metrics
+
+
+class RoadGraph(object):
+    '''
+    CSR路网图
+
+    Attributes:
+    -----------
+    node_ids : np.ndarray
+        下标 -> 节点id
+    road_ids : np.ndarray
+        下标 -> 道路id
+    offsets : np.ndarray
+        节点i的出边为offsets[i]到offsets[i+1]
+    sources : np.ndarray
+        每条边的起点下标
+    targets : np.ndarray
+        每条边的终点下标
+    weights : np.ndarray
+        每条边的权重
+    edge_roads : np.ndarray
+        每条边对应的道路下标
+    node_x, node_y : np.ndarray
+        节点坐标， 未知时为nan
+    '''
+
+    def __init__(self, node_ids, road_ids, offsets, sources, targets, weights, edge_roads, node_x=None, node_y=None):
+        self.node_ids = node_ids
+        self.road_ids = road_ids
+        self.offsets = offsets
+        self.sources = sources
+        self.targets = targets
+        self.weights = weights
+        self.edge_roads = edge_roads
+        if node_x is None:
+            node_x = np.full(len(node_ids), np.nan)
+            node_y = np.full(len(node_ids), np.nan)
+        self.node_x = node_x
+        self.node_y = node_y
+
+        self.node_index = dict((int(node_id), idx) for idx, node_id in enumerate(node_ids))
+        self.reverse_csr = None
+        self.heuristic_scale = None
+
+    @classmethod
+    def from_edges(cls, edges, node_coords=None):
+        '''
+        由(road_id, source, target, weight)列表构造图
+
+        同一对(source, target)出现多次时， 保留最后一条（与nx.DiGraph.add_edge一致），
+        每个节点的出边保持第一次出现的顺序。
+
+        node_coords为节点id -> (x, y)字典， 用于A*搜索的启发函数。
+        '''
+        edge_dict = {}
+        node_index = {}
+        for road_id, source, target, weight in edges:
+            for node_id in (source, target):
+                if node_id not in node_index:
+                    node_index[node_id] = len(node_index)
+            edge_dict[(source, target)] = (road_id, weight)
+
+        node_count = len(node_index)
+        edge_count = len(edge_dict)
+
+        sources = np.empty(edge_count, dtype=np.int32)
+        targets = np.empty(edge_count, dtype=np.int32)
+        weights = np.empty(edge_count, dtype=np.float64)
+        edge_road_ids = np.empty(edge_count, dtype=np.int64)
+        for idx, ((source, target), (road_id, weight)) in enumerate(edge_dict.items()):
+            sources[idx] = node_index[source]
+            targets[idx] = node_index[target]
+            weights[idx] = weight
+            edge_road_ids[idx] = road_id
+
+        # 按起点稳定排序， 保持每个节点出边的插入顺序
+        order = np.argsort(sources, kind='stable')
+        sources = sources[order]
+        targets = targets[order]
+        weights = weights[order]
+        edge_road_ids = edge_road_ids[order]
+
+        offsets = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=node_count), out=offsets[1:])
+
+        road_ids, edge_roads = np.unique(edge_road_ids, return_inverse=True)
+
+        node_ids = np.empty(node_count, dtype=np.int64)
+        node_x = np.full(node_count, np.nan)
+        node_y = np.full(node_count, np.nan)
+        for node_id, idx in node_index.items():
+            node_ids[idx] = node_id
+            if node_coords is not None and node_id in node_coords:
+                node_x[idx], node_y[idx] = node_coords[node_id]
+
+        return cls(node_ids, road_ids, offsets, sources, targets, weights, edge_roads.astype(np.int32), node_x, node_y)
+
+    @classmethod
+    def from_shapefile(cls, shp_path):
+        '''
+        从道路shp文件构造图
+        '''
+        c = fiona.open(shp_path)
+        edges = []
+        node_coords = {}
+        for feature in c:
+            properties = feature['properties']
+            source = int(properties['source'])
+            target = int(properties['target'])
+            edges.append((int(feature['id']), source, target, float(properties['weight'])))
+            coords = feature['geometry']['coordinates']
+            node_coords[source] = coords[0][:2]
+            node_coords[target] = coords[-1][:2]
+        c.close()
+        return cls.from_edges(edges, node_coords)
+
+    def get_edge(self, source, target):
+        '''
+        获得(source, target)对应的边下标， 不存在返回None
+        '''
+        source_idx = self.node_index[source]
+        target_idx = self.node_index[target]
+        begin, end = self.offsets[source_idx], self.offsets[source_idx + 1]
+        for edge_idx in range(begin, end):
+            if self.targets[edge_idx] == target_idx:
+                return edge_idx
+        return None
+
+    def get_weight(self, source, target):
+        return self.weights[self.get_edge(source, target)]
+
+    def get_reverse_csr(self):
+        '''
+        按终点组织的入边CSR， 用于反向搜索
+
+        Returns:
+        ---------
+        (offsets, sources, weights, edges)
+            节点i的入边为edges[offsets[i]:offsets[i+1]]
+        '''
+        if self.reverse_csr is None:
+            edges = np.argsort(self.targets, kind='stable').astype(np.int32)
+            offsets = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.targets, minlength=len(self.node_ids)), out=offsets[1:])
+            self.reverse_csr = (offsets, self.sources[edges], self.weights[edges], edges)
+        return self.reverse_csr
+
+    def get_heuristic_scale(self):
+        '''
+        A*启发函数的系数: 保证每条边的权重不小于 系数 * 两端点的直线距离， 使启发函数可采纳且一致
+
+        节点坐标未知时为0， 退化为dijkstra。
+        '''
+        if self.heuristic_scale is None:
+            euclidean = np.hypot(self.node_x[self.targets] - self.node_x[self.sources], self.node_y[self.targets] - self.node_y[self.sources])
+            if np.isnan(euclidean).any():
+                self.heuristic_scale = 0.0
+            else:
+                positive = euclidean > 0
+                ratio = self.weights[positive] / euclidean[positive]
+                self.heuristic_scale = float(min(1.0, ratio.min())) if len(ratio) else 1.0
+        return self.heuristic_scale
+
+    def search(self, source_idx, source_dis, cutoff):
+        '''
+        从source_idx出发的有界dijkstra搜索
+
+        Parameters:
+        -----------
+        source_idx : int
+            起点下标
+        source_dis : float
+            起点的初始距离（起点为虚拟点时， 为虚拟点到source_idx的距离）
+        cutoff : float
+            超过cutoff的节点不再扩展
+
+        Returns:
+        ---------
+        dist : dict
+            节点下标 -> 距离
+        pred : dict
+            节点下标 -> 最短路径上进入该节点的边下标， 起点为None
+        '''
+        offsets = self.offsets
+        targets = self.targets
+        weights = self.weights
+
+        dist = {}
+        seen = {source_idx: source_dis}
+        pred = {source_idx: None}
+        heap = []
+        if source_dis <= cutoff:
+            heap.append((source_dis, source_idx))
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in dist:
+                continue
+            dist[u] = d
+            begin = offsets[u]
+            end = offsets[u + 1]
+            for edge_idx, v, weight in zip(range(begin, end), targets[begin:end].tolist(), weights[begin:end].tolist()):
+                vu_dist = d + weight
+                if vu_dist > cutoff:
+                    continue
+                if v not in seen or vu_dist < seen[v]:
+                    seen[v] = vu_dist
+                    pred[v] = edge_idx
+                    heapq.heappush(heap, (vu_dist, v))
+        if metrics.ENABLED:
+            metrics.count('nodes_settled', len(dist))
+        return dist, pred
+
+    def get_search_source(self, closest_point):
+        '''
+        获得候选点作为起点时， 搜索开始的节点下标和初始距离
+        '''
+        if closest_point.fraction == 0:
+            return self.node_index[closest_point.source], 0, False
+        elif closest_point.fraction == 1:
+            return self.node_index[closest_point.target], 0, False
+        else:
+            return self.node_index[closest_point.target], (1 - closest_point.fraction) * closest_point.weight, True
+
+    def get_search_target(self, closest_point):
+        '''
+        获得候选点作为终点时， 需要到达的节点下标和从该节点到候选点的距离
+        '''
+        if closest_point.fraction == 1:
+            return self.node_index[closest_point.target], 0, False
+        elif closest_point.fraction == 0:
+            return self.node_index[closest_point.source], 0, False
+        else:
+            return self.node_index[closest_point.source], closest_point.fraction * closest_point.weight, True
+
+    def get_path(self, pred, node_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target):
+        '''
+        由pred得到vertex path和road path， 格式与get_dijkstra_distance保存到缓存中的一致
+        '''
+        vertex_path = []
+        edge_path = []
+        while pred[node_idx] is not None:
+            edge_idx = pred[node_idx]
+            vertex_path.append(int(self.node_ids[node_idx]))
+            edge_path.append(edge_idx)
+            node_idx = self.sources[edge_idx]
+        vertex_path.append(int(self.node_ids[node_idx]))
+        vertex_path.reverse()
+        edge_path.reverse()
+
+        road_path = ['x']
+        if is_virtual_source:
+            vertex_path.insert(0, 'a')
+            road_path.append(pre_closest_point.road_id)
+        for edge_idx in edge_path:
+            road_id = int(self.road_ids[self.edge_roads[edge_idx]])
+            if road_id != road_path[-1]:
+                road_path.append(road_id)
+        if is_virtual_target:
+            vertex_path.append('b')
+            if now_closest_point.road_id != road_path[-1]:
+                road_path.append(now_closest_point.road_id)
+        return vertex_path, road_path[1:]
+
+    def shortest_paths(self, pre_closest_point, now_closest_points, cutoff, max_dis, with_path=True):
+        '''
+        获得一个候选点到多个候选点的最短路径
+
+        不处理起点和终点在同一条道路上的情况， 这种情况由调用者处理。
+
+        Parameters:
+        -----------
+        with_path : bool
+            为False时只计算距离， vertex_path和road_path为None
+
+        Returns:
+        ---------
+        result_list : list
+            (distance, vertex_path, road_path)列表， 不可达为(max_dis, None, None)
+        '''
+        source_idx, source_dis, is_virtual_source = self.get_search_source(pre_closest_point)
+        dist, pred = self.search(source_idx, source_dis, cutoff)
+
+        result_list = []
+        for now_closest_point in now_closest_points:
+            target_idx, target_dis, is_virtual_target = self.get_search_target(now_closest_point)
+            if target_idx not in dist or dist[target_idx] + target_dis > cutoff:
+                result_list.append((max_dis, None, None))
+                continue
+            if not with_path:
+                result_list.append((dist[target_idx] + target_dis, None, None))
+                continue
+            vertex_path, road_path = self.get_path(pred, target_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target)
+            result_list.append((dist[target_idx] + target_dis, vertex_path, road_path))
+        return result_list
+
+    def shortest_path(self, pre_closest_point, now_closest_point, cutoff, max_dis, with_path=True):
+        '''
+        获得两个候选点之间的最短路径， 见shortest_paths
+        '''
+        return self.shortest_paths(pre_closest_point, [now_closest_point], cutoff, max_dis, with_path)[0]
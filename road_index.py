@@ -0,0 +1,398 @@
+'''
+
+用numpy实现的道路线段网格索引， 批量获得一条轨迹所有gps log的候选点
+
+所有道路被拆分为线段， 按线段的外包矩形登记到规则网格中。
+查询时一次性计算所有log周围网格中的线段， 用向量化的点到线段距离代替buffer + intersects，
+每条道路取距离最近的线段上的投影点， 得到fraction和投影坐标， 结果保存为列式的CandidateStore（见candidates.py）。
+
+'''
+import math
+
+import numpy as np
+import fiona
+
+import config
+import metrics
+from candidates import CandidateStore
+
+
+# 由道路坐标计算得到的线段和网格数组， 与get_grid的网格参数一起保存在路网快照中（见road_network.py）
+INDEX_ARRAY_NAMES = ['seg_x0', 'seg_y0', 'seg_x1', 'seg_y1', 'seg_roads', 'seg_begins', 'road_last_seg', 'road_lengths', 'cell_keys', 'cell_segs']
+
+
+class RoadSegmentIndex(object):
+    '''
+    道路线段网格索引
+
+    Attributes:
+    -----------
+    road_ids, road_sources, road_targets, road_weights : np.ndarray
+        道路下标 -> 道路id, source, target, weight
+    road_lengths : np.ndarray
+        道路几何长度， 用于计算fraction
+    seg_x0, seg_y0, seg_x1, seg_y1 : np.ndarray
+        线段端点坐标
+    seg_roads : np.ndarray
+        线段所属的道路下标
+    seg_begins : np.ndarray
+        线段起点到道路起点的长度
+    cell_keys, cell_segs : np.ndarray
+        按网格编号排序的(网格编号, 线段下标)
+    '''
+
+    def __init__(self, road_ids, road_sources, road_targets, road_weights, coords, coord_offsets, cell_size=100):
+        self.road_ids = road_ids
+        self.road_sources = road_sources
+        self.road_targets = road_targets
+        self.road_weights = road_weights
+        self.cell_size = cell_size
+
+        # 每条道路的第i个坐标到第i+1个坐标为一条线段， 跳过每条道路最后一个坐标
+        road_count = len(road_ids)
+        is_seg_start = np.ones(len(coords), dtype=bool)
+        is_seg_start[coord_offsets[1:] - 1] = False
+        seg_starts = np.nonzero(is_seg_start)[0]
+        self.seg_x0 = coords[seg_starts, 0]
+        self.seg_y0 = coords[seg_starts, 1]
+        self.seg_x1 = coords[seg_starts + 1, 0]
+        self.seg_y1 = coords[seg_starts + 1, 1]
+        self.seg_roads = np.repeat(np.arange(road_count, dtype=np.int32), np.diff(coord_offsets) - 1)
+
+        seg_lengths = np.hypot(self.seg_x1 - self.seg_x0, self.seg_y1 - self.seg_y0)
+        cum_lengths = np.cumsum(seg_lengths) - seg_lengths
+        road_first_seg = np.searchsorted(self.seg_roads, np.arange(road_count))
+        self.road_last_seg = np.searchsorted(self.seg_roads, np.arange(road_count), 'right') - 1
+        self.seg_begins = cum_lengths - cum_lengths[road_first_seg][self.seg_roads]
+        self.road_lengths = np.bincount(self.seg_roads, weights=seg_lengths, minlength=road_count)
+
+        # 网格
+        self.min_x = min(self.seg_x0.min(), self.seg_x1.min())
+        self.min_y = min(self.seg_y0.min(), self.seg_y1.min())
+        self.grid_x = int((max(self.seg_x0.max(), self.seg_x1.max()) - self.min_x) // cell_size) + 1
+        self.grid_y = int((max(self.seg_y0.max(), self.seg_y1.max()) - self.min_y) // cell_size) + 1
+
+        cx0, cy0 = self.get_cell(np.minimum(self.seg_x0, self.seg_x1), np.minimum(self.seg_y0, self.seg_y1))
+        cx1, cy1 = self.get_cell(np.maximum(self.seg_x0, self.seg_x1), np.maximum(self.seg_y0, self.seg_y1))
+        width_y = cy1 - cy0 + 1
+        cell_counts = (cx1 - cx0 + 1) * width_y
+        cell_segs = np.repeat(np.arange(len(seg_starts), dtype=np.int32), cell_counts)
+        local = np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        cell_keys = self.get_cell_key(cx0[cell_segs] + local // width_y[cell_segs], cy0[cell_segs] + local % width_y[cell_segs])
+
+        order = np.argsort(cell_keys, kind='stable')
+        self.cell_keys = cell_keys[order]
+        self.cell_segs = cell_segs[order]
+
+    @classmethod
+    def from_shapefile(cls, shp_path, cell_size=100):
+        '''
+        从道路shp文件构造索引
+        '''
+        c = fiona.open(shp_path)
+        road_ids = []
+        road_sources = []
+        road_targets = []
+        road_weights = []
+        coord_list = []
+        coord_offsets = [0]
+        for feature in c:
+            properties = feature['properties']
+            road_ids.append(int(feature['id']))
+            road_sources.append(properties['source'])
+            road_targets.append(properties['target'])
+            road_weights.append(properties['weight'])
+            coords = feature['geometry']['coordinates']
+            coord_list.extend(coord[:2] for coord in coords)
+            coord_offsets.append(len(coord_list))
+        c.close()
+        return cls(
+            np.array(road_ids, dtype=np.int64),
+            np.array(road_sources, dtype=np.int64),
+            np.array(road_targets, dtype=np.int64),
+            np.array(road_weights, dtype=np.float64),
+            np.array(coord_list, dtype=np.float64),
+            np.array(coord_offsets, dtype=np.int64),
+            cell_size
+        )
+
+    @classmethod
+    def from_arrays(cls, road_ids, road_sources, road_targets, road_weights, index_arrays, grid):
+        '''
+        由保存的线段和网格数组恢复索引， 不再重新计算
+
+        Parameters:
+        -----------
+        index_arrays : dict
+            INDEX_ARRAY_NAMES中的数组
+        grid : dict
+            get_grid的返回值
+        '''
+        road_index = cls.__new__(cls)
+        road_index.road_ids = road_ids
+        road_index.road_sources = road_sources
+        road_index.road_targets = road_targets
+        road_index.road_weights = road_weights
+        for name in INDEX_ARRAY_NAMES:
+            setattr(road_index, name, index_arrays[name])
+        for name, value in grid.items():
+            setattr(road_index, name, value)
+        return road_index
+
+    def get_grid(self):
+        '''
+        网格参数， 可以保存为json
+        '''
+        return {
+            'cell_size': self.cell_size,
+            'min_x': float(self.min_x),
+            'min_y': float(self.min_y),
+            'grid_x': self.grid_x,
+            'grid_y': self.grid_y
+        }
+
+    def get_cell(self, x, y):
+        '''
+        坐标所在的网格， 网格范围外的坐标归到边界外一圈的网格
+        '''
+        cx = np.clip(np.floor((x - self.min_x) / self.cell_size), -1, self.grid_x).astype(np.int64)
+        cy = np.clip(np.floor((y - self.min_y) / self.cell_size), -1, self.grid_y).astype(np.int64)
+        return cx, cy
+
+    def get_cell_key(self, cx, cy):
+        return (cx + 1) * (self.grid_y + 2) + (cy + 1)
+
+    def query(self, xs, ys, radius=30):
+        '''
+        批量获得所有点在radius范围内的道路投影点
+
+        Parameters:
+        -----------
+        xs, ys : np.ndarray
+            gps log坐标
+        radius : float
+            搜索半径
+
+        Returns:
+        ---------
+        (point_idx, road_idx, fraction, p_x, p_y, distance)
+            每个(点, 道路)一条记录， 按点和道路下标排序
+        '''
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+
+        # 点周围(2r+1) * (2r+1)个网格
+        r = int(np.ceil(radius / self.cell_size))
+        offset_x, offset_y = np.meshgrid(np.arange(-r, r + 1), np.arange(-r, r + 1))
+        cx, cy = self.get_cell(xs, ys)
+        key_points = np.repeat(np.arange(len(xs)), offset_x.size)
+        keys = self.get_cell_key(
+            np.clip(cx[:, None] + offset_x.ravel(), -1, self.grid_x).ravel(),
+            np.clip(cy[:, None] + offset_y.ravel(), -1, self.grid_y).ravel()
+        )
+
+        # 展开每个网格中的线段， 同一线段可能登记在多个网格中， 去重
+        begins = np.searchsorted(self.cell_keys, keys, 'left')
+        counts = np.searchsorted(self.cell_keys, keys, 'right') - begins
+        point_idx = np.repeat(key_points, counts)
+        seg_idx = self.cell_segs[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(begins, counts)]
+        pair_keys = np.unique(point_idx * len(self.seg_roads) + seg_idx)
+        point_idx = pair_keys // len(self.seg_roads)
+        seg_idx = pair_keys % len(self.seg_roads)
+
+        # 点到线段的距离
+        x0 = self.seg_x0[seg_idx]
+        y0 = self.seg_y0[seg_idx]
+        dx = self.seg_x1[seg_idx] - x0
+        dy = self.seg_y1[seg_idx] - y0
+        px = xs[point_idx]
+        py = ys[point_idx]
+        seg_length2 = dx * dx + dy * dy
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(seg_length2 > 0, ((px - x0) * dx + (py - y0) * dy) / seg_length2, 0)
+        t = np.clip(t, 0, 1)
+        p_x = x0 + t * dx
+        p_y = y0 + t * dy
+        distance = np.hypot(px - p_x, py - p_y)
+
+        within = distance <= radius
+        point_idx = point_idx[within]
+        seg_idx = seg_idx[within]
+        t = t[within]
+        p_x = p_x[within]
+        p_y = p_y[within]
+        distance = distance[within]
+        road_idx = self.seg_roads[seg_idx]
+
+        # 每个(点, 道路)取距离最近的线段
+        order = np.lexsort((distance, road_idx, point_idx))
+        point_idx = point_idx[order]
+        road_idx = road_idx[order]
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = (point_idx[1:] != point_idx[:-1]) | (road_idx[1:] != road_idx[:-1])
+        order = order[is_first]
+        point_idx = point_idx[is_first]
+        road_idx = road_idx[is_first]
+        seg_idx = seg_idx[order]
+
+        t = t[order]
+
+        road_lengths = self.road_lengths[road_idx]
+        along = self.seg_begins[seg_idx] + t * np.hypot(dx[within][order], dy[within][order])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(road_lengths > 0, np.minimum(along / road_lengths, 1), 0)
+        # 投影到道路终点时fraction严格为1， 路径搜索中fraction为0和1有特殊处理
+        fraction[(t == 1) & (seg_idx == self.road_last_seg[road_idx])] = 1
+
+        return point_idx, road_idx, fraction, p_x[order], p_y[order], distance[order]
+
+
+def query_adaptive(road_index, xs, ys, radius, max_radius):
+    '''
+    半径内没有道路的点加倍半径重新搜索， 直到找到道路或者达到max_radius
+
+    Returns:
+    ---------
+    (point_idx, road_idx, fraction, p_x, p_y, distance, widened)
+        同RoadSegmentIndex.query， widened为扩大过半径的点数
+    '''
+    result = road_index.query(xs, ys, radius)
+    missing = np.setdiff1d(np.arange(len(xs)), result[0])
+    widened = len(missing) if radius < max_radius else 0
+    while len(missing) > 0 and radius < max_radius:
+        radius = min(radius * 2, max_radius)
+        more = road_index.query(xs[missing], ys[missing], radius)
+        result = [np.concatenate([a, b]) for a, b in zip(result, (missing[more[0]],) + more[1:])]
+        missing = np.setdiff1d(missing, missing[more[0]])
+    if widened == 0:
+        return tuple(result) + (0,)
+
+    order = np.lexsort((result[1], result[0]))
+    return tuple(a[order] for a in result) + (widened,)
+
+
+def prune_candidates(road_index, point_idx, road_idx, p_x, p_y, distance, max_count=None, dedup_distance=0):
+    '''
+    候选点剪枝
+
+    观察概率随投影距离单调递减， 所以按距离从近到远排序后:
+    1. 同一个log的候选点中， 所在道路相连（有公共节点， 但不是同一对节点之间的相反方向）
+       并且投影点距离不超过dedup_distance的， 只保留观察概率最大的一个， 例如路口处相邻道路的首尾；
+    2. 每个log最多保留max_count个观察概率最大的候选点。
+
+    Parameters:
+    -----------
+    point_idx, road_idx, p_x, p_y, distance : np.ndarray
+        RoadSegmentIndex.query的结果
+    max_count : int
+        为None时不限制数量
+    dedup_distance : float
+        为0时不合并
+
+    Returns:
+    ---------
+    (keep, deduped, truncated)
+        保留的记录的布尔数组， 合并掉和因数量限制去掉的候选点数
+    '''
+    keep = np.ones(len(point_idx), dtype=bool)
+    order = np.lexsort((distance, point_idx))
+    sorted_points = point_idx[order]
+    deduped = 0
+    if dedup_distance > 0:
+        sources = road_index.road_sources[road_idx].tolist()
+        targets = road_index.road_targets[road_idx].tolist()
+        xs = p_x.tolist()
+        ys = p_y.tolist()
+        group_begins = np.flatnonzero(np.r_[True, sorted_points[1:] != sorted_points[:-1]]).tolist() + [len(order)]
+        for begin, end in zip(group_begins[:-1], group_begins[1:]):
+            kept = []
+            for i in order[begin:end].tolist():
+                nodes = set((sources[i], targets[i]))
+                for j in kept:
+                    other_nodes = set((sources[j], targets[j]))
+                    if nodes == other_nodes or not nodes & other_nodes:
+                        continue
+                    if math.hypot(xs[i] - xs[j], ys[i] - ys[j]) <= dedup_distance:
+                        keep[i] = False
+                        deduped += 1
+                        break
+                else:
+                    kept.append(i)
+
+    truncated = 0
+    if max_count is not None:
+        # 剩余候选点在各自log中按距离的排名
+        order = order[keep[order]]
+        sorted_points = point_idx[order]
+        group_begins = np.r_[0, np.flatnonzero(sorted_points[1:] != sorted_points[:-1]) + 1]
+        rank = np.arange(len(order)) - np.repeat(group_begins, np.diff(np.r_[group_begins, len(order)]))
+        truncated = int((rank >= max_count).sum())
+        keep[order[rank >= max_count]] = False
+    return keep, deduped, truncated
+
+
+def get_track_candidates(logs, road_index, radius=None, max_radius=None, max_count=None, dedup_distance=None):
+    '''
+    一次获得一条轨迹所有log在路网中的投影点
+
+    参数为None时使用config中的CANDIDATE_*设置。 每个log的候选点为与它的距离不超过radius的每条道路上最近的投影点。
+
+    Parameters:
+    -----------
+    logs : list
+        TrackRec列表
+    road_index : RoadSegmentIndex
+        道路线段索引
+    radius : float
+        搜索半径
+    max_radius : float
+        没有候选点时扩大到的最大搜索半径
+    max_count : int
+        每个log最多保留的候选点数
+    dedup_distance : float
+        合并相连道路上的相近候选点的距离
+
+    Returns:
+    ---------
+    candidates : CandidateStore
+        每个log的候选点按道路在索引中的顺序排列， 找不到候选点的log候选点数为0
+    '''
+    radius = config.CANDIDATE_RADIUS if radius is None else radius
+    max_radius = config.CANDIDATE_MAX_RADIUS if max_radius is None else max_radius
+    max_count = config.CANDIDATE_MAX_COUNT if max_count is None else max_count
+    dedup_distance = config.CANDIDATE_DEDUP_DISTANCE if dedup_distance is None else dedup_distance
+
+    xs = np.array([log.x for log in logs], dtype=np.float64)
+    ys = np.array([log.y for log in logs], dtype=np.float64)
+    point_idx, road_idx, fraction, p_x, p_y, distance, widened = query_adaptive(road_index, xs, ys, radius, max(radius, max_radius))
+    raw_count = len(point_idx)
+    if max_count is not None or dedup_distance > 0:
+        keep, deduped, truncated = prune_candidates(road_index, point_idx, road_idx, p_x, p_y, distance, max_count, dedup_distance)
+        point_idx, road_idx, fraction, p_x, p_y = point_idx[keep], road_idx[keep], fraction[keep], p_x[keep], p_y[keep]
+    else:
+        deduped, truncated = 0, 0
+
+    # 记录按log和道路下标排序， 每个log的候选点连续
+    counts = np.bincount(point_idx, minlength=len(logs))
+    if metrics.ENABLED:
+        metrics.count('candidates_raw', raw_count)
+        metrics.count('candidates_deduped', deduped)
+        metrics.count('candidates_truncated', truncated)
+        metrics.count('radius_widened', widened)
+        metrics.count('logs_without_candidates', int((counts == 0).sum()))
+        metrics.maximum('candidates_max', int(counts.max()) if len(counts) > 0 else 0)
+
+    offsets = np.r_[0, np.cumsum(counts)].astype(np.int64)
+    return CandidateStore(logs, offsets, road_idx, fraction, p_x, p_y, road_index)
+
+
+def get_track_closest_points(logs, road_index, radius=None, max_radius=None, max_count=None, dedup_distance=None):
+    '''
+    与get_track_candidates相同， 结果为字典视图
+
+    Returns:
+    ---------
+    log_closest_points : CandidatePointView
+        每个log和它对应的closest_points列表， 找不到候选点的log对应空列表
+    '''
+    return get_track_candidates(logs, road_index, radius, max_radius, max_count, dedup_distance).points
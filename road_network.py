@@ -0,0 +1,318 @@
+'''
+
+一次读取道路shp文件， 同时构造路网图（RoadGraph）、 道路线段索引（RoadSegmentIndex）和道路几何
+
+读取结果保存为道路shp文件旁边的快照目录（connected_road.snapshot/）， 每个数组一个npy文件，
+道路线段索引的网格也一起保存， 之后的运行直接以mmap方式打开， 不再解析shp文件， 也不再计算网格。
+shp文件改变或快照格式版本改变时自动重新生成。
+
+usage:
+
+python road_network.py ./shp/input/connected_road.shp
+
+'''
+import os
+import json
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import fiona
+
+from road_graph import RoadGraph
+from road_index import RoadSegmentIndex, INDEX_ARRAY_NAMES
+from cache import get_shapefile_fingerprint
+
+
+SNAPSHOT_VERSION = 2
+
+# 道路数组（按shp文件中要素的顺序）和RoadGraph的数组
+ROAD_ARRAY_NAMES = ['road_ids', 'road_sources', 'road_targets', 'road_weights', 'coords', 'coord_offsets']
+GRAPH_ARRAY_NAMES = ['node_ids', 'road_ids', 'offsets', 'sources', 'targets', 'weights', 'edge_roads', 'node_x', 'node_y']
+
+
+class RoadNetwork(object):
+    '''
+    匹配需要的全部路网数据
+
+    Attributes:
+    -----------
+    road_graph : RoadGraph
+        路网图
+    road_index : RoadSegmentIndex
+        道路线段索引
+    road_ids, road_sources, road_targets, road_weights : np.ndarray
+        道路下标 -> 道路id, source, target, weight
+    coords, coord_offsets : np.ndarray
+        道路i的坐标为coords[coord_offsets[i]:coord_offsets[i+1]]
+    fingerprint : str
+        道路shp文件的指纹
+
+    Parameters:
+    -----------
+    road_index : RoadSegmentIndex
+        从快照恢复的道路线段索引， 为None时由道路数组计算
+    '''
+
+    def __init__(self, road_arrays, road_graph, fingerprint, cell_size=100, road_index=None):
+        self.road_ids = road_arrays['road_ids']
+        self.road_sources = road_arrays['road_sources']
+        self.road_targets = road_arrays['road_targets']
+        self.road_weights = road_arrays['road_weights']
+        self.coords = road_arrays['coords']
+        self.coord_offsets = road_arrays['coord_offsets']
+        self.road_graph = road_graph
+        if road_index is None:
+            road_index = RoadSegmentIndex(
+                self.road_ids, self.road_sources, self.road_targets, self.road_weights, self.coords, self.coord_offsets, cell_size
+            )
+        self.road_index = road_index
+        self.fingerprint = fingerprint
+        self.road_id_idx = None
+
+    def get_geometry(self, road_id):
+        '''
+        道路的GeoJSON几何， 与fiona读出的feature['geometry']格式相同
+        '''
+        if self.road_id_idx is None:
+            self.road_id_idx = dict((int(road_id), idx) for idx, road_id in enumerate(self.road_ids))
+        idx = self.road_id_idx[road_id]
+        coords = self.coords[self.coord_offsets[idx]:self.coord_offsets[idx + 1]]
+        return {'type': 'LineString', 'coordinates': [tuple(coord) for coord in coords.tolist()]}
+
+
+def get_snapshot_path(shp_path):
+    '''
+    快照目录与道路shp文件放在同一目录下
+    '''
+    return os.path.splitext(shp_path)[0] + '.snapshot'
+
+
+def get_shapefile_stat(shp_path):
+    '''
+    道路shp文件（及同名的shx、 dbf文件）的大小和修改时间， 用于快速判断文件是否改变
+    '''
+    stat_list = []
+    base_path = os.path.splitext(shp_path)[0]
+    for ext in ['.shp', '.shx', '.dbf']:
+        path = base_path + ext
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stat_list.append([ext, stat.st_size, stat.st_mtime_ns])
+    return stat_list
+
+
+def read_road_arrays(shp_path):
+    '''
+    一次读取道路shp文件
+
+    Returns:
+    ---------
+    (road_arrays, road_graph)
+        道路数组字典和路网图
+    '''
+    c = fiona.open(shp_path)
+    road_ids = []
+    road_sources = []
+    road_targets = []
+    road_weights = []
+    coord_list = []
+    coord_offsets = [0]
+    edges = []
+    node_coords = {}
+    for feature in c:
+        properties = feature['properties']
+        road_id = int(feature['id'])
+        source = int(properties['source'])
+        target = int(properties['target'])
+        weight = float(properties['weight'])
+        coords = feature['geometry']['coordinates']
+
+        road_ids.append(road_id)
+        road_sources.append(source)
+        road_targets.append(target)
+        road_weights.append(weight)
+        coord_list.extend(coord[:2] for coord in coords)
+        coord_offsets.append(len(coord_list))
+
+        edges.append((road_id, source, target, weight))
+        node_coords[source] = coords[0][:2]
+        node_coords[target] = coords[-1][:2]
+    c.close()
+
+    road_arrays = {
+        'road_ids': np.array(road_ids, dtype=np.int64),
+        'road_sources': np.array(road_sources, dtype=np.int64),
+        'road_targets': np.array(road_targets, dtype=np.int64),
+        'road_weights': np.array(road_weights, dtype=np.float64),
+        'coords': np.array(coord_list, dtype=np.float64).reshape(-1, 2),
+        'coord_offsets': np.array(coord_offsets, dtype=np.int64),
+    }
+    return road_arrays, RoadGraph.from_edges(edges, node_coords)
+
+
+def save_snapshot(snapshot_path, road_arrays, road_graph, road_index, meta):
+    '''
+    写入快照
+
+    先写到同一目录下唯一的临时目录， 再用os.replace换到snapshot_path， 读者不会看到写了一半的快照。
+    多个进程同时生成时， 已经存在版本和指纹相同的快照则直接使用它；
+    旧的快照先换到另一个临时目录再删除， 已经打开它的进程仍然可以使用mmap的数据。
+    '''
+    parent_dir = os.path.dirname(os.path.abspath(snapshot_path))
+    prefix = os.path.basename(snapshot_path) + '.'
+    tmp_path = tempfile.mkdtemp(prefix=prefix, dir=parent_dir)
+    for name in ROAD_ARRAY_NAMES:
+        np.save(os.path.join(tmp_path, '{}.npy'.format(name)), road_arrays[name])
+    for name in GRAPH_ARRAY_NAMES:
+        np.save(os.path.join(tmp_path, 'graph_{}.npy'.format(name)), getattr(road_graph, name))
+    for name in INDEX_ARRAY_NAMES:
+        np.save(os.path.join(tmp_path, 'index_{}.npy'.format(name)), getattr(road_index, name))
+    meta = dict(meta, grid=road_index.get_grid())
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    while True:
+        try:
+            os.replace(tmp_path, snapshot_path)
+            return
+        except OSError:
+            # snapshot_path是非空目录
+            pass
+        old_meta = read_snapshot_meta(snapshot_path)
+        if old_meta is not None and old_meta['version'] == meta['version'] and old_meta['fingerprint'] == meta['fingerprint']:
+            shutil.rmtree(tmp_path)
+            return
+        old_path = tempfile.mkdtemp(prefix=prefix, dir=parent_dir)
+        try:
+            os.replace(snapshot_path, old_path)
+        except OSError:
+            # 其他进程已经换走了旧的快照
+            os.rmdir(old_path)
+            continue
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def read_snapshot_meta(snapshot_path):
+    meta_path = os.path.join(snapshot_path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def write_snapshot_meta(snapshot_path, meta):
+    '''
+    替换快照的meta.json， 先写临时文件再os.replace
+    '''
+    fd, tmp_path = tempfile.mkstemp(prefix='meta.', dir=snapshot_path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(snapshot_path, 'meta.json'))
+
+
+def load_snapshot(snapshot_path, meta, cell_size=100, mmap_mode='r'):
+    '''
+    打开快照
+
+    Parameters:
+    -----------
+    meta : dict
+        read_snapshot_meta的返回值
+    cell_size : int
+        与快照中的网格大小不同时重新计算道路线段索引
+
+    Returns:
+    ---------
+    (road_arrays, road_graph, road_index)
+    '''
+    def load(file_name):
+        # np.memmap的下标访问比np.ndarray慢， 转为共享同一块内存的np.ndarray
+        return np.asarray(np.load(os.path.join(snapshot_path, file_name), mmap_mode=mmap_mode))
+
+    road_arrays = dict((name, load('{}.npy'.format(name))) for name in ROAD_ARRAY_NAMES)
+    road_graph = RoadGraph(*[load('graph_{}.npy'.format(name)) for name in GRAPH_ARRAY_NAMES])
+    road_index = None
+    if meta['grid']['cell_size'] == cell_size:
+        road_index = RoadSegmentIndex.from_arrays(
+            road_arrays['road_ids'], road_arrays['road_sources'], road_arrays['road_targets'], road_arrays['road_weights'],
+            dict((name, load('index_{}.npy'.format(name))) for name in INDEX_ARRAY_NAMES),
+            meta['grid']
+        )
+    return road_arrays, road_graph, road_index
+
+
+def build_snapshot(shp_path, snapshot_path=None, cell_size=100):
+    '''
+    读取道路shp文件并生成快照
+
+    Returns:
+    ---------
+    (road_arrays, road_graph, road_index, fingerprint)
+    '''
+    if snapshot_path is None:
+        snapshot_path = get_snapshot_path(shp_path)
+    stat = get_shapefile_stat(shp_path)
+    fingerprint = get_shapefile_fingerprint(shp_path)
+    road_arrays, road_graph = read_road_arrays(shp_path)
+    road_index = RoadSegmentIndex(
+        road_arrays['road_ids'], road_arrays['road_sources'], road_arrays['road_targets'], road_arrays['road_weights'],
+        road_arrays['coords'], road_arrays['coord_offsets'], cell_size
+    )
+    save_snapshot(snapshot_path, road_arrays, road_graph, road_index, {
+        'version': SNAPSHOT_VERSION,
+        'fingerprint': fingerprint,
+        'stat': stat
+    })
+    print('build road snapshot: {}'.format(snapshot_path))
+    return road_arrays, road_graph, road_index, fingerprint
+
+
+def load_road_network(shp_path, use_snapshot=True, cell_size=100):
+    '''
+    加载路网
+
+    use_snapshot为True时优先打开快照: 快照不存在、 版本不同或者shp文件改变时重新生成。
+    shp文件的大小和修改时间与快照记录的相同时直接使用快照， 否则比较文件内容的指纹。
+
+    Parameters:
+    -----------
+    shp_path : str
+        道路shp文件
+    use_snapshot : bool
+        为False时直接读取shp文件， 不读写快照
+
+    Returns:
+    ---------
+    road_network : RoadNetwork
+    '''
+    if not use_snapshot:
+        road_arrays, road_graph = read_road_arrays(shp_path)
+        return RoadNetwork(road_arrays, road_graph, get_shapefile_fingerprint(shp_path), cell_size)
+
+    snapshot_path = get_snapshot_path(shp_path)
+    meta = read_snapshot_meta(snapshot_path)
+    if meta is not None and meta['version'] == SNAPSHOT_VERSION:
+        stat = get_shapefile_stat(shp_path)
+        if meta['stat'] == stat:
+            road_arrays, road_graph, road_index = load_snapshot(snapshot_path, meta, cell_size)
+            return RoadNetwork(road_arrays, road_graph, meta['fingerprint'], cell_size, road_index)
+        fingerprint = get_shapefile_fingerprint(shp_path)
+        if meta['fingerprint'] == fingerprint:
+            # 文件被touch或复制， 内容没有改变， 只更新记录的大小和修改时间
+            meta['stat'] = stat
+            write_snapshot_meta(snapshot_path, meta)
+            road_arrays, road_graph, road_index = load_snapshot(snapshot_path, meta, cell_size)
+            return RoadNetwork(road_arrays, road_graph, fingerprint, cell_size, road_index)
+
+    road_arrays, road_graph, road_index, fingerprint = build_snapshot(shp_path, snapshot_path, cell_size)
+    return RoadNetwork(road_arrays, road_graph, fingerprint, cell_size, road_index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build road network snapshot')
+    parser.add_argument('shp_path', nargs='?', default='./shp/input/connected_road.shp')
+    args = parser.parse_args()
+
+    build_snapshot(args.shp_path)
@@ -0,0 +1,127 @@
+'''
+
+匹配前压缩轨迹
+
+车辆停在场站、 路口时每隔几秒上报一次， 这些log的候选点几乎相同， 却各自占用一层动态规划和k*k次路径搜索。
+匹配前按顺序扫描一条轨迹， 与上一个保留的log比较:
+1. 距离不超过stationary_distance并且时间间隔不超过stationary_time的log视为静止， 删除；
+2. 距离小于min_spacing的log视为过密， 删除。
+第一个和最后一个log总是保留。 每个被删除的log归属于它之前最近的保留log。
+
+匹配后把被删除的log映射回匹配结果: 静止的log使用所属保留log的匹配道路和fraction；
+过密的log投影到所属保留log或下一个匹配点的道路上， 都不在候选范围内时使用所属保留log的匹配结果。
+所属保留log在匹配中被删除（断裂处）时， 归属于它的log也不输出。
+
+usage:
+
+kept_logs, removed = compress_track(logs, 5, 60, 0)
+... 匹配kept_logs得到match_point_list ...
+match_point_list = expand_match_points(match_point_list, removed, road_index)
+
+'''
+import math
+from collections import namedtuple, OrderedDict
+
+from road_index import get_track_closest_points
+
+
+# log: 被删除的TrackRec, is_stationary: 是否因静止被删除（否则为过密）
+RemovedLog = namedtuple('RemovedLog', ['log', 'is_stationary'])
+
+
+def compress_track(logs, stationary_distance=0, stationary_time=60, min_spacing=0):
+    '''
+    删除静止和过密的log
+
+    Parameters:
+    -----------
+    logs : list
+        一条轨迹的TrackRec列表， 按时间排序
+    stationary_distance : float
+        为0时不删除静止的log
+    stationary_time : float
+        静止的log与保留log的最大时间间隔（秒）， 停留更久时每隔这么长时间保留一个log
+    min_spacing : float
+        为0时不删除过密的log
+
+    Returns:
+    ---------
+    (kept_logs, removed)
+        保留的TrackRec列表， 保留log的uuid -> 归属于它的RemovedLog列表
+    '''
+    removed = OrderedDict()
+    if len(logs) <= 2 or (stationary_distance <= 0 and min_spacing <= 0):
+        return list(logs), removed
+
+    kept_logs = [logs[0]]
+    for log in logs[1:-1]:
+        anchor = kept_logs[-1]
+        distance = math.hypot(log.x - anchor.x, log.y - anchor.y)
+        if distance <= stationary_distance and (log.log_time - anchor.log_time).total_seconds() <= stationary_time:
+            removed.setdefault(anchor.uuid, []).append(RemovedLog(log, True))
+        elif distance < min_spacing:
+            removed.setdefault(anchor.uuid, []).append(RemovedLog(log, False))
+        else:
+            kept_logs.append(log)
+    kept_logs.append(logs[-1])
+    return kept_logs, removed
+
+
+def get_removed_point(removed_log, match_point, next_match_point, closest_points):
+    '''
+    被删除的log的匹配结果
+
+    Parameters:
+    -----------
+    removed_log : RemovedLog
+    match_point : CPointRec
+        所属保留log的匹配结果
+    next_match_point : CPointRec
+        下一个匹配点， 没有时为None
+    closest_points : list
+        被删除的log的候选点
+
+    Returns:
+    ---------
+    closest_point : CPointRec
+        log相关的字段为被删除的log的值
+    '''
+    log = removed_log.log
+    if not removed_log.is_stationary:
+        road_ids = set([match_point.road_id] if next_match_point is None else [match_point.road_id, next_match_point.road_id])
+        on_path = [closest_point for closest_point in closest_points if closest_point.road_id in road_ids]
+        if on_path:
+            return min(on_path, key=lambda closest_point: math.hypot(closest_point.log_x - closest_point.p_x, closest_point.log_y - closest_point.p_y))
+    return match_point._replace(log_x=log.x, log_y=log.y, log_id=log.uuid, v=log.v, log_time=log.log_time, track_id=log.track_id, car_id=log.car_id)
+
+
+def expand_match_points(match_point_list, removed, road_index):
+    '''
+    把被删除的log插回匹配结果， 按原来的顺序排列
+
+    Parameters:
+    -----------
+    match_point_list : list
+        保留log的匹配结果（CPointRec列表）
+    removed : dict
+        compress_track的返回值
+    road_index : RoadSegmentIndex
+        用于获得过密log的候选点
+
+    Returns:
+    ---------
+    match_point_list : list
+    '''
+    if not removed:
+        return match_point_list
+
+    dense_logs = [removed_log.log for match_point in match_point_list for removed_log in removed.get(match_point.log_id, []) if not removed_log.is_stationary]
+    log_closest_points = get_track_closest_points(dense_logs, road_index) if dense_logs else {}
+
+    expanded_list = []
+    for idx, match_point in enumerate(match_point_list):
+        expanded_list.append(match_point)
+        next_match_point = match_point_list[idx + 1] if idx + 1 < len(match_point_list) else None
+        for removed_log in removed.get(match_point.log_id, []):
+            expanded_list.append(get_removed_point(removed_log, match_point, next_match_point, log_closest_points.get(removed_log.log.uuid, [])))
+    return expanded_list
@@ -0,0 +1,239 @@
+'''
+
+逐条轨迹读取gps log
+
+按track_id分组后每次返回一条轨迹， 内存占用只与单条轨迹的长度有关， 匹配可以在读完整个文件之前开始。
+
+输入中同一轨迹的log是连续的（例如按track_id排序）时直接按顺序分组；
+否则先把log按track_id的哈希值分桶写入临时文件， 再逐个桶分组。
+log_time在每条轨迹内用numpy批量解析。
+
+CSV和Parquet文件（列为x, y, uuid, track_id, log_time, car_id, v）不经过fiona逐个要素读取，
+而是一次读入numpy数组， 用排序代替逐条追加完成分组。 读取Parquet需要安装pyarrow。
+
+'''
+import os
+import pickle
+import tempfile
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+import fiona
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+TrackRec = namedtuple('TrackRec', ['x','y', 'uuid', 'track_id', 'log_time', 'car_id', 'v'])
+
+COLUMNS = ['x', 'y', 'uuid', 'track_id', 'log_time', 'car_id', 'v']
+COLUMN_DTYPES = [np.float64, np.float64, np.int64, np.int64, 'datetime64[s]', object, np.float64]
+
+
+def read_rows(shp_path):
+    '''
+    按文件顺序读取log
+
+    Returns:
+    ---------
+    generator of (x, y, uuid, track_id, log_time, car_id, v)
+        log_time为未解析的字符串
+    '''
+    c = fiona.open(shp_path)
+    try:
+        for feature in c:
+            x, y = feature['geometry']['coordinates'][:2]
+            properties = feature['properties']
+            yield (x, y, properties['uuid'], properties['track_id'], properties['log_time'], properties['car_id'], properties['v'])
+    finally:
+        c.close()
+
+
+def get_field_names(shp_path):
+    c = fiona.open(shp_path)
+    field_names = list(c.schema['properties'].keys())
+    c.close()
+    return field_names
+
+
+def is_grouped(shp_path):
+    '''
+    同一轨迹的log在文件中是否连续， 只读取track_id字段
+    '''
+    c = fiona.open(shp_path, ignore_geometry=True, ignore_fields=[name for name in get_field_names(shp_path) if name != 'track_id'])
+    try:
+        finished_track_ids = set()
+        pre_track_id = None
+        for feature in c:
+            track_id = feature['properties']['track_id']
+            if track_id != pre_track_id:
+                if track_id in finished_track_ids:
+                    return False
+                finished_track_ids.add(pre_track_id)
+                pre_track_id = track_id
+        return True
+    finally:
+        c.close()
+
+
+def to_track(rows):
+    '''
+    由一条轨迹的log构造TrackRec列表， 批量解析log_time
+    '''
+    log_times = np.array([row[4] for row in rows], dtype='datetime64[s]').tolist()
+    return [TrackRec(x, y, uuid, track_id, log_time, car_id, v) for (x, y, uuid, track_id, _, car_id, v), log_time in zip(rows, log_times)]
+
+
+def iter_grouped_tracks(rows):
+    '''
+    同一轨迹的log连续时， 按顺序分组
+
+    发现已经结束的轨迹再次出现时抛出ValueError。
+    '''
+    finished_track_ids = set()
+    track_id = None
+    track_rows = []
+    for row in rows:
+        if row[3] != track_id:
+            if track_rows:
+                yield track_id, to_track(track_rows)
+            finished_track_ids.add(track_id)
+            track_id = row[3]
+            if track_id in finished_track_ids:
+                raise ValueError('logs of track {} are not contiguous'.format(track_id))
+            track_rows = []
+        track_rows.append(row)
+    if track_rows:
+        yield track_id, to_track(track_rows)
+
+
+def iter_spilled_tracks(rows, bucket_count=64):
+    '''
+    同一轨迹的log不连续时， 先按track_id的哈希值分桶写入临时文件， 再逐个桶分组
+
+    每条轨迹内log保持文件中的顺序， 轨迹之间的顺序不保证。
+    '''
+    bucket_files = [tempfile.TemporaryFile() for _ in range(bucket_count)]
+    try:
+        for row in rows:
+            pickle.dump(row, bucket_files[hash(row[3]) % bucket_count], pickle.HIGHEST_PROTOCOL)
+
+        for bucket_file in bucket_files:
+            bucket_file.seek(0)
+            track_id_rows = OrderedDict()
+            while True:
+                try:
+                    row = pickle.load(bucket_file)
+                except EOFError:
+                    break
+                track_id_rows.setdefault(row[3], []).append(row)
+            bucket_file.close()
+            while track_id_rows:
+                track_id, track_rows = track_id_rows.popitem(last=False)
+                yield track_id, to_track(track_rows)
+    finally:
+        for bucket_file in bucket_files:
+            bucket_file.close()
+
+
+def read_csv_columns(csv_path):
+    '''
+    一次读取CSV文件中的所有log， 第一行为列名， 列的顺序任意
+
+    Returns:
+    ---------
+    columns : dict
+        列名 -> np.ndarray
+    '''
+    with open(csv_path, encoding='utf-8') as f:
+        header = [name.strip().strip('"') for name in f.readline().strip().split(',')]
+    missing = [name for name in COLUMNS if name not in header]
+    if missing:
+        raise ValueError('{} has no column {}'.format(csv_path, ', '.join(missing)))
+
+    dtype = np.dtype([(name, 'U64' if dtype is object else dtype) for name, dtype in zip(COLUMNS, COLUMN_DTYPES)])
+    table = np.loadtxt(
+        csv_path, dtype=dtype, delimiter=',', skiprows=1, usecols=[header.index(name) for name in COLUMNS],
+        quotechar='"', encoding='utf-8', ndmin=1
+    )
+    return dict((name, table[name]) for name in COLUMNS)
+
+
+def read_parquet_columns(parquet_path):
+    '''
+    一次读取Parquet文件中的所有log
+
+    Returns:
+    ---------
+    columns : dict
+        列名 -> np.ndarray
+    '''
+    if pq is None:
+        raise ImportError('reading parquet files requires pyarrow')
+    table = pq.read_table(parquet_path, columns=COLUMNS)
+    return dict(
+        (name, np.asarray(table.column(name).to_numpy(), dtype=dtype))
+        for name, dtype in zip(COLUMNS, COLUMN_DTYPES)
+    )
+
+
+def iter_column_tracks(columns):
+    '''
+    按track_id分组已读入数组的log
+
+    同一轨迹的log已经连续时直接按顺序切分， 否则按track_id稳定排序， 每条轨迹内log保持输入中的顺序，
+    轨迹按track_id从小到大返回。
+
+    Parameters:
+    -----------
+    columns : dict
+        列名 -> np.ndarray， 见read_csv_columns
+
+    Returns:
+    ---------
+    generator of (track_id, logs)
+    '''
+    track_ids = columns['track_id']
+    is_boundary = track_ids[1:] != track_ids[:-1]
+    if len(np.unique(track_ids)) != int(is_boundary.sum()) + int(len(track_ids) > 0):
+        order = np.argsort(track_ids, kind='stable')
+        columns = dict((name, column[order]) for name, column in columns.items())
+        track_ids = columns['track_id']
+        is_boundary = track_ids[1:] != track_ids[:-1]
+    bounds = np.r_[0, np.flatnonzero(is_boundary) + 1, len(track_ids)].tolist()
+
+    for begin, end in zip(bounds[:-1], bounds[1:]):
+        values = [columns[name][begin:end].tolist() for name in COLUMNS]
+        yield values[3][0], [TrackRec(*row) for row in zip(*values)]
+
+
+def iter_tracks(shp_path, is_sorted=None, bucket_count=64):
+    '''
+    逐条读取轨迹
+
+    Parameters:
+    -----------
+    shp_path : str
+        轨迹文件， 扩展名为.csv或.parquet时一次读入数组后分组， 否则为shp文件
+    is_sorted : bool
+        shp文件中同一轨迹的log是否连续， 为None时先读一遍track_id判断
+    bucket_count : int
+        不连续时分桶的数量， 内存中最多同时保存一个桶的log
+
+    Returns:
+    ---------
+    generator of (track_id, logs)
+    '''
+    ext = os.path.splitext(shp_path)[1].lower()
+    if ext == '.csv':
+        return iter_column_tracks(read_csv_columns(shp_path))
+    if ext == '.parquet':
+        return iter_column_tracks(read_parquet_columns(shp_path))
+
+    if is_sorted is None:
+        is_sorted = is_grouped(shp_path)
+    if is_sorted:
+        return iter_grouped_tracks(read_rows(shp_path))
+    return iter_spilled_tracks(read_rows(shp_path), bucket_count)
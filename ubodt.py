@@ -0,0 +1,223 @@
+'''
+
+上界起终点表（UBODT）
+
+对路网中的每个节点做一次有界的dijkstra搜索， 记录距离不超过delta的所有终点的最短距离和最短路径上进入终点的边，
+保存为可以内存映射的npy文件。 匹配时候选点之间的距离只需要查表， 不再需要搜索。
+
+多个进程用mmap打开同一个文件时， 通过操作系统的页缓存共享一份数据。
+
+生成时使用的路网指纹和delta记录在旁边的json文件中（connected_road.ubodt.json），
+路网改变或delta小于匹配使用的MAX_DIS时拒绝打开， 需要重新生成。
+
+usage:
+
+python ubodt.py ./shp/input/connected_road.shp --delta 5000
+
+'''
+import os
+import json
+import argparse
+import tempfile
+
+import numpy as np
+
+from road_graph import RoadGraph
+from cache import get_shapefile_fingerprint
+
+
+UBODT_VERSION = 1 # 表格式的版本， 改变后需要重新生成
+UBODT_DTYPE = np.dtype([('target', '<i4'), ('edge', '<i4'), ('dis', '<f8')])
+
+
+def get_ubodt_path(shp_path):
+    '''
+    UBODT文件与道路shp文件放在同一目录下
+
+    Returns:
+    ---------
+    (table_path, offsets_path)
+    '''
+    base_path = os.path.splitext(shp_path)[0]
+    return base_path + '.ubodt.npy', base_path + '.ubodt_offsets.npy'
+
+
+def get_ubodt_meta_path(table_path):
+    '''
+    记录生成参数的json文件， 与表文件同名
+    '''
+    return os.path.splitext(table_path)[0] + '.json'
+
+
+def read_ubodt_meta(table_path):
+    meta_path = get_ubodt_meta_path(table_path)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def check_ubodt(table_path, offsets_path, fingerprint, max_dis):
+    '''
+    检查UBODT是否可以用于当前的路网和MAX_DIS
+
+    Returns:
+    ---------
+    error : str
+        不能使用的原因， 可以使用时为None
+    '''
+    if not os.path.exists(table_path) or not os.path.exists(offsets_path):
+        return 'ubodt not found: {}'.format(table_path)
+    meta = read_ubodt_meta(table_path)
+    if meta is None or meta.get('version') != UBODT_VERSION:
+        return 'ubodt has no metadata or an old version: {}'.format(table_path)
+    if meta['fingerprint'] != fingerprint:
+        return 'ubodt was built from another road network: {}'.format(table_path)
+    if meta['delta'] < max_dis:
+        # 查询的cutoff最大为MAX_DIS， delta更小时部分可达的候选点会被当作不可达
+        return 'ubodt delta {} is smaller than MAX_DIS {}: {}'.format(meta['delta'], max_dis, table_path)
+    return None
+
+
+def build_ubodt(road_graph, table_path, offsets_path, delta, fingerprint):
+    '''
+    构造UBODT并写入文件
+
+    每个起点的记录按终点下标排序， offsets[i]到offsets[i+1]为起点i的记录。
+    记录先逐个起点写入临时文件， 内存占用只与单个起点的记录数有关。
+
+    Parameters:
+    -----------
+    road_graph : RoadGraph
+        路网图
+    delta : float
+        最大距离
+    fingerprint : str
+        道路shp文件的指纹， 见cache.get_shapefile_fingerprint
+    '''
+    node_count = len(road_graph.node_ids)
+    offsets = np.zeros(node_count + 1, dtype=np.int64)
+
+    table_dir = os.path.dirname(os.path.abspath(table_path))
+    with tempfile.TemporaryFile(dir=table_dir) as raw_file:
+        for source_idx in range(node_count):
+            dist, pred = road_graph.search(source_idx, 0, delta)
+            rows = np.empty(len(dist), dtype=UBODT_DTYPE)
+            rows['target'] = sorted(dist)
+            rows['edge'] = [-1 if pred[target_idx] is None else pred[target_idx] for target_idx in rows['target']]
+            rows['dis'] = [dist[target_idx] for target_idx in rows['target']]
+            raw_file.write(rows.tobytes())
+            offsets[source_idx + 1] = offsets[source_idx] + len(rows)
+            if source_idx % 1000 == 0:
+                print('build ubodt {}/{}'.format(source_idx, node_count))
+
+        raw_file.seek(0)
+        table = np.lib.format.open_memmap(table_path, mode='w+', dtype=UBODT_DTYPE, shape=(int(offsets[-1]),))
+        chunk_size = 1 << 20
+        for begin in range(0, len(table), chunk_size):
+            chunk = np.frombuffer(raw_file.read(chunk_size * UBODT_DTYPE.itemsize), dtype=UBODT_DTYPE)
+            table[begin:begin + len(chunk)] = chunk
+        table.flush()
+        del table
+
+    np.save(offsets_path, offsets)
+    # 最后写入， 没有生成完的表没有meta， 不会被打开
+    with open(get_ubodt_meta_path(table_path), 'w') as f:
+        json.dump({'version': UBODT_VERSION, 'fingerprint': fingerprint, 'delta': delta, 'node_count': node_count}, f)
+    print('ubodt rows: {}'.format(offsets[-1]))
+
+
+class UBODT(object):
+    '''
+    基于UBODT查表的路径查询， 接口与RoadGraph.shortest_paths相同
+    '''
+
+    def __init__(self, road_graph, table, offsets):
+        assert(len(offsets) == len(road_graph.node_ids) + 1)
+        self.road_graph = road_graph
+        self.table = table
+        self.offsets = offsets
+        self.table_targets = table['target']
+        self.table_edges = table['edge']
+        self.table_dis = table['dis']
+
+    @classmethod
+    def load(cls, road_graph, table_path, offsets_path, fingerprint, max_dis):
+        '''
+        以只读mmap方式打开UBODT
+
+        UBODT不是由指纹为fingerprint的路网生成或delta小于max_dis时抛出ValueError
+        '''
+        error = check_ubodt(table_path, offsets_path, fingerprint, max_dis)
+        if error is not None:
+            raise ValueError('{}, run python ubodt.py to rebuild it'.format(error))
+        table = np.load(table_path, mmap_mode='r')
+        offsets = np.load(offsets_path)
+        return cls(road_graph, table, offsets)
+
+    def lookup(self, source_idx, target_idx):
+        '''
+        查找source_idx到target_idx的记录下标， 不存在返回None
+        '''
+        begin, end = self.offsets[source_idx], self.offsets[source_idx + 1]
+        row = begin + np.searchsorted(self.table_targets[begin:end], target_idx)
+        if row < end and self.table_targets[row] == target_idx:
+            return row
+        return None
+
+    def get_pred(self, source_idx, target_idx):
+        '''
+        由UBODT恢复source_idx到target_idx最短路径上每个节点的入边， 格式与RoadGraph.search的pred相同
+        '''
+        pred = {}
+        node_idx = target_idx
+        while True:
+            edge_idx = int(self.table_edges[self.lookup(source_idx, node_idx)])
+            if edge_idx == -1:
+                pred[node_idx] = None
+                break
+            pred[node_idx] = edge_idx
+            node_idx = self.road_graph.sources[edge_idx]
+        return pred
+
+    def shortest_paths(self, pre_closest_point, now_closest_points, cutoff, max_dis, with_path=True):
+        '''
+        获得一个候选点到多个候选点的最短路径， 见RoadGraph.shortest_paths
+        '''
+        road_graph = self.road_graph
+        source_idx, source_dis, is_virtual_source = road_graph.get_search_source(pre_closest_point)
+
+        begin, end = self.offsets[source_idx], self.offsets[source_idx + 1]
+        source_targets = self.table_targets[begin:end]
+
+        result_list = []
+        for now_closest_point in now_closest_points:
+            target_idx, target_dis, is_virtual_target = road_graph.get_search_target(now_closest_point)
+            row = begin + np.searchsorted(source_targets, target_idx)
+            if row == end or self.table_targets[row] != target_idx:
+                result_list.append((max_dis, None, None))
+                continue
+            dis = source_dis + self.table_dis[row] + target_dis
+            if dis > cutoff:
+                result_list.append((max_dis, None, None))
+                continue
+            if not with_path:
+                result_list.append((float(dis), None, None))
+                continue
+            pred = self.get_pred(source_idx, target_idx)
+            vertex_path, road_path = road_graph.get_path(pred, target_idx, pre_closest_point, now_closest_point, is_virtual_source, is_virtual_target)
+            result_list.append((float(dis), vertex_path, road_path))
+        return result_list
+
+    def shortest_path(self, pre_closest_point, now_closest_point, cutoff, max_dis, with_path=True):
+        return self.shortest_paths(pre_closest_point, [now_closest_point], cutoff, max_dis, with_path)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='build ubodt')
+    parser.add_argument('shp_path', nargs='?', default='./shp/input/connected_road.shp')
+    parser.add_argument('--delta', type=float, default=5000)
+    args = parser.parse_args()
+
+    table_path, offsets_path = get_ubodt_path(args.shp_path)
+    build_ubodt(RoadGraph.from_shapefile(args.shp_path), table_path, offsets_path, args.delta, get_shapefile_fingerprint(args.shp_path))